@@ -23,19 +23,96 @@ from srmetadata import LVMMetadataHandler, UUID_TAG, NAME_LABEL_TAG, IS_A_SNAPSH
     VDI_DELETED_TAG, READ_ONLY_TAG, MANAGED_TAG, SNAPSHOT_OF_TAG, VDI_TYPE_TAG
 
 import os
-import copy
 import sys
-import tempfile
+import copy
+import time
+import shutil
+import threading
 import xs_errors
 import lvmconfigparser
+import lvmlabel
+import lvmresign
+import memfile
+import mgtpatch
+import workerpool
+import resignmetrics
+import resignjournal
+import vhdheader
 import vhdutil
 import iscsilib
 from lvhdutil import VG_LOCATION, VG_PREFIX
 from lvutil import CMD_PVCREATE, LVM_BIN, MDVOLUME_NAME
 from pprint import pformat as pf
+from cStringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 CMD_VGCFGRESTORE = os.path.join(LVM_BIN, "vgcfgrestore")
 CMD_PVDISPLAY = os.path.join(LVM_BIN, "pvdisplay")
+CMD_LVCHANGE = os.path.join(LVM_BIN, "lvchange")
+CMD_LVREMOVE = os.path.join(LVM_BIN, "lvremove")
+
+# maximum number of LVs passed to a single lvchange or lvremove call
+LV_BATCH_SIZE = 256
+
+SECTOR_SIZE = 512
+# size of the reads made when copying an LV from the PV
+LV_READ_SIZE = 1024 * 1024
+# size of the resign journal, at the end of the MGT volume
+JOURNAL_SIZE = 1024 * 1024
+
+DEFAULT_VDI_WORKERS = 8
+DEFAULT_LUN_WORKERS = 4
+DEFAULT_PORT = 3260
+# seconds to wait for the device of a LUN after the iSCSI login
+DEVICE_TIMEOUT = 60
+DEFAULT_METRICS_FILE = '/var/log/SMresign-metrics.log'
+# the generated LVM config is saved there with keep_config
+KEPT_CONFIG_FILE = '/var/log/SMresign-%s.conf'
+
+# outcomes of the resign of a LUN
+RESIGN_DONE = 'resigned'
+RESIGN_RESUMED = 'resumed'
+RESIGN_UNCHANGED = 'unchanged'
+
+# LUNs of a batch are resigned concurrently, but the sections reading and
+# restoring LVM metadata run one at a time
+_lvmLock = threading.Lock()
+# and so do their XAPI calls, which share the session of the driver
+_xapiLock = threading.Lock()
+
+
+class _LockedXenAPI(object):
+    """ The xenapi of the session shared by the LUNs of a batch: each call
+    holds _xapiLock """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        return _LockedXenAPI(getattr(self._target, name))
+
+    def __call__(self, *args):
+        _xapiLock.acquire()
+        try:
+            return self._target(*args)
+        finally:
+            _xapiLock.release()
+
+
+class _LockedSession(object):
+    """ The session of the driver, as used by the copy resigning a LUN of a
+    batch, in LVHDSR.load as well as in the resign """
+
+    def __init__(self, shared):
+        self._shared = shared
+        self.xenapi = _LockedXenAPI(shared.xenapi)
+
+    def __getattr__(self, name):
+        return getattr(self._shared, name)
 
 CAPABILITIES = ["SR_CREATE"]
 
@@ -51,7 +128,24 @@ CONFIGURATION = [['SCSIid', 'The scsi_id of the destination LUN'], \
                  ['port', 'The network port number on which to query the target'], \
                  ['multihomed',
                   'Enable multi-homing to this target, true or false (optional, defaults to same value as host.other_config:multipathing)'], \
-                 ['usediscoverynumber', 'The specific iscsi record index to use. (optional)']]
+                 ['usediscoverynumber', 'The specific iscsi record index to use. (optional)'], \
+                 ['vdi_workers',
+                  'Number of VDIs resigned concurrently (optional, defaults to %d)' % DEFAULT_VDI_WORKERS], \
+                 ['prune_snapshots',
+                  'Drop the snapshots, and the VHDs only they use, instead of resigning them, true or false (optional, defaults to false)'], \
+                 ['SCSIids',
+                  'Comma separated scsi_ids of LUNs of targetIQN to resign in one batch (optional)'], \
+                 ['targetIQNs',
+                  'Comma separated IQNs whose LUN0 is resigned in one batch (optional)'], \
+                 ['lun_workers',
+                  'Number of LUNs of a batch resigned concurrently (optional, defaults to %d)' % DEFAULT_LUN_WORKERS], \
+                 ['metrics_file',
+                  'File the metrics of each resign are appended to, as JSON lines (optional, defaults to %s)' % DEFAULT_METRICS_FILE], \
+                 ['verbose', 'Log the full SR metadata, true or false (optional, defaults to false)'], \
+                 ['keep_config',
+                  'Save the resigned LVM config to %s, true or false (optional, defaults to false)' % (KEPT_CONFIG_FILE % '<VG name>')], \
+                 ['force',
+                  'Resign LUNs which were resigned already, true or false (optional, defaults to false)']]
 
 DRIVER_INFO = {
     'name': 'LVHD over iSCSI with resigning of duplicates',
@@ -76,106 +170,574 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
 
     handles = staticmethod(handles)
 
+    def load(self, sr_uuid):
+        if self._getBatchLuns():
+            # the LUNs of a batch are attached by create
+            self.uuid = sr_uuid
+            return
+
+        LVHDoISCSISR.LVHDoISCSISR.load(self, sr_uuid)
+
     def create(self, sr_uuid, size):
+        luns = self._getBatchLuns()
+        if luns:
+            self._createBatch(sr_uuid, luns)
+
+        metrics = self._startMetrics(sr_uuid, self.dconf.get('device'))
         try:
+            try:
 
-            # attach the device
-            util.SMlog("Trying to attach iscsi disk")
+                # attach the device
+                util.SMlog("Trying to attach iscsi disk")
+
+                metrics.run('iscsi_attach', self.iscsi.attach, sr_uuid)
+                if not self.iscsi.attached:
+                    raise xs_errors.XenError('SRNotAttached')
+
+                util.SMlog("Attached iscsi disk at %s \n" % self.iscsi.path)
+
+                try:
+                    resigned_uuid, outcome = self._resign(sr_uuid)
+                except:
+                    util.logException("RESIGN_CREATE")
+                    raise
+
+            finally:
+                metrics.run('iscsi_logout', iscsilib.logout, self.iscsi.target,
+                            self.iscsi.targetIQN, all=True)
+        except:
+            self._finishMetrics(metrics, error=sys.exc_info()[1])
+            raise
+
+        self._finishMetrics(metrics, outcome)
+        if outcome == RESIGN_UNCHANGED:
+            raise xs_errors.XenError("The SR has already been resigned as SR %s. Use the lvmoiscsi type to "
+                                     "attach it, or force=true to resign it again" % resigned_uuid)
+        if outcome == RESIGN_RESUMED:
+            raise xs_errors.XenError("The SR has been successfully resigned as SR %s, resuming an "
+                                     "interrupted resign. Use the lvmoiscsi type to attach it" % resigned_uuid)
+        raise xs_errors.XenError("The SR has been successfully resigned. Use the lvmoiscsi type to attach it")
 
-            self.iscsi.attach(sr_uuid)
-            if not self.iscsi.attached:
-                raise xs_errors.XenError('SRNotAttached')
+    def _resign(self, sr_uuid):
+        """
+        Resigns the SR on the attached device, dconf['device']. The phases
+        are recorded in self.metrics, and journaled on the LUN so that a
+        resign which was interrupted is resumed by the next one, and one
+        which completed is not run again unless force is set.
+        :param sr_uuid: new uuid of the SR
+        :return: (uuid the SR was resigned with, outcome). The uuid is the
+        one of the previous resign if it is resumed or unchanged.
+        """
 
-            util.SMlog("Attached iscsi disk at %s \n" % self.iscsi.path)
+        metrics = self.metrics
 
+        pv_metadata = metrics.run('read_pv_metadata', self._readPvMetadata,
+                                  self.dconf['device'])
+        if pv_metadata:
+            vg_name, lvm_config_dict, wiped = pv_metadata
+        else:
+            wiped = False
+            _lvmLock.acquire()
             try:
+                vg_name = metrics.run('get_vg_name', self._getVgName,
+                                      self.dconf['device'])
 
-                # generate new UUIDs for VG and LVs
-                old_vg_name = self._getVgName(self.dconf['device'])
+                lvm_config_dict = metrics.run('get_lvm_info', self._getLvmInfo,
+                                              vg_name)
+            finally:
+                _lvmLock.release()
 
-                lvm_config_dict = self._getLvmInfo(old_vg_name)
-                lvUuidMap = {}  # Maps old lv uuids to new uuids
+        journal = metrics.run('open_journal', self._openJournal,
+                              lvm_config_dict[vg_name])
+        try:
+            return self._resignVg(sr_uuid, vg_name, lvm_config_dict, journal,
+                                  wiped)
+        finally:
+            if journal:
+                journal.close()
 
-                for lv_name in lvm_config_dict[old_vg_name]['logical_volumes']:
-                    if lv_name == MDVOLUME_NAME:
-                        continue
-                    oldUuid = lv_name[4:]  # remove the VHD-
-                    lvUuidMap[oldUuid] = util.gen_uuid()
+    def _resignVg(self, sr_uuid, vg_name, lvm_config_dict, journal,
+                  wiped=False):
+        """
+        Resigns the VG of the device, or resumes its resign
+        :param vg_name: name of the VG found on the device
+        :param lvm_config_dict: its LVM config
+        :param journal: resignjournal.ResignJournal, None to run without
+        :param wiped: True if the PV has a new label but no VG metadata, the
+        VG was read from what its metadata area held before
+        :return: see _resign
+        """
 
-                new_vg_name = VG_PREFIX + sr_uuid
+        metrics = self.metrics
+
+        plan, done = self._readJournal(journal, vg_name, wiped)
+        if 'completed' in done:
+            if not self._getBoolConfig('force') and \
+                    metrics.run('check_resigned', self._isResigned,
+                                vg_name, lvm_config_dict[vg_name], plan, done):
+                util.SMlog("%s was resigned already as SR %s" %
+                           (self.dconf['device'], plan['sr_uuid']))
+                return plan['sr_uuid'], RESIGN_UNCHANGED
+            plan, done = None, {}
+
+        if plan:
+            # the VG was restored, or pvcreate ran and the restore has to be
+            # run again, the new names and uuids are the ones of the journal
+            sr_uuid = plan['sr_uuid']
+            old_vg_name = plan['old_vg_name']
+            lvUuidMap = plan['lv_uuid_map']
+            pruned_lvs = set(plan['pruned_lvs'])
+            prune_snapshots = plan['prune_snapshots']
+            util.SMlog("Resuming the resign of %s as SR %s, done: %s" %
+                       (old_vg_name, sr_uuid, ', '.join(sorted(done)) or
+                        wiped and 'pvcreate' or 'resign_lvm'))
+        else:
+            old_vg_name = vg_name
+
+            # snapshots are dropped before the restore rather than
+            # resigned and deleted afterwards
+            prune_snapshots = self._getBoolConfig('prune_snapshots')
+            pruned_lvs = set()
+            if prune_snapshots:
+                pruned_lvs = metrics.run('prune_snapshots', self._getPrunedLvs,
+                                         lvm_config_dict[old_vg_name])
+
+            # Maps old lv uuids to new uuids
+            oldUuids = [lv_name[4:]  # remove the VHD-
+                        for lv_name in lvm_config_dict[old_vg_name]['logical_volumes']
+                        if lv_name != MDVOLUME_NAME and lv_name not in pruned_lvs]
+            lvUuidMap = dict(zip(oldUuids, lvmconfigparser.gen_uuids(len(oldUuids))))
+
+        new_vg_name = VG_PREFIX + sr_uuid
+
+        if not plan:
+            journal = self._startJournal(journal, {
+                'sr_uuid': sr_uuid, 'old_vg_name': old_vg_name,
+                'new_vg_name': new_vg_name, 'lv_uuid_map': lvUuidMap,
+                'pruned_lvs': sorted(pruned_lvs),
+                'prune_snapshots': prune_snapshots})
+
+        if vg_name == old_vg_name:
+            _lvmLock.acquire()
+            try:
+                restored_lvs = metrics.run('resign_lvm', self._resignLvm, sr_uuid,
+                                           old_vg_name, lvUuidMap,
+                                           lvm_config_dict, pruned_lvs)
+            finally:
+                _lvmLock.release()
+            self._journalPhase(journal, 'resign_lvm')
+        else:
+            # restored by the interrupted resign, less the LVs it removed
+            restored_lvs = lvm_config_dict[vg_name]['logical_volumes'].keys()
+
+        # causes creation of nodes and activates the lvm volumes
+        metrics.run('load', LVHDSR.LVHDSR.load, self, sr_uuid)
+
+        if 'resign_sr_metadata' in done:
+            snapshot_uuids = done['resign_sr_metadata']['snapshot_uuids']
+        else:
+            pruned_uuids = set([lv_name[4:] for lv_name in pruned_lvs])
+            snapshot_uuids = metrics.run('resign_sr_metadata',
+                                         self._resignSrMetadata, new_vg_name,
+                                         self.uuid, lvUuidMap, pruned_uuids,
+                                         not prune_snapshots, bool(plan))
+            self._journalPhase(journal, 'resign_sr_metadata',
+                               snapshot_uuids=snapshot_uuids)
+
+        if 'delete_snapshots' not in done:
+            metrics.run('delete_snapshots', self._deleteAllSnapshots,
+                        new_vg_name, lvUuidMap, snapshot_uuids, restored_lvs)
+            self._journalPhase(journal, 'delete_snapshots')
+        for old_uuid in snapshot_uuids:
+            del lvUuidMap[old_uuid]
+
+        if 'resign_vdis' not in done:
+            metrics.run('resign_vdis', self._resignVdis, new_vg_name, lvUuidMap,
+                        old_vg_name)
+            self._journalPhase(journal, 'resign_vdis')
+
+        # Detach LVM
+        lv_names = [self.LV_VHD_PREFIX + newUuid
+                    for newUuid in lvUuidMap.values()]
+        metrics.run('deactivate', self._deactivateLvs, new_vg_name,
+                    [MDVOLUME_NAME] + lv_names)
+
+        # the completed journal tells a retry that there is nothing to do
+        self._journalPhase(journal, 'completed')
+        return sr_uuid, plan and RESIGN_RESUMED or RESIGN_DONE
+
+    def _isResigned(self, vg_name, vg_info, plan, done):
+        """
+        Checks that a VG whose resign completed is still the one the resign
+        left, from its LVM config and the SR record of its MGT volume, and
+        that no other SR of the pool has its uuid
+        :param vg_name: name of the VG
+        :param vg_info: config dict of the VG
+        :param plan: plan of the resign, from the journal
+        :param done: the phases of the resign, from the journal
+        :return: True if the VG needs no resign
+        """
 
-                self._resignLvm(sr_uuid, old_vg_name, lvUuidMap, lvm_config_dict)
+        sr_uuid = plan['sr_uuid']
+        old_lv_names = set([self.LV_VHD_PREFIX + old_uuid
+                            for old_uuid in plan['lv_uuid_map']])
+        if old_lv_names.intersection(vg_info['logical_volumes']):
+            util.SMlog("%s holds LVs of the VG before the resign" % vg_name)
+            return False
 
-                # causes creation of nodes and activates the lvm volumes
-                LVHDSR.LVHDSR.load(self, sr_uuid)
+        fd = os.open(self.dconf['device'], os.O_RDONLY)
+        try:
+            offset = self._getLvSegments(vg_info, MDVOLUME_NAME)[0][0]
+            try:
+                mgt_uuid = mgtpatch.readSrUuid(fd, offset)
+            except mgtpatch.MgtFormatError, e:
+                util.SMlog("Cannot read the SR record of %s: %s" % (vg_name, e))
+                return False
+        finally:
+            os.close(fd)
+        if mgt_uuid != sr_uuid:
+            util.SMlog("The SR record of %s is the one of SR %s" %
+                       (vg_name, mgt_uuid))
+            return False
+
+        return self._isUniqueInPool(sr_uuid)
+
+    def _isUniqueInPool(self, sr_uuid):
+        """
+        :return: True if no SR of the pool has the uuid, but the SR of this
+        LUN once it is attached
+        """
+
+        if not self.session:
+            util.SMlog("No XAPI session, the pool cannot be checked for SR %s" %
+                       sr_uuid)
+            return False
+
+        srs = self.session.xenapi.SR.get_all_records_where(
+            'field "uuid" = "%s"' % sr_uuid)
+        pbds = {}
+        for sr_ref in srs:
+            sr_pbds = self.session.xenapi.PBD.get_all_records_where(
+                'field "SR" = "%s"' % sr_ref)
+            if not sr_pbds:
+                # its LUN is not known
+                util.SMlog("SR %s is in the pool without PBDs" % sr_uuid)
+                return False
+            pbds.update(sr_pbds)
+
+        scsi_id = self.dconf.get('SCSIid')
+        for pbd in pbds.itervalues():
+            device_config = pbd['device_config']
+            if scsi_id and device_config.get('SCSIid') != scsi_id or \
+                    not scsi_id and \
+                    device_config.get('targetIQN') != self.dconf.get('targetIQN'):
+                util.SMlog("SR %s is in the pool on another LUN, %s" %
+                           (sr_uuid, device_config.get('SCSIid')))
+                return False
+        return True
+
+    def _openJournal(self, vg_info):
+        """
+        Opens the resign journal, kept in the last JOURNAL_SIZE bytes of the
+        MGT volume, past the SR metadata
+        :param vg_info: config dict of the VG
+        :return: resignjournal.ResignJournal, None if the MGT volume has no
+        room for it
+        """
+
+        segments = self._getLvSegments(vg_info, MDVOLUME_NAME)
+        lv_size = sum([size for _offset, size in segments])
+        offset, size = segments[-1]
+        if size < JOURNAL_SIZE:
+            util.SMlog("The MGT volume has no room for the resign journal")
+            return None
+
+        fd = os.open(self.dconf['device'], os.O_RDWR)
+        try:
+            os.lseek(fd, segments[0][0], 0)
+            length = mgtpatch.readLength(os.read(fd, SECTOR_SIZE))
+            if length > lv_size - JOURNAL_SIZE:
+                raise mgtpatch.MgtFormatError("%d bytes of SR metadata" % length)
+        except (OSError, mgtpatch.MgtFormatError), e:
+            os.close(fd)
+            util.SMlog("Resigning without a journal: %s" % e)
+            return None
+
+        return resignjournal.ResignJournal(fd, offset + size - JOURNAL_SIZE,
+                                           JOURNAL_SIZE)
+
+    def _readJournal(self, journal, vg_name, wiped=False):
+        """
+        Reads the journal of an interrupted resign of the VG
+        :param vg_name: name of the VG found on the device
+        :param wiped: True if the PV has a new label but no VG metadata
+        :return: (plan, dict of the completed phases to their entries). The
+        plan is None if there is no resign to resume: no journal, or one of
+        a resign which did not restore the VG.
+        """
+
+        entries = []
+        if journal:
+            try:
+                entries = journal.read()
+            except OSError, e:
+                util.SMlog("Cannot read the resign journal: %s" % e)
+
+        if wiped:
+            # the resign was interrupted between pvcreate and vgcfgrestore,
+            # only its journal tells the names the VG is restored with
+            if not entries or entries[0].get('old_vg_name') != vg_name or \
+                    'resign_lvm' in [entry.get('phase') for entry in entries]:
+                raise xs_errors.XenError("The PV of %s has no VG metadata and no interrupted resign "
+                                         "of it to resume. Restore it with vgcfgrestore" % vg_name)
+        elif not entries or entries[0].get('new_vg_name') != vg_name:
+            return None, {}
+
+        # JSON strings are unicode, the names are used as str
+        plan = entries[0]
+        plan['sr_uuid'] = str(plan['sr_uuid'])
+        plan['old_vg_name'] = str(plan['old_vg_name'])
+        plan['lv_uuid_map'] = dict([(str(old_uuid), str(new_uuid))
+                                    for old_uuid, new_uuid in
+                                    plan['lv_uuid_map'].iteritems()])
+        plan['pruned_lvs'] = [str(lv_name) for lv_name in plan['pruned_lvs']]
+
+        done = {}
+        for entry in entries[1:]:
+            if entry.get('phase') == 'resign_sr_metadata':
+                entry['snapshot_uuids'] = [str(uuid) for uuid in
+                                           entry['snapshot_uuids']]
+            done[str(entry.get('phase'))] = entry
+        return plan, done
+
+    def _startJournal(self, journal, plan):
+        """
+        Writes the plan of a resign to the journal, before the VG is changed
+        :return: the journal, None if the plan could not be written
+        """
 
-                new_vdi_info = self._resignSrMetadata(new_vg_name, self.uuid, lvUuidMap)
-                self._resignVdis(new_vg_name, lvUuidMap)
-                self._deleteAllSnapshots(new_vdi_info)
+        if not journal:
+            return None
+        try:
+            journal.start(plan)
+        except (OSError, resignjournal.JournalError), e:
+            util.SMlog("Resigning without a journal: %s" % e)
+            return None
+        return journal
 
+    def _journalPhase(self, journal, phase, **fields):
+        """
+        Records a completed phase in the journal. A phase which is not
+        recorded is run again if the resign is resumed.
+        """
 
-                # Detach LVM
-                self.lvmCache.deactivateNoRefcount(MDVOLUME_NAME)
-                for newUuid in lvUuidMap.values():
-                    new_lv_name = self.LV_VHD_PREFIX + newUuid
-                    self.lvmCache.deactivateNoRefcount(new_lv_name)
+        if not journal:
+            return
+        fields['phase'] = phase
+        try:
+            journal.append(fields)
+        except (OSError, resignjournal.JournalError), e:
+            util.SMlog("Cannot journal the phase %s: %s" % (phase, e))
 
+    def _getBatchLuns(self):
+        """
+        Reads the LUNs of a batch resign from the device config
+        :return: list of (targetIQN, SCSIid) of the LUNs, SCSIid is None for
+        LUN0 of a target given in targetIQNs. Empty if no batch is requested.
+        """
+
+        luns = []
+
+        for scsi_id in self.dconf.get('SCSIids', '').split(','):
+            scsi_id = scsi_id.strip()
+            if scsi_id:
+                if not self.dconf.get('targetIQN'):
+                    raise xs_errors.XenError('ConfigTargetIQNMissing')
+                luns.append((self.dconf['targetIQN'], scsi_id))
+
+        for iqn in self.dconf.get('targetIQNs', '').split(','):
+            iqn = iqn.strip()
+            if iqn:
+                luns.append((iqn, None))
+
+        return luns
+
+    def _createBatch(self, sr_uuid, luns):
+        """
+        Resigns several LUNs concurrently. Every target IQN is logged in once
+        and its session is shared by its LUNs. The first LUN gets sr_uuid,
+        the others new uuids. Raises an error holding a JSON report with the
+        outcome for each LUN.
+        :param sr_uuid: uuid of the SR being created
+        :param luns: list of (targetIQN, SCSIid) as returned by _getBatchLuns
+        """
+
+        start = time.time()
+        workers = self._getIntConfig('lun_workers', DEFAULT_LUN_WORKERS)
+
+        if not self.dconf.get('target'):
+            raise xs_errors.XenError('ConfigServerMissing')
+        try:
+            target = util._convertDNS(self.dconf['target'].split(',')[0])
+        except:
+            raise xs_errors.XenError('DNSError')
+        portal = "%s:%s" % (target, self.dconf.get('port') or DEFAULT_PORT)
+
+        iqns = []
+        for iqn, _scsi_id in luns:
+            if iqn not in iqns:
+                iqns.append(iqn)
+
+        sr_uuids = [sr_uuid] + lvmconfigparser.gen_uuids(len(luns) - 1)
+
+        def resignLun(index):
+            iqn, scsi_id = luns[index]
+            if iqn not in sessions:
+                raise xs_errors.XenError('ISCSILogin')
+
+            if scsi_id:
+                device = os.path.join('/dev/disk/by-id', 'scsi-' + scsi_id)
+            else:
+                device = os.path.join('/dev/iscsi', iqn, portal, 'LUN0')
+            if not util.wait_for_path(device, DEVICE_TIMEOUT):
+                raise xs_errors.XenError('SRNotAttached')
+
+            # each LUN is resigned by its own copy of the driver
+            lun = copy.copy(self)
+            lun.dconf = self.dconf.copy()
+            if self.session:
+                lun.session = _LockedSession(self.session)
+            lun.dconf['device'] = device
+            lun.dconf['targetIQN'] = iqn
+            if scsi_id:
+                lun.dconf['SCSIid'] = scsi_id
+
+            util.SMlog("RESIGN LUN %s as SR %s" % (device, sr_uuids[index]))
+            metrics = lun._startMetrics(sr_uuids[index], device)
+            try:
+                resigned_uuid, outcome = lun._resign(sr_uuids[index])
             except:
-                util.logException("RESIGN_CREATE")
+                util.logException("RESIGN_CREATE %s" % device)
+                lun._finishMetrics(metrics, error=sys.exc_info()[1])
                 raise
+            lun._finishMetrics(metrics, outcome)
+            return device, resigned_uuid, outcome
 
+        sessions = []
+        try:
+            for result in workerpool.run(lambda iqn: self._loginTarget(portal, iqn),
+                                         iqns, workers):
+                if result.error:
+                    util.SMlog("Login to %s failed: %s" % (result.item, result.error[1]))
+                else:
+                    sessions.append(result.item)
+
+            results = workerpool.run(resignLun, range(len(luns)), workers)
         finally:
-            iscsilib.logout(self.iscsi.target, self.iscsi.targetIQN, all=True)
+            for iqn in sessions:
+                try:
+                    iscsilib.logout(portal, iqn)
+                except:
+                    util.logException("RESIGN_LOGOUT %s" % iqn)
+
+        report = []
+        for result in results:
+            iqn, scsi_id = luns[result.item]
+            entry = {'targetIQN': iqn, 'SCSIid': scsi_id,
+                     'sr_uuid': sr_uuids[result.item]}
+            if result.error:
+                entry['status'] = 'failed'
+                entry['error'] = str(result.error[1])
+            else:
+                entry['device'], entry['sr_uuid'], entry['status'] = result.value
+            report.append(entry)
+
+        resigned = len([entry for entry in report if entry['status'] != 'failed'])
+        util.SMlog("RESIGN BATCH DONE: %d of %d LUNs resigned in %.2fs with %d workers" %
+                   (resigned, len(luns), time.time() - start, workers))
+
+        raise xs_errors.XenError("Resigned %d of %d LUNs. Use the lvmoiscsi type to attach "
+                                 "them. Report: %s" % (resigned, len(luns), json.dumps(report)))
+
+    def _loginTarget(self, portal, iqn):
+        """
+        Logs in to a target, with the CHAP settings of the device config
+        :param portal: ip:port of the target portal
+        :param iqn: IQN of the target
+        """
 
-        raise xs_errors.XenError("The SR has been successfully resigned. Use the lvmoiscsi type to attach it")
+        cmd = ["iscsiadm", "-m", "node", "-p", portal, "-T", iqn, "-o", "new"]
+        iscsilib.exn_on_failure(cmd, "Unable to create an iSCSI record %s:%s" %
+                                (iqn, portal))
 
-    def _resignLvm(self, new_uuid, old_vg_name, lvUuidMap, lvm_config_dict):
+        if self.dconf.get('chapuser') and self.dconf.get('chappassword'):
+            iscsilib.set_chap_settings(portal, iqn, self.dconf['chapuser'],
+                                       self.dconf['chappassword'],
+                                       self.dconf.get('incoming_chapuser', ''),
+                                       self.dconf.get('incoming_chappassword', ''))
 
-        resigned_lvm_config = copy.deepcopy(lvm_config_dict)
-        vg_info = resigned_lvm_config[old_vg_name]
-        del resigned_lvm_config[old_vg_name]
+        cmd = ["iscsiadm", "-m", "node", "-p", portal, "-T", iqn, "-l"]
+        iscsilib.exn_on_failure(cmd, "Failed to login to target.")
+        if not iscsilib.wait_for_devs(iqn, portal):
+            raise xs_errors.XenError('ISCSILogin')
 
-        new_vg_name = VG_PREFIX + new_uuid
-        resigned_lvm_config[new_vg_name] = vg_info
+    def _resignLvm(self, new_uuid, old_vg_name, lvUuidMap, lvm_config_dict,
+                   pruned_lvs=()):
+        """
+        Restores the VG under its new name, with new PV and LV ids and the
+        VHD LVs renamed after their new uuids
+        :return: names of the LVs of the restored VG
+        """
 
-        # resign the PV
-        pv_uuid = None
+        vg_info = lvm_config_dict[old_vg_name]
+        new_vg_name = VG_PREFIX + new_uuid
 
-        for pv in vg_info['physical_volumes']:
-            pv_uuid = lvmconfigparser.gen_lvm_uuid()
-            vg_info['physical_volumes'][pv]['id'] = pv_uuid
-            vg_info['physical_volumes'][pv]['device'] = self.dconf['device']
+        pvs = vg_info['physical_volumes'].keys()
+        lvs = [lv_name for lv_name in vg_info['logical_volumes']
+               if lv_name not in pruned_lvs]
+        assert pvs, "PV not found in config"
 
-        assert pv_uuid, "PV not found in config"
+        # resign the PV and the LVs, all new ids are generated up front
+        new_ids = lvmconfigparser.gen_lvm_uuids(len(pvs) + len(lvs))
+        pv_ids = dict(zip(pvs, new_ids[:len(pvs)]))
+        lv_ids = dict(zip(lvs, new_ids[len(pvs):]))
+        pv_uuid = new_ids[0]
 
-        # resign the LVs
-        for lv_name in vg_info['logical_volumes'].keys():
-            vg_info['logical_volumes'][lv_name]['id'] = lvmconfigparser.gen_lvm_uuid()
+        # rename the VHD LVs after their new uuids
+        lv_names = {}
+        for lv_name in lvs:
             if lv_name != MDVOLUME_NAME:
-                # change the vg name
                 old_uuid = lv_name[4:]  # Remove the VHD-
-                new_uuid = lvUuidMap[old_uuid]
-                new_lv_name = self.LV_VHD_PREFIX + new_uuid
+                lv_names[lv_name] = self.LV_VHD_PREFIX + lvUuidMap[old_uuid]
 
-                vg_info['logical_volumes'][new_lv_name] = vg_info['logical_volumes'][lv_name]
-                del vg_info['logical_volumes'][lv_name]
+        # the resigned config is a view of the original one, the new names
+        # and ids are substituted as it is written
+        resigned_config = lvmresign.ResignedLvmConfig(
+            lvm_config_dict, old_vg_name, new_vg_name, pv_ids,
+            self.dconf['device'], lv_ids, lv_names, pruned_lvs)
+
+        # the new config is kept in memory, the tools read it by path
+        config_file = memfile.MemFile('SMresign-' + new_vg_name)
+        try:
+            fd = config_file.open('w')
+            try:
+                resigned_config.write(fd)
+            finally:
+                fd.close()
 
-        # write new config to disk
-        _fd, config_file = tempfile.mkstemp()
-        resigned_config = lvmconfigparser.LvmConfigParser(resigned_lvm_config)
-        fd = open(config_file, 'w')
-        fd.write(resigned_config.toConfigString())
-        fd.close()
+            if self._getBoolConfig('keep_config'):
+                self._keepConfig(new_vg_name, config_file.read())
 
-        # restore from this config
-        util.pread2([CMD_PVCREATE, '-u', pv_uuid, '-ff', '-y', '--restorefile',
-                     config_file, self.dconf['device']])
+            # restore from this config
+            util.pread2([CMD_PVCREATE, '-u', pv_uuid, '-ff', '-y', '--restorefile',
+                         config_file.path, self.dconf['device']])
 
-        util.pread2([CMD_VGCFGRESTORE, '-f', config_file, new_vg_name])
+            util.pread2([CMD_VGCFGRESTORE, '-f', config_file.path, new_vg_name])
+        finally:
+            config_file.close()
 
-        # remove the tempfile which stored the config
-        os.remove(config_file)
         util.SMlog("RESIGN LVM DONE.")
+        return [lv_names.get(lv_name, lv_name) for lv_name in lvs]
 
 
     def _getLvmInfo(self, vg_name):
@@ -185,23 +747,248 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
         :return: lvm config dict
         """
 
-        _fd, temp_file = tempfile.mkstemp()
-        util.pread2(['vgcfgbackup', '-f', temp_file, vg_name])
+        # vgcfgbackup replaces the file by renaming a temp file of its
+        # directory, so it gets a private directory rather than a MemFile
+        temp_dir = memfile.mkdtemp()
+        try:
+            temp_file = os.path.join(temp_dir, vg_name)
+            util.pread2(['vgcfgbackup', '-f', temp_file] +
+                        self._lvmDeviceFilter(self.dconf['device']) + [vg_name])
+
+            # parse old config
+            lvm_config = lvmconfigparser.LvmConfigParser()
+            lvm_config.parse(temp_file)
+            lvm_config_dict = lvm_config.toDict()
+        finally:
+            shutil.rmtree(temp_dir, True)
+
+        self._checkLvmInfo(vg_name, lvm_config_dict)
+        return lvm_config_dict
 
-        # parse old config
-        lvm_config = lvmconfigparser.LvmConfigParser()
-        lvm_config.parse(temp_file)
-        lvm_config_dict = lvm_config.toDict()
+    def _keepConfig(self, vg_name, config):
+        """
+        Saves a generated LVM config for post-mortem
+        :param vg_name: name of the VG of the config
+        :param config: text of the config
+        """
 
-        os.remove(temp_file)
+        path = KEPT_CONFIG_FILE % vg_name
+        try:
+            fd = open(path, 'w')
+            try:
+                fd.write(config)
+            finally:
+                fd.close()
+        except IOError, e:
+            util.SMlog("Cannot save the LVM config to %s: %s" % (path, e))
+            return
+        util.SMlog("Saved the LVM config to %s" % path)
+
+    def _checkLvmInfo(self, vg_name, lvm_config_dict):
+        """
+        Checks that the LVM config holds the VG of a single PV
+        """
 
         assert vg_name in lvm_config_dict, "No volume group found"
         assert 'physical_volumes' in lvm_config_dict[vg_name], "No physical volumes found"
         assert len(lvm_config_dict[vg_name]['physical_volumes']) == 1, "LUN should container only 1 physical volume"
         assert 'logical_volumes' in lvm_config_dict[vg_name], "No logical volumes found"
 
-        return lvm_config_dict
+    def _readPvMetadata(self, device):
+        """
+        Reads the VG name and config from the LVM2 label and metadata area of
+        the PV, which saves the pvdisplay and vgcfgbackup calls and their
+        device scans
+        :param device: device of the LUN
+        :return: (vg name, lvm config dict, wiped), None if the metadata must
+        be read with the LVM tools. wiped is True if the PV has a new label
+        but no VG metadata, and the VG is the one its metadata area held
+        before.
+        """
+
+        try:
+            fd = os.open(device, os.O_RDONLY)
+            try:
+                pv = lvmlabel.readPvMetadata(fd)
+                if pv and not pv.text:
+                    return self._readPreviousMetadata(fd, device)
+            finally:
+                os.close(fd)
+
+            if not pv or not pv.text:
+                util.SMlog("No LVM metadata found on %s, using the LVM tools" %
+                           device)
+                return None
+
+            lvm_config = lvmconfigparser.LvmConfigParser()
+            lvm_config.parse(StringIO(pv.text))
+        except (OSError, lvmlabel.LvmLabelError, lvmconfigparser.ParseError), e:
+            util.SMlog("Cannot read the LVM metadata of %s, using the LVM "
+                       "tools: %s" % (device, e))
+            return None
+
+        lvm_config_dict = lvm_config.toDict()
+        self._checkLvmInfo(pv.vg_name, lvm_config_dict)
+
+        pv_ids = [pv_info.get('id') for pv_info in
+                  lvm_config_dict[pv.vg_name]['physical_volumes'].itervalues()]
+        if pv_ids != [pv.pv_uuid]:
+            util.SMlog("The LVM metadata of %s is not the one of PV %s, using "
+                       "the LVM tools" % (device, pv.pv_uuid))
+            return None
+
+        util.SMlog("Read VG %s, seqno %d, from the label of %s" %
+                   (pv.vg_name, pv.seqno, device))
+        return pv.vg_name, lvm_config_dict, False
+
+    def _readPreviousMetadata(self, fd, device):
+        """
+        Reads the VG metadata of a PV whose label pvcreate rewrote, from what
+        the circular buffer of its metadata area held before, so that a resign
+        interrupted before vgcfgrestore can restore the VG from its journal.
+        pvcreate gives the PV a new id, which the metadata does not match.
+        :param fd: file descriptor of the device
+        :return: see _readPvMetadata
+        """
+
+        for vg_name, seqno, text in lvmlabel.readPreviousMetadata(fd):
+            lvm_config = lvmconfigparser.LvmConfigParser()
+            try:
+                lvm_config.parse(StringIO(text))
+                lvm_config_dict = lvm_config.toDict()
+                self._checkLvmInfo(vg_name, lvm_config_dict)
+            except (lvmconfigparser.ParseError, AssertionError), e:
+                util.SMlog("Skipping the previous metadata of VG %s, seqno "
+                           "%d: %s" % (vg_name, seqno, e))
+                continue
+
+            util.SMlog("The label of %s has no metadata, read VG %s, seqno %d, "
+                       "from its metadata area" % (device, vg_name, seqno))
+            return vg_name, lvm_config_dict, True
 
+        util.SMlog("No LVM metadata found on %s, using the LVM tools" % device)
+        return None
+
+
+    def _getPrunedLvs(self, vg_info):
+        """
+        Finds the LVs dropped when the snapshots are pruned: the snapshot VDIs
+        and the hidden VHDs that no other VDI depends on. The VG cannot be
+        activated before it is resigned, so the MGT metadata and the VHD
+        headers are read from the PV at the offsets of the LVs.
+
+        :param vg_info: config dict of the VG
+        :return: set of the names of the LVs to drop
+        """
+
+        start = time.time()
+        lv_names = [lv_name for lv_name in vg_info['logical_volumes']
+                    if lv_name != MDVOLUME_NAME]
+
+        fd = os.open(self.dconf['device'], os.O_RDONLY)
+        try:
+            snapshots = set([self.LV_VHD_PREFIX + uuid
+                             for uuid in self._getSnapshotUuids(fd, vg_info)])
+
+            headers = {}
+
+            def getHeader(lv_name):
+                if lv_name not in headers:
+                    assert lv_name in vg_info['logical_volumes'], \
+                        "Parent LV %s not found" % lv_name
+                    headers[lv_name] = vhdheader.readHeader(
+                        fd, self._getLvSegments(vg_info, lv_name)[0][0])
+                return headers[lv_name]
+
+            # keep the VDIs which are not snapshots, and their VHD chains
+            kept = set()
+            for lv_name in lv_names:
+                if lv_name in snapshots:
+                    continue
+                header = getHeader(lv_name)
+                if header and header.hidden:
+                    continue
+                while lv_name and lv_name not in kept:
+                    kept.add(lv_name)
+                    header = getHeader(lv_name)
+                    lv_name = header and header.getParentLvName()
+        finally:
+            os.close(fd)
+
+        pruned = set(lv_names) - kept
+        util.SMlog("PRUNE SNAPSHOTS: %d snapshots, %d of %d LVs dropped in %.2fs" %
+                   (len(snapshots), len(pruned), len(lv_names), time.time() - start))
+        return pruned
+
+    def _getSnapshotUuids(self, fd, vg_info):
+        """
+        Reads the MGT volume from the PV and returns the uuids of the snapshots
+        it lists
+        :param fd: file descriptor of the PV
+        :param vg_info: config dict of the VG
+        """
+
+        segments = self._getLvSegments(vg_info, MDVOLUME_NAME)
+
+        # the records are read in place when the metadata is in the first
+        # segment of the volume, as laid out by srmetadata
+        try:
+            mgt = mgtpatch.MgtMetadata(fd, segments[0][0])
+            if mgt.length <= segments[0][1]:
+                return [record.uuid for record in mgt.records
+                        if record.is_a_snapshot and not record.deleted]
+            util.SMlog("SR metadata beyond the first segment of the MGT volume")
+        except mgtpatch.MgtFormatError, e:
+            util.SMlog("Cannot read the SR metadata in place: %s" % e)
+
+        mgt_file = memfile.MemFile('SMresign-MGT')
+        try:
+            mgt_fd = mgt_file.open('w')
+            try:
+                for offset, size in segments:
+                    os.lseek(fd, offset, 0)
+                    while size > 0:
+                        data = os.read(fd, min(size, LV_READ_SIZE))
+                        assert data, "Short read of the MGT volume"
+                        mgt_fd.write(data)
+                        size -= len(data)
+            finally:
+                mgt_fd.close()
+
+            sr_info, vdi_info = LVMMetadataHandler(mgt_file.path,
+                                                   False).getMetadata()
+        finally:
+            mgt_file.close()
+
+        return [vi[UUID_TAG] for vi in vdi_info.itervalues()
+                if vi[IS_A_SNAPSHOT_TAG] == '1']
+
+    def _getLvSegments(self, vg_info, lv_name):
+        """
+        Locates an LV on the PV from the LVM config
+        :param vg_info: config dict of the VG
+        :param lv_name: name of the LV
+        :return: list of the (offset, size) in bytes of the segments of the LV
+        on the PV, in the order of the LV
+        """
+
+        extent_size = vg_info['extent_size'] * SECTOR_SIZE
+        segments = []
+
+        for key, segment in vg_info['logical_volumes'][lv_name].iteritems():
+            if not key.startswith('segment') or type(segment) != dict:
+                continue
+            assert segment['stripe_count'] == 1, \
+                "Striped LV %s is not supported" % lv_name
+            pv_name, start_pe = segment['stripes'][:2]
+            pe_start = vg_info['physical_volumes'][pv_name]['pe_start'] * SECTOR_SIZE
+            segments.append((segment['start_extent'],
+                             pe_start + start_pe * extent_size,
+                             segment['extent_count'] * extent_size))
+
+        assert segments, "No segments found for LV %s" % lv_name
+        segments.sort()
+        return [(offset, size) for _start, offset, size in segments]
 
     def _getSrMetadata(self, mdata_dev):
         """
@@ -215,8 +1002,9 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
 
         sr_info, vdi_info = LVMMetadataHandler(mdata_dev).getMetadata()
 
-        util.SMlog("sr_info: %s" % sr_info)
-        util.SMlog("vdi_info: %s" % vdi_info)
+        if self._getBoolConfig('verbose'):
+            util.SMlog("sr_info: %s" % sr_info)
+            util.SMlog("vdi_info: %s" % vdi_info)
 
         vdi_info_map = {}
 
@@ -225,22 +1013,57 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
 
         return vdi_info_map
 
-    def _deleteAllSnapshots(self, vdi_info):
+    def _deleteAllSnapshots(self, vg_name, lvUuidMap, snapshot_uuids, lv_names):
+        """
+        Removes the LVs of the snapshots with one lvremove call per batch of
+        LVs, instead of loading every VDI of the SR and removing the LVs one
+        at a time
+
+        :param vg_name: The Volumegroup where the VDIs reside
+        :param lvUuidMap: map from old uuids to new uuids
+        :param snapshot_uuids: old uuids of the snapshots
+        :param lv_names: names of the LVs of the VG, as restored
+        """
 
-        self._loadvdis()
+        if not snapshot_uuids:
+            return
 
+        start = time.time()
         util.SMlog("Deleting all snapshots")
-        for offset, vi in vdi_info.iteritems():
-            if vi['is_a_snapshot'] == '1':
-                uuid = vi['uuid']
-                vdi = self.allVDIs[uuid]
-                assert vdi, "VDI not found for deletion"
-                util.SMlog("Delete %s" % uuid)
-                lv_name = self.LV_VHD_PREFIX + uuid
+
+        existing = set(lv_names)
+        lv_names = []
+        for old_uuid in snapshot_uuids:
+            # the LVM config read before the resign lists every LV
+            assert old_uuid in lvUuidMap, "VDI not found for deletion"
+            lv_name = self.LV_VHD_PREFIX + lvUuidMap[old_uuid]
+            # removed already if the resign is resumed
+            if lv_name in existing:
+                lv_names.append(lv_name)
+        if not lv_names:
+            return
+
+        failed = []
+        for batch in self._lvBatches(lv_names):
+            try:
+                util.pread2([CMD_LVREMOVE, '-f'] + self._lvPaths(vg_name, batch))
+            except util.CommandException, e:
+                util.SMlog("Bulk removal failed, removing LVs one at a time: "
+                           "%s" % e)
+                failed.extend(batch)
+
+        # the cache drops the removed LVs, and keeps those of a failed batch
+        # that are left
+        self.lvmCache.refresh()
+        for lv_name in failed:
+            if self.lvmCache.checkLV(lv_name):
                 self.lvmCache.remove(lv_name)
 
+        util.SMlog("DELETE SNAPSHOTS DONE: %d LVs removed in %.2fs" %
+                   (len(lv_names), time.time() - start))
 
-    def _resignSrMetadata(self, vg_name, sr_uuid, vdi_uuids):
+    def _resignSrMetadata(self, vg_name, sr_uuid, vdi_uuids, pruned_uuids=(),
+                          drop_snapshots=False, resumed=False):
         """
         Xen stores the metatadata about an LVM SR in a separate volume group
         named MGT. This function reads that metadata and resigns it.
@@ -248,23 +1071,62 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
         :param mdata_dev: The MGT volume device that holds the SR metadata
         :param sr_uuid: new UUID that needs to be used
         :param vdi_uuids: a map between old uuid and new uuids which was generated when rewriting LVM config
+        :param pruned_uuids: uuids of the VDIs dropped from the SR, whose records are removed
+        :param drop_snapshots: remove the records of the snapshots too
+        :param resumed: the metadata may have been resigned in part by an
+        interrupted resign
+        :return: old uuids of the snapshots whose records were removed
 
         """
 
         util.SMlog("Resigning the SR metadata")
 
         mdata_dev = os.path.join(lvhdutil.VG_LOCATION, vg_name, MDVOLUME_NAME)
+
+        # the uuids are patched in place, the whole metadata is only
+        # rewritten if it does not have the expected layout
+        fd = os.open(mdata_dev, os.O_RDWR)
+        try:
+            try:
+                mgt = mgtpatch.MgtMetadata(fd)
+            except mgtpatch.MgtFormatError, e:
+                util.SMlog("Cannot patch the SR metadata, rewriting it: %s" % e)
+            else:
+                return self._patchSrMetadata(mgt, sr_uuid, vdi_uuids,
+                                             pruned_uuids, drop_snapshots,
+                                             resumed)
+        finally:
+            os.close(fd)
+
         sr_info, vdi_info = LVMMetadataHandler(mdata_dev).getMetadata()
 
-        util.SMlog("sr_info: %s" % pf(sr_info))
-        util.SMlog("vdi_info: %s" % pf(vdi_info))
+        verbose = self._getBoolConfig('verbose')
+        if verbose:
+            util.SMlog("sr_info: %s" % pf(sr_info))
+            util.SMlog("vdi_info: %s" % pf(vdi_info))
+        util.SMlog("Read %d VDI records" % len(vdi_info))
 
         sr_info[UUID_TAG] = sr_uuid
+        snapshot_uuids = []
+        new_uuids = set(vdi_uuids.values())
 
         # change the uuids and name labels for VDIs
         for vdi_offset in vdi_info.keys():
             vdi_map = vdi_info[vdi_offset]
             old_uuid = vdi_map[UUID_TAG]
+            if old_uuid in new_uuids:
+                # resigned before the resign was interrupted
+                continue
+
+            if old_uuid in pruned_uuids:
+                del vdi_info[vdi_offset]
+                continue
+
+            if drop_snapshots and vdi_map[IS_A_SNAPSHOT_TAG] == '1':
+                snapshot_uuids.append(old_uuid)
+                del vdi_info[vdi_offset]
+                continue
+
             new_uuid = vdi_uuids[old_uuid]
             vdi_map[UUID_TAG] = new_uuid
 
@@ -277,43 +1139,347 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
 
             #vdi_map[NAME_LABEL_TAG] = self.CLONE_NAME_LABEL_PREFIX + vdi_map[NAME_LABEL_TAG]
 
-        util.SMlog("Vdi info to update %s" % pf(vdi_info))
+        if verbose:
+            util.SMlog("Vdi info to update %s" % pf(vdi_info))
+        util.SMlog("Writing %d VDI records" % len(vdi_info))
         LVMMetadataHandler(mdata_dev).writeMetadata(sr_info, vdi_info)
 
-        return vdi_info
+        return snapshot_uuids
 
 
-    def _resignVdis(self, vg_name, lvUuidMap):
+    def _patchSrMetadata(self, mgt, sr_uuid, vdi_uuids, pruned_uuids,
+                         drop_snapshots, resumed=False):
+        """
+        Resigns the SR metadata in place: the uuid fields of the records are
+        rewritten, and the dropped records are marked deleted. Only the
+        sectors holding changed fields are written. Records which already
+        carry a new uuid are left as they are, so an interrupted patch can be
+        run again.
+
+        :param mgt: mgtpatch.MgtMetadata read from the MGT volume
+        :return: old uuids of the snapshots whose records were removed,
+        see _resignSrMetadata
+        """
+
+        start = time.time()
+        records = [record for record in mgt.records if not record.deleted]
+        util.SMlog("Read %d VDI records" % len(records))
+
+        mgt.setSrUuid(sr_uuid)
+        snapshot_uuids = []
+        dropped = 0
+
+        if resumed and drop_snapshots:
+            # snapshots whose records were dropped by the interrupted resign,
+            # their LVs may still be there
+            snapshot_uuids = [record.uuid for record in mgt.records
+                              if record.deleted and record.is_a_snapshot and
+                              record.uuid in vdi_uuids]
+
+        new_uuids = set(vdi_uuids.values())
+        for record in records:
+            old_uuid = record.uuid
+            if old_uuid in new_uuids:
+                continue
+
+            if old_uuid in pruned_uuids:
+                mgt.delete(record)
+                dropped += 1
+                continue
+
+            if drop_snapshots and record.is_a_snapshot:
+                snapshot_uuids.append(old_uuid)
+                mgt.delete(record)
+                dropped += 1
+                continue
+
+            mgt.setUuid(record, vdi_uuids[old_uuid])
+
+            # sometimes the uuid is not present and this may be a stale
+            # snapshot which will be clean by GC
+            if record.snapshot_of in vdi_uuids:
+                mgt.setSnapshotOf(record, vdi_uuids[record.snapshot_of])
+
+        written = mgt.write()
+        util.SMlog("PATCH SR METADATA DONE: %d VDI records, %d dropped, %d "
+                   "bytes written in %.2fs" % (len(records), dropped, written,
+                                               time.time() - start))
+        return snapshot_uuids
+
+    def _resignVdis(self, vg_name, lvUuidMap, old_vg_name):
         """
         Changes the parent locators in each VDI so it points to the resigned LVs
 
+        The parent of every VDI is read first to build the VHD parent graph,
+        then the locators are rewritten. Both steps run on a pool of
+        vdi_workers threads; every LV is activated once, up front. The VHD
+        headers are read and rewritten in process, vhd-util is only used for
+        the LVs that are not plain VHDs.
+
         :param vg_name: The Volumegroup where the VDIs reside
         :param lvUuidMap: map from old uuids to new uuids
+        :param old_vg_name: name of the Volumegroup before the resign
+        """
+
+        start = time.time()
+        workers = self._getIntConfig('vdi_workers', DEFAULT_VDI_WORKERS)
+        # in the order of the old uuids, the same on every run of a resign
+        old_uuids = lvUuidMap.keys()
+        old_uuids.sort()
+        lv_names = [self.LV_VHD_PREFIX + lvUuidMap[old_uuid]
+                    for old_uuid in old_uuids]
+
+        self._activateLvs(vg_name, lv_names)
+
+        def lvPath(lv_name):
+            return os.path.join(lvhdutil.VG_LOCATION, vg_name, lv_name)
+
+        def readParent(lv_name):
+            path = lvPath(lv_name)
+            util.SMlog("RESIGN VDI %s" % path)
+            vhd = self._readVhdHeader(path)
+            if vhd:
+                return vhd, vhd.getParentLvName()
+            return None, vhdutil._getVHDParentNoCheck(path)
+
+        def getParent(lv_name):
+            return self.metrics.runLv(lv_name, 'read_parent', readParent, lv_name)
+
+        # VHD parent graph, from the resigned LV names to their old and new
+        # parents. Each VHD is judged by the parent it names now: a new LV
+        # was set before the resign was interrupted, an old LV is rewritten,
+        # and any other name is an error rather than a guess.
+        vhds = {}
+        parents = []
+        new_uuids = set(lvUuidMap.values())
+        results = workerpool.runAll(resignmetrics.bind(getParent), lv_names,
+                                    workers)
+        for lv_name, (vhd, parent) in zip(lv_names, results):
+            if vhd:
+                vhds[lv_name] = vhd
+            if not parent:
+                continue
+            parent_uuid = parent[4:]  # remove the VHD-
+            if parent_uuid in new_uuids:
+                continue
+            if parent_uuid not in lvUuidMap:
+                raise xs_errors.XenError('VDIUnavailable',
+                                         opterr='%s has the parent %s, which is '
+                                                'not an LV of the VG' % (lv_name, parent))
+            parents.append((lv_name, (parent,
+                                      self.LV_VHD_PREFIX + lvUuidMap[parent_uuid])))
+
+        def escape(name):
+            # device mapper names double the dashes of VG and LV names
+            return name.replace('-', '--')
+
+        vg_replacements = [(escape(old_vg_name), escape(vg_name)),
+                           (old_vg_name, vg_name)]
+
+        def writeParent(lv_name, old_parent_lv_name, parent_lv_name):
+            parent_path = lvPath(parent_lv_name)
+            util.SMlog("RESIGN VDI HAS PARENT  %s" % parent_path)
+
+            vhd = vhds.get(lv_name)
+            parent_vhd = vhds.get(parent_lv_name)
+            if vhd and parent_vhd:
+                replacements = vg_replacements + \
+                    [(escape(old_parent_lv_name), escape(parent_lv_name)),
+                     (old_parent_lv_name, parent_lv_name)]
+                if self._setVhdParent(lvPath(lv_name), vhd, parent_vhd.uuid,
+                                      replacements, parent_lv_name):
+                    return
+
+            vhdutil.setParent(lvPath(lv_name), parent_path, False)
+
+        def setParent(item):
+            lv_name, (old_parent_lv_name, parent_lv_name) = item
+            self.metrics.runLv(lv_name, 'set_parent', writeParent, lv_name,
+                               old_parent_lv_name, parent_lv_name)
+
+        workerpool.runAll(resignmetrics.bind(setParent), parents, workers)
+
+        util.SMlog("RESIGN VDIS DONE: %d VDIs, %d parent locators rewritten "
+                   "in %.2fs with %d workers" %
+                   (len(lv_names), len(parents), time.time() - start, workers))
+
+    def _readVhdHeader(self, path):
+        """
+        Reads the VHD header of an LV
+        :param path: path of the LV
+        :return: vhdheader.VhdHeader, None if the LV is not a VHD that can be
+        handled without vhd-util
+        """
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                vhd = vhdheader.readHeader(fd)
+            finally:
+                os.close(fd)
+        except (OSError, vhdheader.VhdFormatError), e:
+            util.SMlog("Cannot read the VHD header of %s, using vhd-util: %s" %
+                       (path, e))
+            return None
+
+        resignmetrics.countIo(vhd and vhd.bytes_read or
+                              vhdheader.FOOTER_SIZE + vhdheader.HEADER_SIZE, 0)
+        return vhd
+
+    def _setVhdParent(self, path, vhd, parent_uuid, replacements, parent_lv_name):
+        """
+        Rewrites the parent of a VHD in place, see vhdheader.setParent
+        :return: True if the parent was set, False if vhd-util must be used
         """
 
-        for uuid in lvUuidMap.values():
+        try:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                bytes_read, bytes_written = vhdheader.setParent(
+                    fd, vhd, parent_uuid, replacements, parent_lv_name)
+            finally:
+                os.close(fd)
+        except (OSError, vhdheader.VhdFormatError), e:
+            util.SMlog("Cannot set the parent of %s, using vhd-util: %s" %
+                       (path, e))
+            return False
+
+        resignmetrics.countIo(bytes_read, bytes_written)
+        return True
+
+    def _activateLvs(self, vg_name, lv_names):
+        """
+        Makes LVs writable and activates them, with one lvchange call per
+        batch of LVs rather than per LV. The LVM cache is refreshed once the
+        batches ran, and the LVs that could not be changed in bulk are
+        changed one at a time through it.
+        :param vg_name: VG of the LVs
+        :param lv_names: names of the LVs
+        """
 
-            lv_name = self.LV_VHD_PREFIX + uuid
+        failed = []
+        for batch in self._lvBatches(lv_names):
+            try:
+                # the permission is changed first, so the LVs are activated
+                # writable and need no refresh
+                paths = self._lvPaths(vg_name, batch)
+                util.pread2([CMD_LVCHANGE, '-prw'] + paths)
+                util.pread2([CMD_LVCHANGE, '-ay'] + paths)
+            except util.CommandException, e:
+                util.SMlog("Bulk activation failed, activating LVs one at "
+                           "a time: %s" % e)
+                failed.extend(batch)
+
+        if lv_names:
+            self.lvmCache.refresh()
+        for lv_name in failed:
             self.lvmCache.activateNoRefcount(lv_name)
             self.lvmCache.setReadonly(lv_name, False)
 
-            path = os.path.join(lvhdutil.VG_LOCATION, vg_name, lv_name)
-            util.SMlog("RESIGN VDI %s" % path)
-            old_parent = vhdutil._getVHDParentNoCheck(path)
+    def _deactivateLvs(self, vg_name, lv_names):
+        """
+        Deactivates LVs with one lvchange call per batch of LVs. The LVM cache
+        is refreshed once the batches ran, and the LVs that could not be
+        deactivated in bulk are deactivated one at a time through it.
+        :param vg_name: VG of the LVs
+        :param lv_names: names of the LVs
+        """
+
+        failed = []
+        for batch in self._lvBatches(lv_names):
+            try:
+                util.pread2([CMD_LVCHANGE, '-an'] + self._lvPaths(vg_name, batch))
+            except util.CommandException, e:
+                util.SMlog("Bulk deactivation failed, deactivating LVs one "
+                           "at a time: %s" % e)
+                failed.extend(batch)
+
+        if lv_names:
+            self.lvmCache.refresh()
+        for lv_name in failed:
+            self.lvmCache.deactivateNoRefcount(lv_name)
+
+    def _lvPaths(self, vg_name, lv_names):
+        """
+        :return: the LVs in the vg/lv form accepted by lvchange
+        """
+
+        return ['%s/%s' % (vg_name, lv_name) for lv_name in lv_names]
+
+    def _lvBatches(self, lv_names):
+        """
+        :return: list of batches of at most LV_BATCH_SIZE LV names
+        """
+
+        return [lv_names[i:i + LV_BATCH_SIZE]
+                for i in range(0, len(lv_names), LV_BATCH_SIZE)]
+
+    def _startMetrics(self, sr_uuid, device):
+        """
+        Starts recording the metrics of a resign run by the calling thread
+        :param sr_uuid: new uuid of the SR
+        :param device: device of the LUN
+        :return: resignmetrics.ResignMetrics
+        """
+
+        resignmetrics.install()
+        self.metrics = resignmetrics.ResignMetrics(sr_uuid, device)
+        resignmetrics.activate(self.metrics)
+        return self.metrics
+
+    def _finishMetrics(self, metrics, outcome=None, error=None):
+        """
+        Writes the metrics of a resign to the metrics file
+        :param outcome: RESIGN_DONE, RESIGN_RESUMED or RESIGN_UNCHANGED
+        :param error: exception which ended the resign, None if it succeeded
+        """
+
+        resignmetrics.activate(None)
+        metrics.finish()
+        path = self.dconf.get('metrics_file') or DEFAULT_METRICS_FILE
+        try:
+            metrics.write(path, outcome, error)
+        except (IOError, OSError), e:
+            util.SMlog("Cannot write the resign metrics to %s: %s" % (path, e))
+
+    def _getBoolConfig(self, key):
+        """
+        :param key: device-config key
+        :return: True if the key is set to true
+        """
 
-            if old_parent:
+        return self.dconf.get(key, '').lower() == 'true'
 
-                old_parent_uuid = old_parent[4:]  # remove the VHD-
-                new_parent_uuid = lvUuidMap[old_parent_uuid]
+    def _getIntConfig(self, key, default):
+        """
+        Reads a positive integer from the device config
+        :param key: device-config key
+        :param default: value used when the key is not set
+        """
+
+        if not self.dconf.get(key):
+            return default
 
-                parent_lv_name = self.LV_VHD_PREFIX + new_parent_uuid
-                self.lvmCache.activateNoRefcount(parent_lv_name)
+        try:
+            value = int(self.dconf[key])
+        except ValueError:
+            value = 0
 
-                parent_path = os.path.join(lvhdutil.VG_LOCATION, vg_name, parent_lv_name)
+        if value < 1:
+            raise xs_errors.XenError('InvalidArg',
+                                     opterr='%s must be a positive integer' % key)
+        return value
 
-                util.SMlog("RESIGN VDI HAS PARENT  %s" % parent_path)
-                vhdutil.setParent(path, parent_path, False)
+    def _lvmDeviceFilter(self, device):
+        """
+        LUNs cloned from the same SR hold VGs with the same name, so the LVM
+        tools reading the VG of a LUN are restricted to its device
+        :param device: device of the LUN
+        :return: arguments of the LVM command
+        """
 
+        return ['--config', 'devices { filter = [ "a|^%s$|", "r|.*|" ] }' %
+                os.path.realpath(device)]
 
     def _getVgName(self, lvm_device):
         """
@@ -326,7 +1492,8 @@ class ReLVHDoISCSISR(LVHDoISCSISR.LVHDoISCSISR):
 
         # get VG name from pvdisplay
         util.SMlog("Reading metadata from device:%s" % lvm_device)
-        stdout = util.pread2([CMD_PVDISPLAY, lvm_device])
+        stdout = util.pread2([CMD_PVDISPLAY] + self._lvmDeviceFilter(lvm_device) +
+                             [lvm_device])
 
         assert stdout, "pvdisplay: Could not find device"
 
@@ -18,20 +18,29 @@
 # VDI-per-LUN SR implementation
 #
 import os
+import time
 import SR, VDI, SRCommand, util
 import lvhdutil
 import vhdutil
+import devwait
 import iscsilib
+import iscsiindex
+import iscsisessions
+import iscsistate
+import srindex
+import workerpool
 import xs_errors
 import xml.dom.minidom
 from lock import Lock
 import sys
 
+DEFAULT_SCAN_WORKERS = 16
+
 CAPABILITIES = ["SR_PROBE", "VDI_CREATE", "VDI_DELETE", "VDI_ATTACH",
                 "VDI_DETACH", "VDI_RESIZE", "VDI_INTRODUCE"]
 
 CONFIGURATION = [['target', 'IP address or hostname of the iSCSI target (required)'], \
-                 ['targetIQNs', 'The list of target IQNs to add as VDIs (optional)'], \
+                 ['targetIQNs', 'Comma separated target IQNs whose LUN0 is introduced as a VDI by sr-scan, * for every target of the portal (optional)'], \
                  ['chapuser', 'The username to be used during CHAP authentication (optional)'], \
                  ['chappassword', 'The password to be used during CHAP authentication (optional)'], \
                  ['incoming_chapuser',
@@ -42,6 +51,10 @@ CONFIGURATION = [['target', 'IP address or hostname of the iSCSI target (require
                  ['multihomed',
                   'Enable multi-homing to this target, true or false (optional, defaults to same value as host.other_config:multipathing)'],
                  ['force_tapdisk', 'Force use of tapdisk, true or false (optional, defaults to false)'],
+                 ['session_grace',
+                  'Seconds an unused iSCSI session stays logged in, 0 logs out at once (optional, defaults to %d)' % iscsisessions.DEFAULT_GRACE],
+                 ['scan_workers',
+                  'Number of LUNs probed concurrently by sr-scan (optional, defaults to %d)' % DEFAULT_SCAN_WORKERS],
                  ]
 
 DRIVER_INFO = {
@@ -71,16 +84,17 @@ def log(message):
     pass
     # util.SMlog("#"* 40 + str(message) + "#"*20)
 
-def _checkTGT(tgtIQN, tgt=''):
-    if not is_iscsi_daemon_running():
-        return False
-    iscsi_path = "/dev/iscsi/" + tgtIQN
-    return os.path.isdir(iscsi_path)
+def is_vhd(path):
+    """ Reads first 8 bytes of the path and checks for the cookie """
+
+    fd = open(path)
+    cookie = fd.read(8)
+    fd.close()
+
+    if cookie == VHD_COOKIE:
+        return True
 
-def is_iscsi_daemon_running():
-    cmd = ["/sbin/pidof", "-s", "/sbin/iscsid"]
-    (rc,stdout,stderr) = util.doexec(cmd)
-    return (rc==0)
+    return False
 
 def iscsi_login(portal, target, username, password, username_in="", password_in="",
           multipath=False):
@@ -91,29 +105,12 @@ def iscsi_login(portal, target, username, password, username_in="", password_in=
     failuremessage = "Failed to login to target."
     try:
         (stdout,stderr) = iscsilib.exn_on_failure(cmd,failuremessage)
-        if not iscsilib.wait_for_devs(target, portal):
+        if not devwait.waitForPath(
+                os.path.join(iscsiindex.DEV_DIR, target, portal), MAX_TIMEOUT):
             raise xs_errors.XenError('ISCSILogin')
     except:
         raise xs_errors.XenError('ISCSILogin')
 
-def create_iscsi_record(portal, port, target):
-    portal_str = "%s:%s" % (portal, port)
-    cmd = ["iscsiadm", "-m", "node", "-p", portal_str, "-T", target, "-o",  "new"]
-    failuremessage = "Unable to create an iSCSI record %s:%s" %  (target, portal)
-    try:
-        (stdout,stderr) = iscsilib.exn_on_failure(cmd,failuremessage)
-    except:
-        raise xs_errors.XenError('ISCSILogin')
-
-def delete_iscsi_record(portal, port, target):
-    portal_str = "%s:%s" % (portal, port)
-    cmd = ["iscsiadm", "-m", "node", "-p", portal_str, "-T", target, "-o", "delete"]
-    failuremessage = "Unable to delete an iSCSI record %s:%s" %  (target, portal)
-    try:
-        (stdout,stderr) = iscsilib.exn_on_failure(cmd,failuremessage)
-    except:
-        raise xs_errors.XenError('ISCSILogout')
-
 
 class VDILUNSR(SR.SR):
     """VHDoISCSI storage repository"""
@@ -182,6 +179,13 @@ class VDILUNSR(SR.SR):
         self.lock = Lock(vhdutil.LOCK_TYPE_SR, self.uuid)
         self.uuid = sr_uuid
 
+        grace = self._getIntConfig('session_grace',
+                                   iscsisessions.DEFAULT_GRACE, 0)
+        self.sessions = iscsisessions.SessionPool(grace)
+        self.srIndex = srindex.SrIndex()
+        # records of the VDIs of the SR, by uuid, once read by a scan
+        self.xapi_vdis = None
+
         self.sm_config = self.session.xenapi.SR.get_sm_config(self.sr_ref)
         self.physical_utilisation = 0
         self.physical_size = MAXINT
@@ -210,50 +214,183 @@ class VDILUNSR(SR.SR):
             raise xs_errors.XenError('LVMMaster')
 
         # Check if this storage node is already being used
-        SRs = self.session.xenapi.SR.get_all_records()
-        for sr in SRs:
-            record = SRs[sr]
-            log(record)
-            sm_config = record["sm_config"]
-            if sm_config.has_key('target') and \
-               sm_config['target'] == self.target and \
-                    record['type'] == SR_TYPE_VDILUN:
-                raise xs_errors.XenError('SRInUse')
+        if self._findSr(self.target) is not None:
+            raise xs_errors.XenError('SRInUse')
 
         self.sm_config['datatype'] = 'ISCSI'
         self.sm_config['target'] = self.target
         self.session.xenapi.SR.set_sm_config(self.sr_ref, self.sm_config)
+        self.srIndex.update({self.target: sr_uuid})
 
     def delete(self, sr_uuid):
         # Should logout of all the LUNS?
         if not self.isMaster:
             raise xs_errors.XenError('LVMMaster')
         self.detach(sr_uuid)
+        self.srIndex.remove(self.target, sr_uuid)
 
     def probe(self):
         log("vdilunsr probe")
-        SRs = self.session.xenapi.SR.get_all_records()
         Rec = {}
-        for sr in SRs:
-            record = SRs[sr]
-            sm_config = record["sm_config"]
+        found = self._findSr(self.target)
+        if found is not None:
+            record = found[1]
+            Rec[record["uuid"]] = record["sm_config"]
 
+        return self.srlist_toxml(Rec)
 
-            if sm_config.has_key('target') and \
-                            sm_config['target'] == self.target and \
-                            record['type'] == SR_TYPE_VDILUN:
-                Rec[record["uuid"]] = sm_config
-                break
+    def _findSr(self, target):
+        """
+        Finds the SR of a target from the index, or else from the records of
+        the VDILUNSR SRs only, which are then indexed
+        :return: (ref, record) of the SR, None if the target has none
+        """
 
-        return self.srlist_toxml(Rec)
+        sr_uuid = self.srIndex.lookup(target)
+        if sr_uuid:
+            try:
+                sr_ref = self.session.xenapi.SR.get_by_uuid(sr_uuid)
+                record = self.session.xenapi.SR.get_record(sr_ref)
+            except:
+                # forgotten by XAPI
+                record = None
+            if record and record['type'] == SR_TYPE_VDILUN and \
+                    record['sm_config'].get('target') == target:
+                return sr_ref, record
+            self.srIndex.remove(target, sr_uuid)
+
+        SRs = self.session.xenapi.SR.get_all_records_where(
+            'field "type" = "%s"' % SR_TYPE_VDILUN)
+        found = None
+        entries = {}
+        for sr_ref, record in SRs.items():
+            sr_target = record['sm_config'].get('target')
+            if sr_target:
+                entries[sr_target] = record['uuid']
+                if sr_target == target:
+                    found = sr_ref, record
+        self.srIndex.update(entries)
+        return found
 
 
     def scan(self, sr_uuid):
         self.physical_size = MAXINT
         self.physical_utilisation = 0
+        if self.dconf.get('targetIQNs'):
+            self._introduceTargets()
         self._db_update()
         log("vdilunsr scan UUID:%s" % sr_uuid)
 
+    def _introduceTargets(self):
+        """
+        Introduces the LUN0 of the targets of targetIQNs which have no VDI
+        yet. One sendtargets discovery lists the targets of the portal, the
+        LUNs of the new ones are probed by scan_workers threads, then the
+        LUNs holding a VHD are introduced together, with a single update of
+        the SR.
+        """
+
+        start = time.time()
+        wanted = [iqn.strip() for iqn in self.dconf['targetIQNs'].split(',')
+                  if iqn.strip()]
+        workers = self._getIntConfig('scan_workers', DEFAULT_SCAN_WORKERS)
+        portal = "%s:%s" % (self.target, self.port)
+
+        try:
+            targets = iscsilib.discovery(self.target, self.port,
+                                         self.dconf.get('chapuser', ''),
+                                         self.dconf.get('chappassword', ''))
+        except:
+            util.logException("VDILUN_SCAN")
+            raise xs_errors.XenError('ISCSIDiscovery')
+
+        iqns = []
+        for _portal, _tpgt, iqn in targets:
+            if iqn not in iqns and ('*' in wanted or iqn in wanted):
+                iqns.append(iqn)
+
+        records = self.session.xenapi.VDI.get_all_records_where(
+            'field "SR" = "%s"' % self.sr_ref)
+        self.xapi_vdis = dict([(record['uuid'], record)
+                               for record in records.values()])
+        known = set([record['location'] for record in records.values()])
+        new_iqns = [iqn for iqn in iqns if iqn not in known]
+
+        # the probes log out as soon as they are done, the LUNs are not
+        # attached until VMs use them
+        probe_sessions = iscsisessions.SessionPool(0, index=self.sessions.index)
+        probe_sessions.index.rebuild()
+        luns = []
+        for result in workerpool.run(
+                lambda iqn: self._probeLun(probe_sessions, portal, iqn),
+                new_iqns, workers):
+            if result.error:
+                util.SMlog("Probe of %s failed: %s" % (result.item, result.error[1]))
+            elif result.value is None:
+                util.SMlog("LUN of %s holds no VHD, skipped" % result.item)
+            else:
+                luns.append((result.item, result.value))
+
+        for iqn, size in luns:
+            vdi = self.vdi(util.gen_uuid())
+            vdi.iqn = vdi.location = vdi.label = iqn
+            vdi.size = vdi.utilisation = size
+            vdi.ref = vdi._db_introduce()
+            self.vdis[vdi.uuid] = vdi
+
+        util.SMlog("VDILUN SCAN: %d targets, %d new, %d VDIs introduced in "
+                   "%.2fs with %d workers" % (len(iqns), len(new_iqns),
+                                              len(luns), time.time() - start,
+                                              workers))
+
+    def _probeLun(self, sessions, portal, iqn):
+        """
+        :param sessions: SessionPool holding the session during the probe
+        :return: virtual size of the VHD on the LUN0 of a target, None if the
+        LUN holds no VHD
+        """
+
+        def login():
+            # the CHAP credentials of the discovery
+            iscsi_login(portal, iqn, self.dconf.get('chapuser', ''),
+                        self.dconf.get('chappassword', ''),
+                        self.dconf.get('incoming_chapuser', ''),
+                        self.dconf.get('incoming_chappassword', ''))
+            return iscsiindex.lunPath(portal, iqn)
+
+        holder = 'scan-%s' % self.uuid
+        path = sessions.acquire(portal, iqn, holder, login, os.getpid())
+        try:
+            if not devwait.waitForPath(path, MAX_TIMEOUT):
+                raise xs_errors.XenError('VDIUnavailable')
+            if not is_vhd(path):
+                return None
+            return vhdutil.getSizeVirt(path)
+        finally:
+            sessions.release(portal, iqn, holder)
+
+    def _getIntConfig(self, key, default, minimum=1):
+        """
+        Reads an integer from the device config
+        :param key: device-config key
+        :param default: value used when the key is not set
+        :param minimum: smallest valid value
+        """
+
+        if not self.dconf.get(key):
+            return default
+
+        try:
+            value = int(self.dconf[key])
+        except ValueError:
+            value = minimum - 1
+
+        if value < minimum:
+            raise xs_errors.XenError('InvalidArg',
+                                     opterr='%s must be an integer of at least '
+                                            '%d' % (key, minimum))
+        return value
+
     def refresh(self, sr_uuid):
         log("vdilunsr refresh UUID:%s" % sr_uuid)
 
@@ -325,6 +462,7 @@ class VDILUN(VDI.VDI):
         self.iqn = self.location
         self.target = self.sr.target
         self.port = self.sr.port
+        self.portal = "%s:%s" % (self.target, self.port)
         self.exists = False
         self.vdi_type = vhdutil.VDI_TYPE_VHD
 
@@ -337,13 +475,13 @@ class VDILUN(VDI.VDI):
         log("Calling VDI introduce")
 
         self.attach(sr_uuid, vdi_uuid)
+        try:
+            if not self.vdiExists(self.path):
+                raise xs_errors.XenError("VDIMissing")
 
-        if not self.vdiExists(self.path):
+            self.size = vhdutil.getSizeVirt(self.path)
+        finally:
             self.detach(sr_uuid, vdi_uuid)
-            raise xs_errors.XenError("VDIMissing")
-
-        self.size = vhdutil.getSizeVirt(self.path)
-        self.detach(sr_uuid, vdi_uuid)
         self.introduce_vdi(vdi_uuid)
 
         return VDI.VDI.get_params(self)
@@ -354,12 +492,14 @@ class VDILUN(VDI.VDI):
         self.size = self.validate_size(size)
 
         self.attach(sr_uuid, vdi_uuid)
-        # Create the VHD on the LUN
-        vhdutil.create(self.path, long(self.size), False, lvhdutil.MSIZE_MB)
-        self.introduce_vdi(vdi_uuid)
-
-        # This is done on the master, ideally, detach it
-        self.detach(sr_uuid, vdi_uuid)
+        try:
+            # Create the VHD on the LUN
+            vhdutil.create(self.path, long(self.size), False, lvhdutil.MSIZE_MB)
+            self.introduce_vdi(vdi_uuid)
+        finally:
+            # This is done on the master, ideally, detach it. The session
+            # stays logged in for the attach which usually follows.
+            self.detach(sr_uuid, vdi_uuid)
 
         return VDI.VDI.get_params(self)
 
@@ -368,22 +508,33 @@ class VDILUN(VDI.VDI):
         if not self.sr.vdis.has_key(vdi_uuid):
             raise xs_errors.XenError('VDIUnavailable')
 
-        if _checkTGT(self.iqn):
+        if self._inUse():
+            raise xs_errors.XenError('VDIInUse')
+
+        # the LUN goes away with the VDI, so do its session and node record
+        try:
+            forgotten = self.sr.sessions.forget(self.portal, self.iqn)
+        except:
+            util.logException("VDI_DELETE")
+            raise xs_errors.XenError('ISCSILogout')
+        if not forgotten:
             raise xs_errors.XenError('VDIInUse')
 
         self._db_forget()
         self.sr._updateStats(self.sr.uuid, -self.size)
 
     def attach(self, sr_uuid, vdi_uuid):
-        # Does the iscsi login
+        # Holds the iscsi session, logging in if the host has none
         self.iqn = self.validate_iqn()
-        self.path = self.login_target()
+        self.path = self.sr.sessions.acquire(self.portal, self.iqn, vdi_uuid,
+                                             self.login_target)
 
         log("IQN")
         log(self.iqn)
 
-        if not util.wait_for_path(self.path, MAX_TIMEOUT):
+        if not devwait.waitForPath(self.path, MAX_TIMEOUT):
             util.SMlog("Unable to detect LUN attached to host [%s]" % self.sr.path)
+            self.sr.sessions.release(self.portal, self.iqn, vdi_uuid)
             raise xs_errors.XenError('VDIUnavailable')
 
         ret = super(VDILUN, self).attach(sr_uuid, vdi_uuid)
@@ -391,11 +542,13 @@ class VDILUN(VDI.VDI):
         return ret
 
     def detach(self, sr_uuid, vdi_uuid):
-        # Does iscsi logout
+        # Releases the iscsi session, which is logged out once unused
         log("Calling VDI DETACH")
-        portal = "%s:%s" % (self.target, self.port)
-        iscsilib.logout(portal, self.iqn)
-        delete_iscsi_record(self.target, self.port, self.iqn)
+        try:
+            self.sr.sessions.release(self.portal, self.iqn, vdi_uuid)
+        except:
+            util.logException("VDI_DETACH")
+            raise xs_errors.XenError('ISCSILogout')
         self.attached = False
 
     def resize(self, sr_uuid, vdi_uuid, size):
@@ -420,13 +573,15 @@ class VDILUN(VDI.VDI):
         size = util.roundup(self.VHD_SIZE_INC, size)
         old_size = self.size
 
-        if _checkTGT(self.iqn):
+        if self._inUse():
             raise xs_errors.XenError('VDIInUse')
 
         self.attach(sr_uuid, vdi_uuid)
-
-        vhdutil.setSizeVirtFast(self.path, size)
-        self.size = vhdutil.getSizeVirt(self.path)
+        try:
+            vhdutil.setSizeVirtFast(self.path, size)
+            self.size = vhdutil.getSizeVirt(self.path)
+        finally:
+            self.detach(sr_uuid, vdi_uuid)
         self.utilisation = self.size
 
         vdi_ref = self.sr.srcmd.params['vdi_ref']
@@ -434,8 +589,6 @@ class VDILUN(VDI.VDI):
         self.session.xenapi.VDI.set_physical_utilisation(vdi_ref, str(self.size))
         self.sr._updateStats(self.sr.uuid, self.size - old_size)
 
-        self.detach(sr_uuid, vdi_uuid)
-
         return VDI.VDI.get_params(self)
 
     def introduce_vdi(self, vdi_uuid):
@@ -469,31 +622,40 @@ class VDILUN(VDI.VDI):
         if not iqn:
             raise xs_errors.XenError('ConfigTargetIQNMissing')
 
-        # check if LUN is reachable
-        create_iscsi_record(self.target, self.port, iqn)
-
         return iqn
 
     def login_target(self):
-        portal = "%s:%s" % (self.target, self.port)
-        iscsi_login(portal, self.iqn, self.chapuser, self.chappass)
+        # check if LUN is reachable, the session pool creates the node record
+        iscsi_login(self.portal, self.iqn, self.chapuser, self.chappass)
         # TODO CHap
-        path = os.path.join("/dev/iscsi", self.iqn, portal, "LUN0")
-        return path
+        return iscsiindex.lunPath(self.portal, self.iqn)
 
-    def vdiExists(self, vdi_path):
-        """ Reads first 8 bytes of the path and checks for the cookie """
-
-        fd = open(vdi_path)
-        cookie = fd.read(8)
-        fd.close()
+    def _inUse(self):
+        """
+        :return: True if the LUN is held by an attached VDI or an SM
+        operation, or open on the host outside of the session pool
+        """
 
-        if cookie == VHD_COOKIE:
+        if self.sr.sessions.holders(self.portal, self.iqn):
             return True
 
+        state = iscsistate.lunState(self.portal, self.iqn)
+        if state.inUse():
+            util.SMlog("LUN of %s is in use: devices %s, holders %s, "
+                       "tapdisks %s, VBDs %s" % (self.iqn, state.devices,
+                                                 state.holders,
+                                                 state.tapdisks, state.vbds))
+            return True
         return False
 
+    def vdiExists(self, vdi_path):
+        return is_vhd(vdi_path)
+
     def _get_vdi_from_xapi(self, vdi_uuid):
+        if self.sr.xapi_vdis is not None:
+            # the SR read the records of all its VDIs, a missing one is new
+            return self.sr.xapi_vdis.get(vdi_uuid, {})
+
         vdi = {}
         try:
             vdi_ref = self.sr.session.xenapi.VDI.get_by_uuid(vdi_uuid)
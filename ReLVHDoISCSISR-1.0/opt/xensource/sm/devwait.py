@@ -0,0 +1,268 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Waits for device paths to appear, such as the links udev makes under
+# /dev/iscsi for the LUNs of a session. inotify wakes the waiter as soon as
+# a path appears; where inotify is not available the paths are polled.
+#
+
+import os
+import time
+import errno
+import fcntl
+import select
+import struct
+import threading
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR
+
+# struct inotify_event, followed by a name of len bytes
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+READ_SIZE = 64 * 1024
+
+# seconds between the polls where inotify is not available
+POLL_INTERVAL = 0.1
+# seconds between the checks of every path waited for with inotify, for
+# the changes no watch sees
+RECHECK_INTERVAL = 1.0
+
+_libc = None
+
+# inotify instances not in use, kept open for the life of the process:
+# closing one waits for the kernel to free its watches
+_idle = []
+_idleLock = threading.Lock()
+
+
+def _inotifyInit():
+    """
+    :return: file descriptor of a new non-blocking inotify instance, None if
+    the kernel or python cannot create one, or the instances of the user are
+    used up
+    """
+
+    global _libc
+
+    if ctypes is None:
+        return None
+
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(None)
+        # inotify_init1 is missing from older C libraries
+        fd = _libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return fd
+
+
+def _watchedDir(path):
+    """
+    :return: directory in which a missing path, or the next missing
+    directory on the way to it, will appear. For a link to a device not
+    created yet, the directory of the device.
+    """
+
+    if os.path.lexists(path):
+        return os.path.dirname(os.path.realpath(path))
+    parent = os.path.dirname(path)
+    while not os.path.isdir(parent) and parent != os.path.dirname(parent):
+        parent = os.path.dirname(parent)
+    return parent
+
+
+class _Watcher(object):
+    """ The inotify watches of the paths waited for, one per directory """
+
+    def __init__(self, fd):
+        self.fd = fd
+        # a forked process must not share the instance of its parent
+        self.pid = os.getpid()
+        # directory -> watch descriptor
+        self.dirs = {}
+        # watch descriptor -> paths waiting on it
+        self.paths = {}
+
+    def watch(self, path):
+        """
+        Watches a path until it exists. The path is checked again once its
+        directory is watched, as it may have appeared before.
+        :return: True if the path exists
+        """
+
+        directory = None
+        while not os.path.exists(path):
+            current = _watchedDir(path)
+            if current == directory:
+                return False
+            directory = current
+
+            wd = self.dirs.get(directory)
+            if wd is None:
+                wd = _libc.inotify_add_watch(self.fd, directory,
+                                             ctypes.c_uint32(WATCH_MASK))
+                if wd < 0:
+                    # removed meanwhile, left to the next check
+                    continue
+                self.dirs[directory] = wd
+            self.paths.setdefault(wd, set()).add(path)
+        return True
+
+    def read(self):
+        """
+        Reads the pending events
+        :return: set of the paths watched in the directories which changed
+        """
+
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+
+            offset = 0
+            while offset + EVENT_SIZE <= len(data):
+                wd, mask, _cookie, length = struct.unpack(
+                    EVENT_FORMAT, data[offset:offset + EVENT_SIZE])
+                offset += EVENT_SIZE + length
+                changed.update(self.paths.pop(wd, ()))
+                if mask & IN_IGNORED:
+                    for directory, watched in self.dirs.items():
+                        if watched == wd:
+                            del self.dirs[directory]
+        return changed
+
+
+def _getWatcher():
+    """
+    :return: a _Watcher, reused when one is idle, None if no inotify
+    instance can be created
+    """
+
+    _idleLock.acquire()
+    try:
+        watcher = None
+        while _idle and watcher is None:
+            watcher = _idle.pop()
+            if watcher.pid != os.getpid():
+                watcher = None
+    finally:
+        _idleLock.release()
+
+    if watcher is None:
+        fd = _inotifyInit()
+        if fd is None:
+            return None
+        return _Watcher(fd)
+
+    # the events of the watches left by the previous wait
+    watcher.read()
+    watcher.paths = {}
+    return watcher
+
+
+def _putWatcher(watcher):
+    _idleLock.acquire()
+    try:
+        _idle.append(watcher)
+    finally:
+        _idleLock.release()
+
+
+def _pollPaths(paths, deadline):
+    pending = set(paths)
+    while True:
+        pending = set([path for path in pending if not os.path.exists(path)])
+        if not pending or time.time() >= deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+    return set(paths) - pending
+
+
+def waitForPaths(paths, timeout):
+    """
+    Waits for several paths at once
+    :param timeout: seconds to wait for all of them
+    :return: set of the paths which exist
+    """
+
+    deadline = time.time() + timeout
+    watcher = _getWatcher()
+    if watcher is None:
+        return _pollPaths(paths, deadline)
+
+    try:
+        pending = set([path for path in paths if not watcher.watch(path)])
+        recheck = time.time() + RECHECK_INTERVAL
+        while pending:
+            now = time.time()
+            if now >= deadline:
+                break
+            if now >= recheck:
+                changed = set(pending)
+                recheck = now + RECHECK_INTERVAL
+            else:
+                try:
+                    ready = select.select([watcher.fd], [], [],
+                                          min(deadline, recheck) - now)[0]
+                except select.error, e:
+                    if e[0] != errno.EINTR:
+                        raise
+                    ready = []
+                if not ready:
+                    continue
+                changed = watcher.read() & pending
+            pending -= set([path for path in changed if watcher.watch(path)])
+    finally:
+        _putWatcher(watcher)
+
+    pending = set([path for path in pending if not os.path.exists(path)])
+    return set(paths) - pending
+
+
+def waitForPath(path, timeout):
+    """
+    Waits for a path, as util.wait_for_path does without polling
+    :param timeout: seconds to wait
+    :return: True if the path exists
+    """
+
+    return path in waitForPaths([path], timeout)
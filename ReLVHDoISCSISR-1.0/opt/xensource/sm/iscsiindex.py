@@ -0,0 +1,260 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Host-local index of the iSCSI targets of VDILUNSR: whether the node record
+# of a target exists, and the session and LUN path of the targets logged in.
+# Looking a target up reads a few sysfs attributes and lists its node record
+# directory, where iscsiadm would fork. Entries are checked against sysfs and
+# the node records when read, so a stale entry is corrected, not trusted.
+# The index is under /var/run and rebuilt from the sessions of sysfs on the
+# first lookup after a boot.
+#
+
+import os
+import re
+import shutil
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import util
+
+SYSFS_DIR = '/sys/class'
+NODE_DIRS = ['/var/lib/iscsi/nodes', '/etc/iscsi/nodes']
+DEV_DIR = '/dev/iscsi'
+INDEX_DIR = '/var/run/sm/iscsi-index'
+
+_KEY_RE = re.compile(r'[^A-Za-z0-9.:,_-]')
+
+
+def targetKey(portal, iqn):
+    """
+    :return: name of the index entry, state file and lock of a target
+    """
+
+    return _KEY_RE.sub('_', '%s,%s' % (iqn, portal))
+
+
+def lunPath(portal, iqn, lun=0):
+    """
+    :return: path of a LUN of a target, linked by udev once logged in
+    """
+
+    return os.path.join(DEV_DIR, iqn, portal, 'LUN%d' % lun)
+
+
+def _readAttr(path):
+    """
+    :return: value of a sysfs attribute, None if it does not exist
+    """
+
+    try:
+        fd = open(path)
+    except IOError:
+        return None
+    try:
+        return fd.read().strip()
+    finally:
+        fd.close()
+
+
+def sessionTarget(session):
+    """
+    :param session: name of a session in sysfs, as session3
+    :return: (portal, iqn) of the session, None if it is not logged in
+    """
+
+    iqn = _readAttr(os.path.join(SYSFS_DIR, 'iscsi_session', session,
+                                 'targetname'))
+    connection = os.path.join(SYSFS_DIR, 'iscsi_connection',
+                              'connection%s:0' % session[len('session'):])
+    address = _readAttr(os.path.join(connection, 'persistent_address'))
+    port = _readAttr(os.path.join(connection, 'persistent_port'))
+    if iqn is None or address is None or port is None:
+        return None
+    return '%s:%s' % (address, port), iqn
+
+
+def listSessions():
+    """
+    :return: dict of the sessions logged in, session name by (portal, iqn)
+    """
+
+    try:
+        names = os.listdir(os.path.join(SYSFS_DIR, 'iscsi_session'))
+    except OSError:
+        return {}
+
+    sessions = {}
+    for name in names:
+        target = sessionTarget(name)
+        if target is not None:
+            sessions[target] = name
+    return sessions
+
+
+def nodeRecordExists(portal, iqn):
+    """
+    :param portal: portal of the target, as ip:port
+    :return: True if iscsiadm has a node record of the target
+    """
+
+    # records are named ip,port,tpgt in the directory of the target
+    prefix = '%s,' % ','.join(portal.rsplit(':', 1))
+    for node_dir in NODE_DIRS:
+        try:
+            names = os.listdir(os.path.join(node_dir, iqn))
+        except OSError:
+            continue
+        for name in names:
+            if name.startswith(prefix):
+                return True
+    return False
+
+
+class NodeIndex(object):
+    """ The index of the targets of the host. An entry is only changed by
+    the holder of the lock of its target. """
+
+    def __init__(self, index_dir=None):
+        """
+        :param index_dir: directory of the entries, INDEX_DIR by default
+        """
+
+        self.index_dir = index_dir or INDEX_DIR
+
+    def _path(self, key):
+        return os.path.join(self.index_dir, key)
+
+    def _read(self, key):
+        try:
+            fd = open(self._path(key))
+        except IOError:
+            return None
+        try:
+            return json.load(fd)
+        finally:
+            fd.close()
+
+    def _write(self, key, entry, index_dir=None):
+        index_dir = index_dir or self.index_dir
+        temp_path = os.path.join(index_dir, '.%s.%d' % (key, os.getpid()))
+        fd = open(temp_path, 'w')
+        try:
+            json.dump(entry, fd)
+        finally:
+            fd.close()
+        os.rename(temp_path, os.path.join(index_dir, key))
+
+    def rebuild(self):
+        """
+        Builds the index from the sessions of sysfs, unless it exists. The
+        index is built aside and renamed into place, a concurrent rebuild
+        is discarded.
+        :return: True if this call built the index
+        """
+
+        if os.path.isdir(self.index_dir):
+            return False
+
+        parent = os.path.dirname(self.index_dir)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+
+        temp_dir = '%s.%d' % (self.index_dir, os.getpid())
+        os.mkdir(temp_dir)
+        try:
+            sessions = listSessions()
+            for (portal, iqn), session in sessions.items():
+                self._write(targetKey(portal, iqn),
+                            {'portal': portal, 'iqn': iqn, 'record': True,
+                             'session': session,
+                             'path': lunPath(portal, iqn)}, temp_dir)
+            try:
+                os.rename(temp_dir, self.index_dir)
+            except OSError:
+                return False
+        finally:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir)
+
+        util.SMlog("iSCSI index rebuilt with %d sessions" % len(sessions))
+        return True
+
+    def lookup(self, portal, iqn):
+        """
+        :param portal: portal of the target, as ip:port
+        :return: entry of a target, a dict of 'record', True if its node
+        record exists, 'session', name of its session in sysfs or None, and
+        'path', path of its LUN
+        """
+
+        self.rebuild()
+        key = targetKey(portal, iqn)
+        entry = self._read(key)
+        if entry is None:
+            entry = {'portal': portal, 'iqn': iqn,
+                     'record': nodeRecordExists(portal, iqn),
+                     'session': None, 'path': lunPath(portal, iqn)}
+            self._write(key, entry)
+            return entry
+
+        stale = False
+        if entry['session'] and \
+                sessionTarget(entry['session']) != (portal, iqn):
+            entry['session'] = None
+            stale = True
+        if entry['record'] and not nodeRecordExists(portal, iqn):
+            entry['record'] = False
+            stale = True
+        if stale:
+            util.SMlog("iSCSI index entry %s was stale" % key)
+            self._write(key, entry)
+        return entry
+
+    def update(self, portal, iqn, **fields):
+        """
+        Changes fields of the entry of a target
+        :return: the entry
+        """
+
+        entry = self.lookup(portal, iqn)
+        entry.update(fields)
+        self._write(targetKey(portal, iqn), entry)
+        return entry
+
+    def findSession(self, portal, iqn):
+        """
+        Records the session of a target just logged in
+        :return: name of the session, None if sysfs has none
+        """
+
+        session = listSessions().get((portal, iqn))
+        self.update(portal, iqn, record=True, session=session)
+        return session
+
+    def remove(self, portal, iqn):
+        try:
+            os.remove(self._path(targetKey(portal, iqn)))
+        except OSError:
+            pass
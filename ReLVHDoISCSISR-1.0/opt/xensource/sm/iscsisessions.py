@@ -0,0 +1,392 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Host-local pool of the iSCSI sessions of VDILUNSR. A session is held by the
+# VDIs attached through it and by the SM operations using it, and their names
+# are kept in a state file per session under /var/run, changed under a lock
+# so that every SM process sees the same holders. An SM operation holds a
+# session for as long as its process lives, the hold of a process that died
+# is dropped the next time the state is read. A session is logged in by
+# its first holder. Once it has no holders left it stays logged in for a
+# grace period, then a reaper process logs it out unless it was held again.
+# The node record of a target is kept after the logout, for the next login,
+# and deleted with its LUN.
+#
+
+import os
+import errno
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import util
+import iscsilib
+import iscsiindex
+import iscsistate
+import workerpool
+from lock import Lock
+
+SESSION_DIR = '/var/run/sm/iscsi-sessions'
+LOCK_NS = 'iscsi-session'
+# seconds a session without holders stays logged in
+DEFAULT_GRACE = 60
+
+
+def createRecord(portal, iqn):
+    """
+    Creates the node record of a target
+    :param portal: portal of the target, as ip:port
+    """
+
+    cmd = ["iscsiadm", "-m", "node", "-p", portal, "-T", iqn, "-o", "new"]
+    iscsilib.exn_on_failure(cmd, "Unable to create an iSCSI record %s:%s" %
+                            (iqn, portal))
+
+
+def deleteRecord(portal, iqn):
+    """
+    Deletes the node record of a target
+    :param portal: portal of the target, as ip:port
+    """
+
+    cmd = ["iscsiadm", "-m", "node", "-p", portal, "-T", iqn, "-o", "delete"]
+    iscsilib.exn_on_failure(cmd, "Unable to delete an iSCSI record %s:%s" %
+                            (iqn, portal))
+
+
+def _daemonize():
+    """
+    Forks a process detached from the SM command: it holds none of its
+    descriptors, so neither its output nor its locks
+    :return: True in the detached process, False in the caller
+    """
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return False
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        for fd in range(3, os.sysconf('SC_OPEN_MAX')):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+    except:
+        os._exit(1)
+    return True
+
+
+def _processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class SessionPool(object):
+    """ The sessions of the host, shared by the SM processes """
+
+    def __init__(self, grace=DEFAULT_GRACE, state_dir=None, index=None):
+        """
+        :param grace: seconds a session without holders stays logged in, 0
+        logs it out with its last holder
+        :param state_dir: directory of the state files, SESSION_DIR by
+        default
+        :param index: NodeIndex of the host
+        """
+
+        self.grace = grace
+        self.state_dir = state_dir or SESSION_DIR
+        self.index = index or iscsiindex.NodeIndex()
+
+    def _path(self, key):
+        return os.path.join(self.state_dir, key)
+
+    def _read(self, key):
+        """
+        :return: state of a session, None if it is not logged in. The holders
+        whose process died are left out.
+        """
+
+        try:
+            fd = open(self._path(key))
+        except IOError:
+            return None
+        try:
+            state = json.load(fd)
+        finally:
+            fd.close()
+
+        holders = state['holders']
+        for holder, hold in holders.items():
+            # the holds written before the pid was kept have none
+            if isinstance(hold, dict) and hold['pid'] and \
+                    not _processAlive(hold['pid']):
+                util.SMlog("iSCSI session %s: holder %s dropped, process %d "
+                           "is gone" % (key, holder, hold['pid']))
+                del holders[holder]
+        return state
+
+    def _write(self, key, state):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        temp_path = self._path('.%s.%d' % (key, os.getpid()))
+        fd = open(temp_path, 'w')
+        try:
+            json.dump(state, fd)
+        finally:
+            fd.close()
+        os.rename(temp_path, self._path(key))
+
+    def holders(self, portal, iqn):
+        """
+        :return: names of the holders of a session, None if the pool has no
+        session to the target
+        """
+
+        state = self._read(iscsiindex.targetKey(portal, iqn))
+        if state is None:
+            return None
+        return state['holders'].keys()
+
+    def acquire(self, portal, iqn, holder, login, pid=None):
+        """
+        Holds the session to a target, logging in if there is none
+        :param portal: portal of the target, as ip:port
+        :param holder: name of the holder, a holder holds a session once
+        :param login: function logging in to the target, returning the path
+        of its LUN
+        :param pid: process the hold ends with, None for a hold kept until it
+        is released, as the attach of a VDI
+        :return: path of the LUN
+        """
+
+        key = iscsiindex.targetKey(portal, iqn)
+        lock = Lock(key, LOCK_NS)
+        lock.acquire()
+        try:
+            state = self._read(key)
+            if not self._alive(portal, iqn, state):
+                state = {'portal': portal, 'iqn': iqn, 'holders': {},
+                         'generation': 0,
+                         'path': self._login(key, portal, iqn, login)}
+            state['holders'][holder] = {'time': time.time(), 'pid': pid}
+            state['generation'] += 1
+            self._write(key, state)
+            return str(state['path'])
+        finally:
+            lock.release()
+
+    def release(self, portal, iqn, holder):
+        """
+        Releases the session to a target. The last holder leaves it to the
+        reaper, or logs it out if there is no grace period.
+        """
+
+        key = iscsiindex.targetKey(portal, iqn)
+        lock = Lock(key, LOCK_NS)
+        lock.acquire()
+        try:
+            state = self._read(key)
+            if state is None:
+                return
+            state['holders'].pop(holder, None)
+            if not state['holders'] and self.grace <= 0:
+                self._logout(key, state)
+                return
+            state['generation'] += 1
+            self._write(key, state)
+            if state['holders']:
+                return
+        finally:
+            lock.release()
+
+        util.SMlog("iSCSI session %s idle, logout in %ds" % (key, self.grace))
+        self._startReaper([((portal, iqn), state['generation'])])
+
+    def prepare(self, targets, login, workers):
+        """
+        Logs in to targets concurrently, ahead of the attach of their VDIs.
+        The sessions are left without holders, and a single reaper logs out
+        of those still not held once the grace period is over.
+        :param targets: list of (portal, iqn)
+        :param login: function logging in to a target, called with its
+        portal and IQN, returning the path of its LUN
+        :param workers: maximum number of concurrent logins
+        :return: list of WorkResult of the targets, valued with the path of
+        their LUN
+        """
+
+        def prepareTarget(target):
+            portal, iqn = target
+            key = iscsiindex.targetKey(portal, iqn)
+            lock = Lock(key, LOCK_NS)
+            lock.acquire()
+            try:
+                state = self._read(key)
+                if not self._alive(portal, iqn, state):
+                    state = {'portal': portal, 'iqn': iqn, 'holders': {},
+                             'generation': 0,
+                             'path': self._login(key, portal, iqn,
+                                                 lambda: login(portal, iqn))}
+                elif state['holders']:
+                    return str(state['path']), None
+                # the reaper of an earlier release would not wait for the
+                # attach
+                state['generation'] += 1
+                self._write(key, state)
+                return str(state['path']), state['generation']
+            finally:
+                lock.release()
+
+        # the index is rebuilt once, before the threads use it
+        self.index.rebuild()
+        results = workerpool.run(prepareTarget, targets, workers)
+
+        idle = []
+        for result in results:
+            if not result.error:
+                result.value, generation = result.value
+                if generation is not None:
+                    idle.append((result.item, generation))
+        if idle:
+            util.SMlog("%d iSCSI sessions prepared, logout in %ds unless "
+                       "attached" % (len(idle), self.grace))
+            self._startReaper(idle)
+        return results
+
+    def _startReaper(self, sessions):
+        """
+        Starts a process logging out of sessions once the grace period is
+        over, see reap
+        :param sessions: list of ((portal, iqn), generation) of the sessions
+        released
+        """
+
+        if not _daemonize():
+            return
+        try:
+            time.sleep(self.grace)
+            for (portal, iqn), generation in sessions:
+                try:
+                    self.reap(portal, iqn, generation)
+                except:
+                    util.logException("ISCSI_REAPER %s" %
+                                      iscsiindex.targetKey(portal, iqn))
+        finally:
+            os._exit(0)
+
+    def reap(self, portal, iqn, generation):
+        """
+        Logs out of a session without holders, if it was not held since it
+        was released
+        :param generation: generation of the session when it was released
+        :return: True if the session was logged out
+        """
+
+        key = iscsiindex.targetKey(portal, iqn)
+        lock = Lock(key, LOCK_NS)
+        lock.acquire()
+        try:
+            state = self._read(key)
+            if state is None or state['holders'] or \
+                    state['generation'] != generation:
+                return False
+            self._logout(key, state)
+            return True
+        finally:
+            lock.release()
+
+    def forget(self, portal, iqn):
+        """
+        Forgets a target whose LUN is deleted: logs out of its session,
+        unless it is held, and deletes its node record
+        :return: False if the session is held
+        """
+
+        key = iscsiindex.targetKey(portal, iqn)
+        lock = Lock(key, LOCK_NS)
+        lock.acquire()
+        try:
+            state = self._read(key)
+            entry = self.index.lookup(portal, iqn)
+            if state is not None:
+                if state['holders']:
+                    return False
+                self._logout(key, state)
+            elif entry['session']:
+                # logged in outside of the pool
+                iscsilib.logout(portal, iqn)
+                iscsistate.invalidate()
+            if entry['record']:
+                deleteRecord(portal, iqn)
+            self.index.remove(portal, iqn)
+            return True
+        finally:
+            lock.release()
+
+    def _alive(self, portal, iqn, state):
+        """
+        :return: True if the session of a state is logged in, its LUN may
+        still be waiting for udev
+        """
+
+        if state is None:
+            return False
+        if os.path.exists(state['path']):
+            return True
+        return bool(self.index.lookup(portal, iqn)['session'])
+
+    def _login(self, key, portal, iqn, login):
+        """
+        Logs in to a target, creating its node record unless the index has
+        it. A session logged in outside of the pool, as at boot, is adopted.
+        :return: path of the LUN
+        """
+
+        entry = self.index.lookup(portal, iqn)
+        if entry['session'] and os.path.exists(entry['path']):
+            util.SMlog("iSCSI session %s adopted" % key)
+            return entry['path']
+
+        if not entry['record']:
+            createRecord(portal, iqn)
+            self.index.update(portal, iqn, record=True)
+        path = login()
+        iscsistate.invalidate()
+        self.index.findSession(portal, iqn)
+        util.SMlog("iSCSI session %s logged in" % key)
+        return path
+
+    def _logout(self, key, state):
+        portal, iqn = str(state['portal']), str(state['iqn'])
+        iscsilib.logout(portal, iqn)
+        iscsistate.invalidate()
+        os.remove(self._path(key))
+        self.index.update(portal, iqn, session=None)
+        util.SMlog("iSCSI session %s logged out" % key)
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# State of the iSCSI LUNs of the host, read from sysfs and /proc without
+# running a process: the session of a target, the block devices of its LUNs,
+# the devices stacked on them, and the tapdisk processes and blkback VBDs
+# which have them open. A snapshot of the host is shared by the calls made
+# within CACHE_TTL seconds in a process.
+#
+
+import os
+import glob
+import time
+
+import iscsiindex
+
+PROC_DIR = '/proc'
+XEN_BACKEND_DIR = '/sys/bus/xen-backend/devices'
+BLOCK_DEV_DIR = '/dev'
+# seconds a snapshot of the host is used for
+CACHE_TTL = 2.0
+
+_snapshot = None
+
+
+def _readAttr(path):
+    try:
+        fd = open(path)
+    except IOError:
+        return None
+    try:
+        return fd.read().strip()
+    finally:
+        fd.close()
+
+
+def _listDir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def _blockPath(name):
+    return os.path.join(iscsiindex.SYSFS_DIR, 'block', name)
+
+
+def _sessionsByIqn():
+    """
+    :return: dict of the names of the sessions logged in, by IQN. Only the
+    target names are read, the portals of the sessions of a target are read
+    when it is looked up.
+    """
+
+    sessions_dir = os.path.join(iscsiindex.SYSFS_DIR, 'iscsi_session')
+    sessions = {}
+    for name in _listDir(sessions_dir):
+        iqn = _readAttr(os.path.join(sessions_dir, name, 'targetname'))
+        if iqn is not None:
+            sessions.setdefault(iqn, []).append(name)
+    return sessions
+
+
+def sessionDevices(session):
+    """
+    :param session: name of a session in sysfs, as session3
+    :return: names of the block devices of the LUNs of the session
+    """
+
+    return [os.path.basename(path) for path in sorted(glob.glob(
+        os.path.join(iscsiindex.SYSFS_DIR, 'iscsi_session', session,
+                     'device', 'target*', '*', 'block', '*')))]
+
+
+def deviceNumber(name):
+    """
+    :return: (major, minor) of a block device, None if it is gone
+    """
+
+    dev = _readAttr(os.path.join(_blockPath(name), 'dev'))
+    if dev is None:
+        return None
+    major, minor = dev.split(':')
+    return int(major), int(minor)
+
+
+def deviceHolders(name):
+    """
+    :return: names of the devices stacked on a block device, as dm-3
+    """
+
+    return _listDir(os.path.join(_blockPath(name), 'holders'))
+
+
+def _tapdiskFiles():
+    """
+    :return: dict of the pids of the tapdisk processes which have a file
+    open, by path
+    """
+
+    files = {}
+    for pid in _listDir(PROC_DIR):
+        if not pid.isdigit():
+            continue
+        if _readAttr(os.path.join(PROC_DIR, pid, 'comm')) != 'tapdisk':
+            continue
+        fd_dir = os.path.join(PROC_DIR, pid, 'fd')
+        for fd in _listDir(fd_dir):
+            try:
+                path = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                # closed meanwhile
+                continue
+            files.setdefault(path, set()).add(int(pid))
+    return files
+
+
+def _blkbackDevices():
+    """
+    :return: dict of the blkback VBDs using a block device, by (major, minor)
+    """
+
+    devices = {}
+    for vbd in _listDir(XEN_BACKEND_DIR):
+        if not vbd.startswith('vbd'):
+            continue
+        physical = _readAttr(os.path.join(XEN_BACKEND_DIR, vbd,
+                                          'physical_device'))
+        if not physical or ':' not in physical:
+            continue
+        major, minor = physical.split(':')
+        devices.setdefault((int(major, 16), int(minor, 16)), set()).add(vbd)
+    return devices
+
+
+class LunState(object):
+    """ State of the LUNs of a target """
+
+    __slots__ = ('session', 'devices', 'holders', 'tapdisks', 'vbds')
+
+    def __init__(self, session):
+        self.session = session  # name of the session, None if logged out
+        self.devices = []       # block devices of the LUNs
+        self.holders = []       # devices stacked on them
+        self.tapdisks = []      # pids of the tapdisks having them open
+        self.vbds = []          # blkback VBDs using them
+
+    def loggedIn(self):
+        return self.session is not None
+
+    def inUse(self):
+        """
+        :return: True if a LUN of the target is open by tapdisk, blkback or
+        a device stacked on it
+        """
+
+        return bool(self.holders or self.tapdisks or self.vbds)
+
+
+class HostState(object):
+    """ Snapshot of the sessions of the host and of the users of its block
+    devices. The users are read on the first lookup of a target logged in.
+    """
+
+    def __init__(self):
+        self.time = time.time()
+        self.sessions = _sessionsByIqn()
+        self.tapdisk_files = None
+        self.blkback_devices = None
+
+    def lunState(self, portal, iqn):
+        """
+        :param portal: portal of the target, as ip:port
+        :return: LunState of the target
+        """
+
+        session = None
+        for name in self.sessions.get(iqn, ()):
+            if iscsiindex.sessionTarget(name) == (portal, iqn):
+                session = name
+                break
+        state = LunState(session)
+        if session is None:
+            return state
+
+        if self.tapdisk_files is None:
+            self.tapdisk_files = _tapdiskFiles()
+            self.blkback_devices = _blkbackDevices()
+
+        state.devices = sessionDevices(state.session)
+        for name in state.devices:
+            state.holders.extend(deviceHolders(name))
+        for name in state.devices + state.holders:
+            state.tapdisks.extend(self.tapdisk_files.get(
+                os.path.join(BLOCK_DEV_DIR, name), ()))
+            state.vbds.extend(self.blkback_devices.get(deviceNumber(name),
+                                                       ()))
+        return state
+
+
+def snapshot(max_age=CACHE_TTL):
+    """
+    :param max_age: seconds a snapshot taken earlier in the process is used
+    for, 0 takes a new one
+    :return: HostState of the host
+    """
+
+    global _snapshot
+
+    if _snapshot is None or time.time() - _snapshot.time >= max_age:
+        _snapshot = HostState()
+    return _snapshot
+
+
+def invalidate():
+    """
+    Drops the snapshot of the host, after a login or a logout of the process
+    """
+
+    global _snapshot
+
+    _snapshot = None
+
+
+def lunState(portal, iqn, max_age=CACHE_TTL):
+    return snapshot(max_age).lunState(portal, iqn)
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Typed model of the LVM metadata of a volume group, an alternative to the
+# nested dicts returned by LvmConfigParser.toDict()
+#
+
+import lvmconfigparser
+
+LV_VHD_PREFIX = 'VHD-'
+SEGMENT_PREFIX = 'segment'
+
+
+class _Interner(object):
+    """ Shares equal values between the entries of a config. The status and
+    flags arrays, stripe lists and strings like the segment type repeat for
+    every LV and segment, so only one copy of each is kept """
+
+    def __init__(self):
+        self.values = {}
+
+    def __call__(self, value):
+        if type(value) == list:
+            value = tuple(value)
+        return self.values.setdefault(value, value)
+
+
+class _Entry(object):
+    """ Base of the config sections. The keys listed in FIELDS are kept in
+    slots, in that order when serialized, other keys are kept in extra """
+
+    __slots__ = ('extra',)
+
+    FIELDS = ()
+
+    def __init__(self):
+        self.extra = None
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def _load(self, section, intern):
+        for key, value in section.iteritems():
+            if key in self.FIELDS:
+                if type(value) != dict:
+                    value = intern(value)
+                setattr(self, key, value)
+            elif not self._loadSection(key, value, intern):
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    def _loadSection(self, key, value, intern):
+        return False
+
+    def iteritems(self):
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                yield field, value
+
+        if self.extra:
+            for item in self.extra.iteritems():
+                yield item
+
+        for item in self._iterSections():
+            yield item
+
+    def _iterSections(self):
+        return ()
+
+    def toDict(self):
+        """
+        :return: the entry as nested dicts, as returned by the parser
+        """
+
+        return _toDict(self)
+
+
+def _toDict(section):
+    result = {}
+    for key, value in section.iteritems():
+        if type(value) in lvmconfigparser.ARRAY_TYPES:
+            value = list(value)
+        elif type(value) not in lvmconfigparser.SCALAR_TYPES:
+            value = _toDict(value)
+        result[key] = value
+    return result
+
+
+class Segment(_Entry):
+
+    FIELDS = ('start_extent', 'extent_count', 'type', 'stripe_count',
+              'stripes')
+
+    __slots__ = FIELDS
+
+
+class LogicalVolume(_Entry):
+
+    FIELDS = ('id', 'status', 'flags', 'creation_time', 'creation_host',
+              'segment_count')
+
+    __slots__ = FIELDS + ('name', 'segments')
+
+    def __init__(self, name):
+        _Entry.__init__(self)
+        self.name = name
+        self.segments = []
+
+    def _loadSection(self, key, value, intern):
+        if type(value) != dict or not key.startswith(SEGMENT_PREFIX):
+            return False
+
+        try:
+            index = int(key[len(SEGMENT_PREFIX):])
+        except ValueError:
+            return False
+
+        segment = Segment()
+        segment._load(value, intern)
+        self.segments.append((index, segment))
+        return True
+
+    def _iterSections(self):
+        for i in range(len(self.segments)):
+            yield '%s%d' % (SEGMENT_PREFIX, i + 1), self.segments[i]
+
+
+class PhysicalVolume(_Entry):
+
+    FIELDS = ('id', 'device', 'status', 'flags', 'dev_size', 'pe_start',
+              'pe_count')
+
+    __slots__ = FIELDS + ('name',)
+
+    def __init__(self, name):
+        _Entry.__init__(self)
+        self.name = name
+
+
+class VolumeGroup(_Entry):
+    """ A volume group with its PVs and LVs. LVs are indexed by name and by
+    LVM id, so they can be looked up and renamed in constant time """
+
+    FIELDS = ('id', 'seqno', 'format', 'status', 'flags', 'extent_size',
+              'max_lv', 'max_pv', 'metadata_copies')
+
+    __slots__ = FIELDS + ('name', 'physical_volumes', 'logical_volumes',
+                          '_lvsById')
+
+    def __init__(self, name):
+        _Entry.__init__(self)
+        self.name = name
+        self.physical_volumes = {}
+        self.logical_volumes = {}
+        self._lvsById = {}
+
+    def _loadSection(self, key, value, intern):
+        if key == 'physical_volumes':
+            for pv_name, section in value.iteritems():
+                pv = PhysicalVolume(pv_name)
+                pv._load(section, intern)
+                self.physical_volumes[pv_name] = pv
+            return True
+
+        if key == 'logical_volumes':
+            for lv_name, section in value.iteritems():
+                lv = LogicalVolume(lv_name)
+                lv._load(section, intern)
+                lv.segments.sort()
+                lv.segments = [segment for _index, segment in lv.segments]
+                self.logical_volumes[lv_name] = lv
+                if lv.id is not None:
+                    self._lvsById[lv.id] = lv
+            return True
+
+        return False
+
+    def _iterSections(self):
+        yield 'physical_volumes', self.physical_volumes
+        yield 'logical_volumes', self.logical_volumes
+
+    def getLv(self, lv_name):
+        return self.logical_volumes.get(lv_name)
+
+    def getLvById(self, lv_id):
+        return self._lvsById.get(lv_id)
+
+    def getLvByVhdUuid(self, vdi_uuid):
+        return self.logical_volumes.get(LV_VHD_PREFIX + vdi_uuid)
+
+    def renameLv(self, lv_name, new_lv_name):
+        """
+        Renames an LV
+        :param lv_name: current name of the LV
+        :param new_lv_name: name the LV is renamed to
+        :return: the renamed LV
+        """
+
+        assert new_lv_name not in self.logical_volumes, \
+            "LV %s already exists" % new_lv_name
+
+        lv = self.logical_volumes.pop(lv_name)
+        lv.name = new_lv_name
+        self.logical_volumes[new_lv_name] = lv
+        return lv
+
+    def renameVhdLv(self, vdi_uuid, new_vdi_uuid):
+        return self.renameLv(LV_VHD_PREFIX + vdi_uuid,
+                             LV_VHD_PREFIX + new_vdi_uuid)
+
+    def setLvId(self, lv, lv_id):
+        if lv.id is not None:
+            del self._lvsById[lv.id]
+        lv.id = lv_id
+        self._lvsById[lv_id] = lv
+
+    def removeLv(self, lv_name):
+        lv = self.logical_volumes.pop(lv_name)
+        if lv.id is not None:
+            del self._lvsById[lv.id]
+        return lv
+
+
+class LvmConfig(_Entry):
+    """ The config of a single volume group as written by vgcfgbackup """
+
+    FIELDS = ('contents', 'version', 'description', 'creation_host',
+              'creation_time')
+
+    __slots__ = FIELDS + ('vg',)
+
+    def __init__(self):
+        _Entry.__init__(self)
+        self.vg = None
+
+    def _loadSection(self, key, value, intern):
+        if type(value) != dict or self.vg is not None:
+            return False
+
+        self.vg = VolumeGroup(key)
+        self.vg._load(value, intern)
+        return True
+
+    def _iterSections(self):
+        if self.vg is not None:
+            yield self.vg.name, self.vg
+
+    def write(self, config_fd):
+        """
+        Writes the config in the format read by vgcfgrestore
+        :param config_fd: file object the config is written to
+        """
+
+        lvmconfigparser.LvmConfigParser(self).write(config_fd)
+
+    def toConfigString(self):
+        return lvmconfigparser.LvmConfigParser(self).toConfigString()
+
+
+def fromDict(config_dict):
+    """
+    Builds the model from the dicts returned by LvmConfigParser.toDict()
+    :param config_dict: lvm config dict of a single VG
+    :return: LvmConfig
+    """
+
+    config = LvmConfig()
+    config._load(config_dict, _Interner())
+    assert config.vg is not None, "No volume group found"
+    return config
+
+
+def parse(config_file):
+    """
+    Parses an LVM config into the model
+    :param config_file: path of the config or a file object
+    :return: LvmConfig
+    """
+
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(config_file)
+    return fromDict(parser.toDict())
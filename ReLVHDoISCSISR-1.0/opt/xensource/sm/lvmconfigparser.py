@@ -16,178 +16,348 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-
-try:
-    import simplejson as json
-except:
-    import json
-
+import re
+import binascii
+
+
+_WORD = r'[^\s=\[\]{},"#]+'
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+# Matches the next token of the lvm.conf grammar after skipping whitespace and
+# comments. The common statements are matched whole to keep the work done per
+# token in python low, the groups are:
+#   word:  a bare word, which is a key or an unquoted value (a number)
+#   value: the value or '[' when the word is a key followed by '='
+#   brace: '{' when the word is a key starting a section
+#   other: any other token. A lone '"' only matches an unterminated string.
+# Only the end of the input gives an empty match, so findall never skips
+# over any text.
+_TOKEN_RE = re.compile(
+    r'\s*(?:#[^\n]*(?:\n|\Z)\s*)*'
+    r'(?:(%s)\s*(?:=\s*(%s|%s|\[)|({))?|(}|[\],]|%s|[=\[{]|")|\Z)'
+    % (_WORD, _STRING, _WORD, _STRING))
+_ESCAPE_RE = re.compile(r'\\(.)')
+
+# The config is read and tokenized in blocks of whole lines, no token spans a
+# line.
+_READ_SIZE = 256 * 1024
+
+_PUNCTUATION = '=[]{},'
+
+SCALAR_TYPES = (str, unicode, int, long, float)
+ARRAY_TYPES = (list, tuple)
+
+_LVM_UUID_LEN = 32
+_LVM_UUID_CHARS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!#"
+# maps a random byte to a UUID character, as gen_lvm_uuid always did
+_LVM_UUID_TABLE = ''.join([_LVM_UUID_CHARS[i % (len(_LVM_UUID_CHARS) - 3)]
+                           for i in range(256)])
+# (start, end) of the dash separated groups of the UUIDs
+_LVM_UUID_GROUPS = [(0, 6), (6, 10), (10, 14), (14, 18), (18, 22), (22, 26),
+                    (26, 32)]
+_UUID_GROUPS = [(0, 8), (8, 12), (12, 16), (16, 20), (20, 32)]
+
+# parser states
+_KEY = 0            # expecting a key or the end of a section
+_OPERATOR = 1       # expecting '=' or '{' after a key
+_VALUE = 2          # expecting a value or the start of an array
+_ARRAY_VALUE = 3    # expecting an array element or the end of the array
+_ARRAY_SEP = 4      # expecting ',' or the end of the array
+
+
+class ParseError(Exception):
+    pass
 
 
 class LvmConfigParser(object):
     """ Class which parses the LVM metadata. It uses the grammer given at
-    http://linux.die.net/man/5/lvm.conf There are still some assumptions on the
-    format of the data that is provided. Notably, sections start and end on a
-    new line. i.e '<key> { ' and '}' will always occur on a new line 
-    """
+    http://linux.die.net/man/5/lvm.conf
 
-    ASSIGNMENT = 1
-    DICT_START = 2
-    DICT_END = 3
+    The config is tokenized and parsed in a single pass over its lines, so
+    sections, arrays and assignments may be laid out freely (inline sections,
+    arrays spanning several lines, several statements on one line).
+    """
 
     def __init__(self, config_dict=None):
 
-        self.out_str = ""
-
         self.root = {}
         if config_dict:
             self.root = config_dict
 
-        self.cur_entry = self.root
-        self.prev_entries = list()
-
-        self.current_line = 0
-
-        self.parse_callbacks = {
-
-            LvmConfigParser.ASSIGNMENT: self._parseAssignment,
-            LvmConfigParser.DICT_START: self._parseDictStart,
-            LvmConfigParser.DICT_END: self._parseDictEnd,
-        }
-
     def toConfigString(self):
-        self._toString(self.root, 0)
-        return self.out_str
+        return ''.join(self.iterConfig())
+
+    def write(self, config_fd):
+        """
+        Writes the config to a file object, one line at a time
+        :param config_fd: file object the config is written to
+        """
+
+        config_fd.writelines(self.iterConfig())
+
+    def iterConfig(self):
+        """
+        Serializes the config in the format read by vgcfgrestore and
+        pvcreate --restorefile. Sections are walked with an explicit stack so
+        every line is generated once, in time linear to the config size.
+        :return: generator of config lines
+        """
+
+        stack = [(self.root.iteritems(), '')]
+
+        while stack:
+            items, indent_sp = stack[-1]
+            for key, value in items:
+                value_type = type(value)
+                if value_type in ARRAY_TYPES:
+                    yield '%s%s = [%s]\n' % (indent_sp, key,
+                                             ', '.join(map(_fromValue, value)))
+                elif value_type in SCALAR_TYPES:
+                    yield '%s%s = %s\n' % (indent_sp, key, _fromValue(value))
+                else:
+                    yield '%s%s {\n' % (indent_sp, key)
+                    stack.append((value.iteritems(), indent_sp + '\t'))
+                    break
+            else:
+                stack.pop()
+                if stack:
+                    yield '%s}\n' % indent_sp[:-1]
 
     def toDict(self):
         return self.root
 
     def parse(self, config_file):
+        """
+        Parses an LVM config into the root dict
+        :param config_file: path of the config, or a file object (or pipe)
+        that the config is read from
+        """
 
-        fd = open(config_file)
-        config_data = fd.readlines()
-        clean_config = self._removeComments(config_data)
-        fd.close()
-        self._parse(clean_config)
-
-    def _removeComments(self, config_list):
-
-        clean_lines = []
-        for line in config_list:
-            line = line.strip()
-            comment_idx = line.find('#')
-            if comment_idx >= 0:
-                line = line[:comment_idx]
-            if len(line):
-                clean_lines.append(line)
-
-        return clean_lines
+        if hasattr(config_file, 'read'):
+            self._parse(config_file)
+            return
 
-    def _getLineType(self, line):
-
-        if line.find('=') >= 0:
-            return LvmConfigParser.ASSIGNMENT
-        elif line.endswith('{'):
-            return LvmConfigParser.DICT_START
-        elif line.endswith('}'):
-            return LvmConfigParser.DICT_END
-
-        assert "Parse type not found for %s" % line
-
-    def _parse(self, lines):
+        fd = open(config_file)
+        try:
+            self._parse(fd)
+        finally:
+            fd.close()
+
+    def _parse(self, config_fd):
+
+        stack = []
+        cur_entry = self.root
+        key = None
+        array = None
+        state = _KEY
+        remainder = ''
+
+        while True:
+            data = config_fd.read(_READ_SIZE)
+            if not data:
+                block = remainder
+            else:
+                end = data.rfind('\n') + 1
+                if not end:
+                    remainder += data
+                    continue
+                block = remainder + data[:end]
+                remainder = data[end:]
+
+            for word, value, brace, token in _TOKEN_RE.findall(block):
+
+                if state == _KEY:
+                    if value:
+                        c = value[0]
+                        if c == '"':
+                            value = value[1:-1]
+                            if '\\' in value:
+                                value = _ESCAPE_RE.sub(r'\1', value)
+                            cur_entry[word] = value
+                        elif c == '[':
+                            key = word
+                            array = []
+                            cur_entry[key] = array
+                            state = _ARRAY_VALUE
+                        else:
+                            cur_entry[word] = _toValue(value)
+                    elif brace:
+                        section = {}
+                        cur_entry[word] = section
+                        stack.append(cur_entry)
+                        cur_entry = section
+                    elif word:
+                        # the operator follows after a comment
+                        key = word
+                        state = _OPERATOR
+                    elif token == '}':
+                        if not stack:
+                            raise ParseError("Unbalanced '}' in config")
+                        cur_entry = stack.pop()
+                    elif token:
+                        raise ParseError("Expected a key, got %s" % token)
+                    continue
+
+                if value or brace:
+                    raise ParseError("Unexpected %s in %s" % (word, key))
+
+                token = word or token
+                if not token:
+                    continue
+
+                if state == _ARRAY_SEP:
+                    if token == ',':
+                        state = _ARRAY_VALUE
+                    elif token == ']':
+                        state = _KEY
+                    else:
+                        raise ParseError("Expected ',' or ']' in %s" % key)
+
+                elif state == _ARRAY_VALUE:
+                    if token == ']':
+                        state = _KEY
+                    else:
+                        array.append(_toValue(token))
+                        state = _ARRAY_SEP
+
+                elif state == _VALUE:
+                    if token == '[':
+                        array = []
+                        cur_entry[key] = array
+                        state = _ARRAY_VALUE
+                    else:
+                        cur_entry[key] = _toValue(token)
+                        state = _KEY
+
+                else:  # _OPERATOR
+                    if token == '=':
+                        state = _VALUE
+                    elif token == '{':
+                        section = {}
+                        cur_entry[key] = section
+                        stack.append(cur_entry)
+                        cur_entry = section
+                        state = _KEY
+                    else:
+                        raise ParseError("Expected '=' or '{' after %s" % key)
+
+            if not data:
+                break
+
+        if stack or state != _KEY:
+            raise ParseError("Unexpected end of config")
+
+
+def _toValue(token):
+    """
+    Converts a value token to a string, int or float
+    :param token: token read from the config
+    :return: the python value for the token
+    """
 
-        while self.current_line < len(lines):
-            parse_type = self._getLineType(lines[self.current_line])
-            self.parse_callbacks[parse_type](lines)
+    if token[0] == '"':
+        if len(token) < 2:
+            raise ParseError("Unterminated string in config")
+        value = token[1:-1]
+        if '\\' in value:
+            value = _ESCAPE_RE.sub(r'\1', value)
+        return value
 
-    def _parseAssignment(self, lines):
+    if token in _PUNCTUATION:
+        raise ParseError("Expected a value, got %s" % token)
 
-        line = lines[self.current_line]
-        key, value = line.split('=')
+    try:
+        return int(token)
+    except ValueError:
+        pass
 
-        key = key.strip()
-        value = value.strip()
+    try:
+        return float(token)
+    except ValueError:
+        raise ParseError("Invalid value %s" % token)
 
-        if value == '[':  # array spanning multiple lines
-            while True:
-                self.current_line += 1
-                line = lines[self.current_line].strip()
-                value += line
-                if line == ']':
-                    break
 
-        self.cur_entry[key] = json.loads(value)
-        self.current_line += 1
+def _fromValue(value):
+    """
+    Converts a python value to its config representation
+    :param value: string, int or float
+    :return: the token for the value
+    """
 
-    def _parseDictStart(self, lines):
+    if type(value) == unicode:
+        value = value.encode('utf-8')
 
-        line = lines[self.current_line]
-        key, _ = line.split('{')
-        key = key.strip()
+    if type(value) == str:
+        if '\\' in value or '"' in value:
+            value = value.replace('\\', '\\\\').replace('"', '\\"')
+        return '"%s"' % value
 
-        self.cur_entry[key] = {}
-        self.prev_entries.append(self.cur_entry)
+    if type(value) == float:
+        return repr(value)
 
-        self.cur_entry = self.cur_entry[key]
-        self.current_line += 1
+    return str(value)
 
-    def _parseDictEnd(self, lines):
-        self.cur_entry = self.prev_entries.pop()
-        self.current_line += 1
 
-    def _toString(self, data, indent):
-        indent_sp = '\t' * indent
+def gen_lvm_uuid():
+    """
+    Generates a random UUID used by LVM
+    :return: a random UUID string
+    """
 
-        if type(data) == dict:
-            for key in data:
-                if type(data[key]) == dict:
-                    self.out_str += indent_sp + "%s {\n" % key
-                else:
-                    self.out_str += indent_sp + "%s = " % key
+    return gen_lvm_uuids(1)[0]
 
-                self._toString(data[key], indent + 1)
 
-                if type(data[key]) == dict:
-                    self.out_str += indent_sp + "}\n"
-                else:
-                    self.out_str += indent_sp + "\n"
+def gen_lvm_uuids(count):
+    """
+    Generates random UUIDs used by LVM, in the 6-4-4-4-4-4-6 format. All of
+    them come from a single read of random bytes, mapped to UUID characters
+    with one translate call.
+    :param count: number of UUIDs to generate
+    :return: list of distinct UUID strings
+    """
 
-        elif type(data) == list:
-            self.out_str += "["
-            for v in data:
-                self._toString(v, indent)
-                self.out_str += " , "
+    uuids = []
+    seen = set()
 
-            # remove trailing comma for non-empty lists
-            if len(data):
-                self.out_str = self.out_str[:-3]
-            self.out_str += "]\n"
+    while len(uuids) < count:
+        needed = count - len(uuids)
+        chars = os.urandom(_LVM_UUID_LEN * needed).translate(_LVM_UUID_TABLE)
 
-        elif type(data) == str or type(data) == unicode:
-            self.out_str += '"%s"' % data
+        for start in xrange(0, len(chars), _LVM_UUID_LEN):
+            uuid = '-'.join([chars[start + group_start:start + group_end]
+                             for group_start, group_end in _LVM_UUID_GROUPS])
+            if uuid not in seen:
+                seen.add(uuid)
+                uuids.append(uuid)
 
-        else:
-            self.out_str += "%s" % data
+    return uuids
 
 
-def gen_lvm_uuid():
+def gen_uuids(count):
     """
-    Generates a random UUID used by LVM
-    :return: a random UUID string
+    Generates random (version 4) UUIDs, as used for SRs and VDIs, from a
+    single read of random bytes
+    :param count: number of UUIDs to generate
+    :return: list of distinct UUID strings
     """
 
-    LEN = 32
-    _c = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!#"
-    groups = [6, 10, 14, 18, 22, 26, 32]  # lengths after with to insert a '-'
-    group_idx = 0
-
-    rand_bytes = os.urandom(LEN)
-    uuid = ""
-
-    for i in range(0, LEN):
-        uuid += _c[ord(rand_bytes[i]) % (len(_c) - 3)]
-        if i == groups[group_idx] - 1:
-            group_idx += 1
-            uuid += '-'
-
-    return uuid[:-1]  # remove trailing '-'
+    uuids = []
+    seen = set()
+
+    while len(uuids) < count:
+        needed = count - len(uuids)
+        rand_bytes = os.urandom(16 * needed)
+
+        for start in xrange(0, len(rand_bytes), 16):
+            raw = rand_bytes[start:start + 16]
+            # version 4, variant RFC 4122
+            hex_chars = binascii.hexlify(
+                raw[:6] + chr((ord(raw[6]) & 0x0f) | 0x40) + raw[7] +
+                chr((ord(raw[8]) & 0x3f) | 0x80) + raw[9:])
+            uuid = '-'.join([hex_chars[group_start:group_end]
+                             for group_start, group_end in _UUID_GROUPS])
+            if uuid not in seen:
+                seen.add(uuid)
+                uuids.append(uuid)
+
+    return uuids
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Reads the LVM2 label of a PV and the VG metadata in its metadata areas,
+# without the LVM tools
+#
+
+import os
+import re
+import zlib
+import struct
+
+SECTOR_SIZE = 512
+# the label is in one of the first sectors of the PV
+LABEL_SCAN_SECTORS = 4
+LABEL_ID = 'LABELONE'
+LABEL_TYPE = 'LVM2 001'
+
+MDA_HEADER_SIZE = 512
+MDA_MAGIC = ' LVM2 x[5A%r0N*>'
+MDA_VERSION = 1
+RAW_LOCN_IGNORED = 0x00000001
+
+# initial value of the CRC of the LVM2 on-disk structures
+INITIAL_CRC = 0xf597a6cf
+
+# size of the first read, which holds the label, the header of the first
+# metadata area and, on LVHD PVs, most often the metadata itself
+READ_SIZE = 1024 * 1024
+
+# label header: id, sector, crc, offset of the PV header, type
+_LABEL_FORMAT = '<8sQII8s'
+_LABEL_CRC_START = 20           # the crc covers the rest of the sector
+# PV header: uuid and device size, followed by the lists of data areas and
+# metadata areas, each ended by a null entry
+_PV_HEADER_FORMAT = '<32sQ'
+_DISK_LOCN_FORMAT = '<QQ'
+# metadata area header: crc, magic, version, start, size, followed by the
+# locations of the metadata, ended by a null entry
+_MDA_HEADER_FORMAT = '<I16sIQQ'
+_RAW_LOCN_FORMAT = '<QQII'
+
+_PV_UUID_GROUPS = [(0, 6), (6, 10), (10, 14), (14, 18), (18, 22), (22, 26),
+                   (26, 32)]
+
+_VG_NAME_RE = re.compile(r'\s*([^\s{=#]+)\s*{')
+_SEQNO_RE = re.compile(r'^\s*seqno\s*=\s*(\d+)', re.MULTILINE)
+# start of the metadata text of a VG, as LVM writes it in a metadata area.
+# VG names have at most 128 characters, which bounds the match on the
+# sectors of the circular buffer that hold no metadata.
+_PREVIOUS_TEXT_RE = re.compile(r'([^\s{=#\x00]{1,128}) {\n\s*id = "')
+
+
+class LvmLabelError(Exception):
+    pass
+
+
+class PvMetadata(object):
+    """ The label of a PV and the newest VG metadata of its metadata areas """
+
+    __slots__ = ('pv_uuid', 'device_size', 'vg_name', 'seqno', 'text')
+
+    def __init__(self, pv_uuid, device_size, vg_name, seqno, text):
+        self.pv_uuid = pv_uuid
+        self.device_size = device_size
+        self.vg_name = vg_name
+        self.seqno = seqno
+        self.text = text
+
+
+def calcCrc(data, crc=INITIAL_CRC):
+    """
+    :return: the CRC used by LVM2, a CRC-32 without the final inversion
+    """
+
+    return ~zlib.crc32(data, ~crc & 0xffffffff) & 0xffffffff
+
+
+def formatPvUuid(uuid):
+    """
+    :return: the PV uuid in the dash separated form of the LVM config
+    """
+
+    return '-'.join([uuid[start:end] for start, end in _PV_UUID_GROUPS])
+
+
+def _unpack(fmt, data, offset=0):
+    return struct.unpack(fmt, data[offset:offset + struct.calcsize(fmt)])
+
+
+class _Reader(object):
+    """ Reads the PV through the first block read, and pread past it """
+
+    def __init__(self, fd):
+        self.fd = fd
+        os.lseek(fd, 0, 0)
+        self.data = os.read(fd, READ_SIZE)
+
+    def read(self, offset, size):
+        if offset + size <= len(self.data):
+            return self.data[offset:offset + size]
+
+        os.lseek(self.fd, offset, 0)
+        data = os.read(self.fd, size)
+        if len(data) != size:
+            raise LvmLabelError("Short read at %d" % offset)
+        return data
+
+
+def _findLabel(reader):
+    """
+    :return: the sector holding the label, None if there is none
+    """
+
+    for sector in range(LABEL_SCAN_SECTORS):
+        offset = sector * SECTOR_SIZE
+        data = reader.read(offset, SECTOR_SIZE)
+        if data[:len(LABEL_ID)] != LABEL_ID:
+            continue
+
+        _id, sector_xl, crc, pv_offset, label_type = \
+            _unpack(_LABEL_FORMAT, data)
+        if sector_xl != sector or label_type != LABEL_TYPE:
+            raise LvmLabelError("Unexpected label in sector %d" % sector)
+        if crc != calcCrc(data[_LABEL_CRC_START:]):
+            raise LvmLabelError("Invalid label checksum")
+        return data
+
+    return None
+
+
+def _readDiskLocns(data, offset):
+    """
+    :return: (list of (offset, size), offset past the null entry)
+    """
+
+    size = struct.calcsize(_DISK_LOCN_FORMAT)
+    locns = []
+    while True:
+        if offset + size > len(data):
+            raise LvmLabelError("Unterminated disk area list")
+        locn = _unpack(_DISK_LOCN_FORMAT, data, offset)
+        offset += size
+        if locn == (0, 0):
+            return locns, offset
+        locns.append(locn)
+
+
+def _readMdaHeader(reader, mda_offset, mda_size):
+    """
+    Reads and checks the header of a metadata area
+    :return: the header sector
+    """
+
+    header = reader.read(mda_offset, MDA_HEADER_SIZE)
+    crc, magic, version, start, size = \
+        _unpack(_MDA_HEADER_FORMAT, header)
+    if magic != MDA_MAGIC or version != MDA_VERSION:
+        raise LvmLabelError("Invalid metadata area header at %d" % mda_offset)
+    if crc != calcCrc(header[4:]):
+        raise LvmLabelError("Invalid metadata area checksum at %d" % mda_offset)
+    if start != mda_offset or size != mda_size:
+        raise LvmLabelError("Metadata area %d does not match the label" %
+                            mda_offset)
+    return header
+
+
+def _readMetadataArea(reader, mda_offset, mda_size):
+    """
+    Reads the committed metadata of a metadata area, which is a circular
+    buffer after the header: the metadata may wrap around its end
+    :return: metadata text, None if the area holds none
+    """
+
+    header = _readMdaHeader(reader, mda_offset, mda_size)
+    offset, text_size, text_crc, flags = _unpack(
+        _RAW_LOCN_FORMAT, header, struct.calcsize(_MDA_HEADER_FORMAT))
+    if not text_size or flags & RAW_LOCN_IGNORED:
+        return None
+    if offset < MDA_HEADER_SIZE or offset >= mda_size or \
+            text_size > mda_size - MDA_HEADER_SIZE:
+        raise LvmLabelError("Invalid metadata location in area %d" %
+                            mda_offset)
+
+    wrap = max(offset + text_size - mda_size, 0)
+    text = reader.read(mda_offset + offset, text_size - wrap)
+    if wrap:
+        text += reader.read(mda_offset + MDA_HEADER_SIZE, wrap)
+
+    if text_crc != calcCrc(text):
+        raise LvmLabelError("Invalid metadata checksum in area %d" %
+                            mda_offset)
+    return text.rstrip('\x00')
+
+
+def _readPvHeader(data):
+    """
+    Reads the PV header that follows the label
+    :return: PV uuid, device size, list of (offset, size) of the metadata areas
+    """
+
+    pv_offset = _unpack(_LABEL_FORMAT, data)[3]
+    if pv_offset < struct.calcsize(_LABEL_FORMAT) or \
+            pv_offset + struct.calcsize(_PV_HEADER_FORMAT) > SECTOR_SIZE:
+        raise LvmLabelError("Invalid PV header offset %d" % pv_offset)
+    pv_uuid, device_size = _unpack(_PV_HEADER_FORMAT, data, pv_offset)
+    _data_areas, offset = _readDiskLocns(
+        data, pv_offset + struct.calcsize(_PV_HEADER_FORMAT))
+    metadata_areas, offset = _readDiskLocns(data, offset)
+    return pv_uuid, device_size, metadata_areas
+
+
+def readPvMetadata(fd):
+    """
+    Reads the label of a PV and the newest metadata of its metadata areas
+    :param fd: file descriptor of the PV
+    :return: PvMetadata, None if there is no LVM2 label on the device.
+    PvMetadata.text is None if no metadata area holds any metadata.
+    """
+
+    reader = _Reader(fd)
+    data = _findLabel(reader)
+    if not data:
+        return None
+    pv_uuid, device_size, metadata_areas = _readPvHeader(data)
+
+    best = None
+    for mda_offset, mda_size in metadata_areas:
+        text = _readMetadataArea(reader, mda_offset, mda_size)
+        if text is None:
+            continue
+
+        match = _VG_NAME_RE.match(text)
+        seqno = _SEQNO_RE.search(text)
+        if not match or not seqno:
+            raise LvmLabelError("Unexpected metadata in area %d" % mda_offset)
+        seqno = int(seqno.group(1))
+        if best is None or seqno > best[1]:
+            best = (match.group(1), seqno, text)
+
+    if best is None:
+        return PvMetadata(formatPvUuid(pv_uuid), device_size, None, None, None)
+    vg_name, seqno, text = best
+    return PvMetadata(formatPvUuid(pv_uuid), device_size, vg_name, seqno, text)
+
+
+def readPreviousMetadata(fd):
+    """
+    Finds the VG metadata that the metadata areas of a PV still hold although
+    their headers no longer point to it, as after pvcreate, which writes a new
+    label and empty metadata area headers but leaves the circular buffers
+    as they were. The text of an entry is not checked against a checksum: the
+    caller has to validate it.
+    :param fd: file descriptor of the PV
+    :return: list of (vg name, seqno, text), newest first
+    """
+
+    reader = _Reader(fd)
+    data = _findLabel(reader)
+    if not data:
+        return []
+    metadata_areas = _readPvHeader(data)[2]
+
+    found = {}
+    for mda_offset, mda_size in metadata_areas:
+        _readMdaHeader(reader, mda_offset, mda_size)
+        buf = reader.read(mda_offset + MDA_HEADER_SIZE,
+                          mda_size - MDA_HEADER_SIZE)
+        # metadata is written at sector boundaries of the circular buffer
+        for start in xrange(0, len(buf), SECTOR_SIZE):
+            match = _PREVIOUS_TEXT_RE.match(buf, start)
+            if not match:
+                continue
+            end = buf.find('\x00', start)
+            if end >= 0:
+                text = buf[start:end]
+            else:
+                end = buf.find('\x00')
+                if end < 0:
+                    continue
+                text = buf[start:] + buf[:end]
+            seqno = _SEQNO_RE.search(text)
+            if seqno:
+                found[text] = (match.group(1), int(seqno.group(1)), text)
+
+    previous = found.values()
+    previous.sort(lambda a, b: cmp(b[1], a[1]))
+    return previous
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Resigned view of a parsed LVM config
+#
+
+import lvmconfigparser
+
+
+class _Override(object):
+    """ View of a section with some of its values replaced """
+
+    __slots__ = ('section', 'values')
+
+    def __init__(self, section, values):
+        self.section = section
+        self.values = values
+
+    def iteritems(self):
+        values = self.values
+        for key, value in self.section.iteritems():
+            if key in values:
+                value = values[key]
+            yield key, value
+
+
+class _Volumes(object):
+    """ View of the physical_volumes or logical_volumes section, with the
+    volumes renamed and their ids replaced, and the dropped volumes left out """
+
+    __slots__ = ('section', 'names', 'ids', 'values', 'dropped')
+
+    def __init__(self, section, names, ids, values=None, dropped=()):
+        self.section = section
+        self.names = names
+        self.ids = ids
+        self.values = values
+        self.dropped = dropped
+
+    def iteritems(self):
+        names = self.names
+        ids = self.ids
+        dropped = self.dropped
+        for name, volume in self.section.iteritems():
+            if name in dropped:
+                continue
+            values = {'id': ids[name]}
+            if self.values:
+                values.update(self.values)
+            yield names.get(name, name), _Override(volume, values)
+
+
+class _VolumeGroup(object):
+
+    __slots__ = ('section', 'physical_volumes', 'logical_volumes')
+
+    def __init__(self, section, physical_volumes, logical_volumes):
+        self.section = section
+        self.physical_volumes = physical_volumes
+        self.logical_volumes = logical_volumes
+
+    def iteritems(self):
+        for key, value in self.section.iteritems():
+            if key == 'physical_volumes':
+                value = self.physical_volumes
+            elif key == 'logical_volumes':
+                value = self.logical_volumes
+            yield key, value
+
+
+class ResignedLvmConfig(object):
+    """ Presents an LVM config dict as resigned: the VG is renamed, PVs get
+    new ids and device, LVs new ids and names. The substitutions are made
+    while the config is serialized, so the original config is neither copied
+    nor modified. """
+
+    def __init__(self, config_dict, old_vg_name, new_vg_name, pv_ids, device,
+                 lv_ids, lv_names, dropped_lvs=()):
+        """
+        :param config_dict: lvm config dict as returned by the parser
+        :param old_vg_name: name of the VG in config_dict
+        :param new_vg_name: name of the resigned VG
+        :param pv_ids: map from PV section names to their new ids
+        :param device: device of the PV
+        :param lv_ids: map from LV names to their new ids
+        :param lv_names: map from old to new names of the renamed LVs
+        :param dropped_lvs: set of the names of the LVs left out of the
+        resigned config
+        """
+
+        assert old_vg_name in config_dict, "No volume group found"
+
+        self.config_dict = config_dict
+        self.old_vg_name = old_vg_name
+        self.new_vg_name = new_vg_name
+
+        vg_info = config_dict[old_vg_name]
+        self.vg = _VolumeGroup(
+            vg_info,
+            _Volumes(vg_info['physical_volumes'], {}, pv_ids,
+                     {'device': device}),
+            _Volumes(vg_info['logical_volumes'], lv_names, lv_ids,
+                     dropped=dropped_lvs))
+
+    def iteritems(self):
+        for key, value in self.config_dict.iteritems():
+            if key == self.old_vg_name:
+                yield self.new_vg_name, self.vg
+            else:
+                yield key, value
+
+    def write(self, config_fd):
+        lvmconfigparser.LvmConfigParser(self).write(config_fd)
+
+    def toConfigString(self):
+        return lvmconfigparser.LvmConfigParser(self).toConfigString()
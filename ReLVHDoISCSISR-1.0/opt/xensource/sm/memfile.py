@@ -0,0 +1,119 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Files held in memory, passed by path to the tools run by the driver
+#
+
+import os
+import tempfile
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+SHM_DIR = '/dev/shm'
+
+MFD_CLOEXEC = 0x0001
+# memfd_create is missing from older C libraries
+_MEMFD_SYSCALLS = {'x86_64': 319, 'i386': 356, 'i686': 356}
+
+_libc = None
+
+
+def _memfdCreate(name):
+    """
+    :return: file descriptor of a new memfd, None if the kernel or python
+    cannot create one
+    """
+
+    global _libc
+
+    if ctypes is None:
+        return None
+
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(None)
+        if hasattr(_libc, 'memfd_create'):
+            fd = _libc.memfd_create(name, MFD_CLOEXEC)
+        else:
+            syscall = _MEMFD_SYSCALLS.get(os.uname()[4])
+            if syscall is None:
+                return None
+            fd = _libc.syscall(syscall, name, MFD_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+    return fd
+
+
+def _tempDir():
+    if os.path.isdir(SHM_DIR):
+        return SHM_DIR
+    return None
+
+
+class MemFile(object):
+    """ A regular file held in memory: a memfd, or an unlinked file on tmpfs
+    where memfds are not available. The tools open it through the /proc path
+    of the descriptor, and the LVM tools accept it since it is a regular
+    file, unlike a pipe. """
+
+    def __init__(self, name):
+        self.fd = _memfdCreate(name)
+        if self.fd is None:
+            self.fd, path = tempfile.mkstemp(prefix=name, dir=_tempDir())
+            os.unlink(path)
+        # the descriptor is not inherited, the tools reopen it by path
+        self.path = '/proc/%d/fd/%d' % (os.getpid(), self.fd)
+
+    def open(self, mode='r'):
+        """
+        :return: file object reading or writing the file from its start
+        """
+
+        os.lseek(self.fd, 0, 0)
+        return os.fdopen(os.dup(self.fd), mode)
+
+    def read(self):
+        """
+        :return: the content of the file
+        """
+
+        fd = self.open()
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def mkdtemp():
+    """
+    Creates a private directory for the files written by tools which cannot
+    write to a MemFile, on tmpfs when it is available
+    :return: path of the directory
+    """
+
+    return tempfile.mkdtemp(prefix='SMresign-', dir=_tempDir())
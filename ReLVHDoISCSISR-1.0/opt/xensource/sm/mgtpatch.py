@@ -0,0 +1,218 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Patches the SR metadata of the MGT volume in place. The metadata, as laid
+# out by srmetadata, is a header sector, the SR info up to sector 4, then
+# one record of 2 sectors per VDI. The uuid fields have a fixed width, so
+# they are rewritten in the sectors holding them and no record moves.
+#
+
+import os
+import re
+
+SECTOR_SIZE = 512
+HDR_STRING = 'XSSM'
+HEADER_SEP = ':'
+SR_INFO_SIZE = 4 * SECTOR_SIZE
+VDI_INFO_SIZE = 2 * SECTOR_SIZE
+
+UUID_TAG = 'uuid'
+IS_A_SNAPSHOT_TAG = 'is_a_snapshot'
+SNAPSHOT_OF_TAG = 'snapshot_of'
+VDI_DELETED_TAG = 'deleted'
+
+_UUID_LEN = 36
+_FIELD_RES = {}
+
+
+class MgtFormatError(Exception):
+    pass
+
+
+def _fieldRe(tag):
+    if tag not in _FIELD_RES:
+        _FIELD_RES[tag] = re.compile('<%s>([^<]*)</%s>' % (tag, tag))
+    return _FIELD_RES[tag]
+
+
+def readLength(header):
+    """
+    :param header: first sector of the MGT volume
+    :return: length of the metadata in use, header included
+    """
+
+    fields = header.rstrip('\x00 ').split(HEADER_SEP)
+    try:
+        if fields[0] != HDR_STRING:
+            raise ValueError(fields[0])
+        length = int(fields[1])
+    except (IndexError, ValueError):
+        raise MgtFormatError("Invalid metadata header")
+    if length < SR_INFO_SIZE or (length - SR_INFO_SIZE) % VDI_INFO_SIZE:
+        raise MgtFormatError("Invalid metadata length %d" % length)
+    return length
+
+
+def readSrUuid(fd, offset=0):
+    """
+    Reads the uuid of the SR record, without reading the VDI records
+    :param fd: file descriptor of the MGT volume, or of the PV holding it
+    :param offset: offset of the MGT volume in fd
+    :return: uuid of the SR
+    """
+
+    os.lseek(fd, offset, 0)
+    data = os.read(fd, 2 * SECTOR_SIZE)
+    if len(data) != 2 * SECTOR_SIZE:
+        raise MgtFormatError("Short read at %d" % offset)
+    readLength(data[:SECTOR_SIZE])
+
+    uuids = _fieldRe(UUID_TAG).findall(data[SECTOR_SIZE:])
+    if len(uuids) != 1:
+        raise MgtFormatError("%d SR uuids in the SR record" % len(uuids))
+    return uuids[0]
+
+
+class VdiRecord(object):
+
+    __slots__ = ('offset', 'uuid', 'is_a_snapshot', 'snapshot_of', 'deleted')
+
+    def __init__(self, offset, uuid, is_a_snapshot, snapshot_of, deleted):
+        self.offset = offset
+        self.uuid = uuid
+        self.is_a_snapshot = is_a_snapshot
+        self.snapshot_of = snapshot_of
+        self.deleted = deleted
+
+
+class MgtMetadata(object):
+    """ The SR metadata read from the MGT volume, whose changed sectors are
+    written back by write """
+
+    def __init__(self, fd, offset=0):
+        """
+        Reads the metadata in use, the header gives its length
+        :param fd: file descriptor of the MGT volume opened for reading and
+        writing, or of the PV holding it when the metadata is only read
+        :param offset: offset of the MGT volume in fd
+        """
+
+        self.fd = fd
+        self.offset = offset
+        header = self._pread(SECTOR_SIZE, 0)
+        self.length = length = readLength(header)
+
+        data = header + self._pread(length - SECTOR_SIZE, SECTOR_SIZE)
+        # a string per sector, a patch rebuilds only the sector it changes
+        self.sectors = [data[offset:offset + SECTOR_SIZE]
+                        for offset in range(0, length, SECTOR_SIZE)]
+        self.dirty = set()
+
+        self.sr_uuid = self._getField(SECTOR_SIZE, UUID_TAG)
+        self.records = []
+        for offset in range(SR_INFO_SIZE, length, VDI_INFO_SIZE):
+            # the name fields fill the first sector, the others the second
+            sector = offset + SECTOR_SIZE
+            self.records.append(VdiRecord(
+                offset, self._getField(sector, UUID_TAG),
+                self._getField(sector, IS_A_SNAPSHOT_TAG) == '1',
+                self._getField(sector, SNAPSHOT_OF_TAG),
+                self._getField(sector, VDI_DELETED_TAG) == '1'))
+
+    def _pread(self, size, offset):
+        os.lseek(self.fd, self.offset + offset, 0)
+        data = os.read(self.fd, size)
+        if len(data) != size:
+            raise MgtFormatError("Short read at %d" % offset)
+        return data
+
+    def _findField(self, sector, tag):
+        """
+        :return: (start, end) offsets of the value of a field in the sector
+        """
+
+        text = self.sectors[sector / SECTOR_SIZE]
+        matches = list(_fieldRe(tag).finditer(text))
+        if len(matches) != 1:
+            raise MgtFormatError("%d fields %s in sector %d" %
+                                 (len(matches), tag, sector / SECTOR_SIZE))
+        return matches[0].start(1), matches[0].end(1)
+
+    def _getField(self, sector, tag):
+        start, end = self._findField(sector, tag)
+        return self.sectors[sector / SECTOR_SIZE][start:end]
+
+    def _setField(self, sector, tag, value):
+        start, end = self._findField(sector, tag)
+        if end - start != len(value):
+            raise MgtFormatError("Field %s of sector %d is not %d bytes" %
+                                 (tag, sector / SECTOR_SIZE, len(value)))
+        text = self.sectors[sector / SECTOR_SIZE]
+        if text[start:end] != value:
+            self.sectors[sector / SECTOR_SIZE] = \
+                text[:start] + value + text[end:]
+            self.dirty.add(sector)
+
+    def setSrUuid(self, uuid):
+        assert len(uuid) == _UUID_LEN, "Invalid uuid %s" % uuid
+        self._setField(SECTOR_SIZE, UUID_TAG, uuid)
+        self.sr_uuid = uuid
+
+    def setUuid(self, record, uuid):
+        assert len(uuid) == _UUID_LEN, "Invalid uuid %s" % uuid
+        self._setField(record.offset + SECTOR_SIZE, UUID_TAG, uuid)
+        record.uuid = uuid
+
+    def setSnapshotOf(self, record, uuid):
+        assert len(uuid) == _UUID_LEN, "Invalid uuid %s" % uuid
+        self._setField(record.offset + SECTOR_SIZE, SNAPSHOT_OF_TAG, uuid)
+        record.snapshot_of = uuid
+
+    def delete(self, record):
+        """
+        Marks a record deleted, as srmetadata deletes VDIs
+        """
+
+        self._setField(record.offset + SECTOR_SIZE, VDI_DELETED_TAG, '1')
+        record.deleted = True
+
+    def write(self):
+        """
+        Writes the changed sectors, contiguous sectors in a single write
+        :return: number of bytes written
+        """
+
+        written = 0
+        sectors = sorted(self.dirty)
+        i = 0
+        while i < len(sectors):
+            start = end = sectors[i]
+            i += 1
+            while i < len(sectors) and sectors[i] == end + SECTOR_SIZE:
+                end = sectors[i]
+                i += 1
+            data = ''.join(self.sectors[start / SECTOR_SIZE:
+                                        end / SECTOR_SIZE + 1])
+            os.lseek(self.fd, self.offset + start, 0)
+            if os.write(self.fd, data) != len(data):
+                raise MgtFormatError("Short write at %d" % start)
+            written += len(data)
+
+        if written:
+            os.fsync(self.fd)
+        self.dirty = set()
+        return written
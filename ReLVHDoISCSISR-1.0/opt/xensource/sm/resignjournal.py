@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Journal of a resign, kept on the LUN so an interrupted resign can be
+# resumed. The journal is a region of the PV holding a magic line followed
+# by JSON lines: the plan of the resign, then one line per completed phase.
+#
+
+import os
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+SECTOR_SIZE = 512
+MAGIC = 'SMRESIGNJOURNAL 1\n'
+
+
+class JournalError(Exception):
+    pass
+
+
+class ResignJournal(object):
+    """ A journal in the region [offset, offset + size) of a device. Entries
+    are appended; a torn last entry, left by a crash while it was written,
+    is ignored. """
+
+    def __init__(self, fd, offset, size):
+        """
+        :param fd: file descriptor of the device opened for reading and
+        writing, closed by close
+        :param offset: offset of the region, aligned to a sector
+        :param size: size of the region
+        """
+
+        assert offset % SECTOR_SIZE == 0, "Unaligned journal"
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        # offset of the end of the journal in the region, and the content of
+        # its sector
+        self.end = 0
+        self.tail = ''
+
+    def read(self):
+        """
+        :return: list of the entries of the journal, empty if the region
+        holds no journal
+        """
+
+        os.lseek(self.fd, self.offset, 0)
+        data = os.read(self.fd, self.size)
+        if data[:len(MAGIC)] != MAGIC:
+            return []
+
+        data = data.split('\0', 1)[0]
+        entries = []
+        end = len(MAGIC)
+        for line in data[len(MAGIC):].split('\n'):
+            if not line:
+                break
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # torn write of the last entry
+                break
+            end += len(line) + 1
+
+        self._setEnd(data[:end])
+        return entries
+
+    def _setEnd(self, data):
+        self.end = len(data)
+        self.tail = data[self.end - self.end % SECTOR_SIZE:]
+
+    def _write(self, data):
+        """
+        Appends data at the end of the journal. The sectors written are
+        padded with zeros, which end the journal.
+        """
+
+        start = self.end - len(self.tail)
+        block = self.tail + data
+        padded = block + '\0' * (-len(block) % SECTOR_SIZE)
+        if start + len(padded) > self.size:
+            raise JournalError("Journal full")
+
+        os.lseek(self.fd, self.offset + start, 0)
+        if os.write(self.fd, padded) != len(padded):
+            raise JournalError("Short write of the journal")
+        os.fsync(self.fd)
+
+        self.end = start + len(block)
+        self.tail = block[len(block) - len(block) % SECTOR_SIZE:]
+
+    def start(self, entry):
+        """
+        Starts a new journal
+        :param entry: first entry, the plan of the resign
+        """
+
+        self.end = 0
+        self.tail = ''
+        self._write(MAGIC + json.dumps(entry) + '\n')
+
+    def append(self, entry):
+        self._write(json.dumps(entry) + '\n')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Wall time, process spawns and I/O of the phases of a resign
+#
+
+import os
+import time
+import threading
+import subprocess
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+PROC_IO = '/proc/self/io'
+IO_COUNTERS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+# the metrics of the resign run by each thread
+_local = threading.local()
+# the metrics of the resigns in progress in the process, the LUNs of a batch
+_running = []
+_runningLock = threading.Lock()
+_installLock = threading.Lock()
+_Popen = subprocess.Popen
+
+
+class _CountingPopen(_Popen):
+    """ Counts the processes spawned for the metrics of the calling thread.
+    util.pread, util.doexec and the tools calling them all create their
+    processes through subprocess.Popen. """
+
+    def __init__(self, *args, **kwargs):
+        _Popen.__init__(self, *args, **kwargs)
+        metrics = current()
+        if metrics:
+            metrics.countSpawn()
+            _local.spawns = getattr(_local, 'spawns', 0) + 1
+
+
+def install():
+    """
+    Makes subprocess.Popen count the spawned processes
+    """
+
+    _installLock.acquire()
+    try:
+        subprocess.Popen = _CountingPopen
+    finally:
+        _installLock.release()
+
+
+def current():
+    """
+    :return: the ResignMetrics of the calling thread, or None
+    """
+
+    return getattr(_local, 'metrics', None)
+
+
+def activate(metrics):
+    """
+    Sets the ResignMetrics of the calling thread
+    :param metrics: ResignMetrics, or None
+    """
+
+    _local.metrics = metrics
+
+
+def bind(func):
+    """
+    :return: func, set to run with the metrics of the calling thread, for
+    the threads of a workerpool
+    """
+
+    metrics = current()
+
+    def bound(*args):
+        previous = current()
+        activate(metrics)
+        try:
+            return func(*args)
+        finally:
+            activate(previous)
+
+    return bound
+
+
+def countIo(read_bytes, write_bytes):
+    """
+    Counts the bytes read and written in process by the calling thread, for
+    the steps of the LVs it runs. The I/O of the spawned tools is not
+    counted.
+    """
+
+    _local.read_bytes = getattr(_local, 'read_bytes', 0) + read_bytes
+    _local.write_bytes = getattr(_local, 'write_bytes', 0) + write_bytes
+
+
+def readIo():
+    """
+    :return: dict of the I/O counters of the process, which include the
+    reaped children. The counters are 0 when they are not available.
+    """
+
+    counters = dict.fromkeys(IO_COUNTERS, 0)
+    try:
+        fd = open(PROC_IO)
+        try:
+            for line in fd:
+                key, value = line.split(':', 1)
+                if key in counters:
+                    counters[key] = int(value)
+        finally:
+            fd.close()
+    except (IOError, ValueError):
+        pass
+    return counters
+
+
+def _ioDelta(start, end):
+    return dict([(key, end[key] - start[key]) for key in IO_COUNTERS])
+
+
+class ResignMetrics(object):
+    """ Metrics of the resign of one LUN. The I/O counters of the resign and
+    of its phases are those of the whole process: the io_scope of the record
+    is 'process' if the resigns of other LUNs ran at the same time and
+    overlap in them, 'lun' if the resign ran alone. """
+
+    def __init__(self, sr_uuid, device):
+        self.sr_uuid = sr_uuid
+        self.device = device
+        self.phases = []
+        self.lvs = {}
+        self.spawns = 0
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.startIo = readIo()
+        self.shared = False
+
+        _runningLock.acquire()
+        try:
+            for metrics in _running:
+                metrics.shared = True
+            self.shared = bool(_running)
+            _running.append(self)
+        finally:
+            _runningLock.release()
+
+    def finish(self):
+        """
+        Ends the resign, whose I/O no longer overlaps the next ones
+        """
+
+        _runningLock.acquire()
+        try:
+            if self in _running:
+                _running.remove(self)
+        finally:
+            _runningLock.release()
+
+    def countSpawn(self):
+        self.lock.acquire()
+        try:
+            self.spawns += 1
+        finally:
+            self.lock.release()
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs a phase of the resign and records its metrics
+        :param name: name of the phase
+        :return: the value returned by func
+        """
+
+        start = time.time()
+        spawns = self.spawns
+        io = readIo()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            phase = _ioDelta(io, readIo())
+            phase['name'] = name
+            phase['seconds'] = time.time() - start
+            phase['spawns'] = self.spawns - spawns
+            self.lock.acquire()
+            try:
+                self.phases.append(phase)
+            finally:
+                self.lock.release()
+
+    def runLv(self, lv_name, step, func, *args):
+        """
+        Runs a step of the resign of an LV and records its wall time, the
+        processes it spawned and the bytes it read and wrote, see countIo
+        :param lv_name: name of the LV
+        :param step: name of the step
+        :return: the value returned by func
+        """
+
+        start = time.time()
+        spawns = getattr(_local, 'spawns', 0)
+        read_bytes = getattr(_local, 'read_bytes', 0)
+        write_bytes = getattr(_local, 'write_bytes', 0)
+        try:
+            return func(*args)
+        finally:
+            lv_step = {
+                'seconds': time.time() - start,
+                'spawns': getattr(_local, 'spawns', 0) - spawns,
+                'read_bytes': getattr(_local, 'read_bytes', 0) - read_bytes,
+                'write_bytes': getattr(_local, 'write_bytes', 0) - write_bytes}
+            self.lock.acquire()
+            try:
+                self.lvs.setdefault(lv_name, {})[step] = lv_step
+            finally:
+                self.lock.release()
+
+    def toRecord(self, outcome=None, error=None):
+        """
+        :param outcome: outcome of the resign, recorded as its status
+        :param error: exception which ended the resign, None if it succeeded
+        :return: dict of the metrics
+        """
+
+        record = _ioDelta(self.startIo, readIo())
+        record.update({
+            'sr_uuid': self.sr_uuid,
+            'device': self.device,
+            'start': self.start,
+            'seconds': time.time() - self.start,
+            'spawns': self.spawns,
+            'io_scope': self.shared and 'process' or 'lun',
+            'status': error is None and outcome or 'failed',
+            'phases': self.phases,
+            'lvs': self.lvs})
+        if error is not None:
+            record['error'] = str(error)
+        return record
+
+    def write(self, path, outcome=None, error=None):
+        """
+        Appends the metrics to a file, as one line of JSON
+        :param path: path of the file
+        :param outcome: outcome of the resign, recorded as its status
+        :param error: exception which ended the resign, None if it succeeded
+        """
+
+        line = json.dumps(self.toRecord(outcome, error)) + '\n'
+        fd = open(path, 'a')
+        try:
+            fd.write(line)
+        finally:
+            fd.close()
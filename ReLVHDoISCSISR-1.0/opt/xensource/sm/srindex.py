@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Host-local index of the VDILUNSR SRs, the uuid of the SR of each target.
+# It saves the lookups of sr-create and sr-probe from reading the records of
+# every SR of the pool. The index is a cache: an entry is checked against
+# XAPI before it is used, as an SR forgotten by XAPI, or created from
+# another host, does not reach the driver of this host.
+#
+
+import os
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+INDEX_FILE = '/var/run/sm/vdilun-srs'
+
+
+class SrIndex(object):
+    """ The uuid of the SR of each target. Concurrent updates may lose an
+    entry, which is found again from XAPI. """
+
+    def __init__(self, path=None):
+        """
+        :param path: file of the index, INDEX_FILE by default
+        """
+
+        self.path = path or INDEX_FILE
+
+    def _read(self):
+        try:
+            fd = open(self.path)
+        except IOError:
+            return {}
+        try:
+            try:
+                return json.load(fd)
+            except ValueError:
+                return {}
+        finally:
+            fd.close()
+
+    def _write(self, entries):
+        index_dir = os.path.dirname(self.path)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        fd = open(temp_path, 'w')
+        try:
+            json.dump(entries, fd)
+        finally:
+            fd.close()
+        os.rename(temp_path, self.path)
+
+    def lookup(self, target):
+        """
+        :return: uuid of the SR of a target, None if the index has none
+        """
+
+        sr_uuid = self._read().get(target)
+        return sr_uuid and str(sr_uuid) or None
+
+    def update(self, entries):
+        """
+        Adds entries to the index
+        :param entries: dict of SR uuids, by target
+        """
+
+        index = self._read()
+        if [target for target in entries
+                if index.get(target) != entries[target]]:
+            index.update(entries)
+            self._write(index)
+
+    def remove(self, target, sr_uuid=None):
+        """
+        Removes the entry of a target
+        :param sr_uuid: only remove the entry if it is of this SR
+        """
+
+        index = self._read()
+        if target in index and sr_uuid in (None, index[target]):
+            del index[target]
+            self._write(index)
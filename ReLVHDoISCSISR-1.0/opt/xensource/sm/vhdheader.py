@@ -0,0 +1,303 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Reads the footer and dynamic header of VHD images and rewrites their parent,
+# without vhd-util
+#
+
+import os
+import struct
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+
+FOOTER_COOKIE = 'conectix'
+HEADER_COOKIE = 'cxsparse'
+
+DISK_TYPE_FIXED = 2
+DISK_TYPE_DYNAMIC = 3
+DISK_TYPE_DIFF = 4
+
+# platform codes of the parent locators which hold the parent path
+PLAT_CODE_MACX = 0x4D616358     # file URL, UTF-8
+PLAT_CODE_W2KU = 0x57326B75     # absolute path, UTF-16LE
+PLAT_CODE_W2RU = 0x57327275     # relative path, UTF-16LE
+
+_LOCATOR_ENCODINGS = {
+    PLAT_CODE_MACX: 'utf-8',
+    PLAT_CODE_W2KU: 'utf-16-le',
+    PLAT_CODE_W2RU: 'utf-16-le',
+}
+
+# footer fields
+_FOOTER_DATA_OFFSET = 16        # u64, offset of the dynamic header
+_FOOTER_DISK_TYPE = 60          # u32
+_FOOTER_CHECKSUM = 64           # u32
+_FOOTER_UUID = 68               # 16 bytes
+_FOOTER_HIDDEN = 85             # u8, set by vhd-util on hidden VHDs
+
+# dynamic header fields
+_HEADER_CHECKSUM = 36           # u32
+_HEADER_PARENT_UUID = 40        # 16 bytes
+_HEADER_PARENT_NAME = 64        # 512 bytes of UTF-16BE
+_HEADER_PARENT_NAME_SIZE = 512
+_HEADER_LOCATORS = 576          # 8 entries
+_LOCATOR_FORMAT = '>IIIIQ'      # code, data space, data length, reserved,
+                                # data offset
+_LOCATOR_SIZE = struct.calcsize(_LOCATOR_FORMAT)
+_LOCATOR_COUNT = 8
+
+# length of 'VHD-<uuid>', the end of the parent names set by LVHD
+_PARENT_LV_NAME_LEN = 40
+
+
+class VhdFormatError(Exception):
+    pass
+
+
+class ParentLocator(object):
+
+    __slots__ = ('index', 'code', 'data_space', 'data_len', 'data_offset')
+
+    def __init__(self, index, code, data_space, data_len, data_offset):
+        self.index = index
+        self.code = code
+        self.data_space = data_space
+        self.data_len = data_len
+        self.data_offset = data_offset
+
+    def getSpace(self):
+        """
+        :return: size in bytes of the space reserved for the locator data.
+        Older images give it in bytes rather than in sectors.
+        """
+
+        if self.data_space < SECTOR_SIZE:
+            return self.data_space * SECTOR_SIZE
+        return self.data_space
+
+
+class VhdHeader(object):
+    """ The footer and dynamic header fields of a VHD that the resign needs """
+
+    __slots__ = ('disk_type', 'hidden', 'uuid', 'header_offset', 'header',
+                 'parent_uuid', 'parent_name', 'locators', 'bytes_read')
+
+    def __init__(self, disk_type, hidden, uuid):
+        self.disk_type = disk_type
+        self.hidden = hidden
+        self.uuid = uuid
+        self.header_offset = None
+        self.header = None          # raw dynamic header
+        self.parent_uuid = None
+        self.parent_name = None
+        self.locators = []
+        self.bytes_read = 0         # read from the image by readHeader
+
+    def getParentLvName(self):
+        """
+        :return: the name of the parent LV, as returned by
+        vhdutil._getVHDParentNoCheck, or None if the VHD has no parent
+        """
+
+        if self.disk_type != DISK_TYPE_DIFF or not self.parent_name:
+            return None
+        return _parentLvName(self.parent_name)
+
+
+def _parentLvName(path):
+    return path.replace('--', '-')[-_PARENT_LV_NAME_LEN:]
+
+
+def _pread(fd, size, offset):
+    os.lseek(fd, offset, 0)
+    data = os.read(fd, size)
+    if len(data) != size:
+        raise VhdFormatError("Short read at %d" % offset)
+    return data
+
+
+def _pwrite(fd, data, offset):
+    os.lseek(fd, offset, 0)
+    if os.write(fd, data) != len(data):
+        raise VhdFormatError("Short write at %d" % offset)
+
+
+def _checksum(data, checksum_offset):
+    """
+    :return: the VHD checksum of a footer or header, the one's complement of
+    the sum of its bytes without the checksum field
+    """
+
+    total = sum(map(ord, data))
+    total -= sum(map(ord, data[checksum_offset:checksum_offset + 4]))
+    return ~total & 0xffffffff
+
+
+def _unpack(fmt, data, offset):
+    return struct.unpack(fmt, data[offset:offset + struct.calcsize(fmt)])
+
+
+def _splice(data, offset, value):
+    """
+    :return: data with the bytes at offset replaced by value
+    """
+
+    return data[:offset] + value + data[offset + len(value):]
+
+
+def readHeader(fd, offset=0):
+    """
+    Reads the footer copy and the dynamic header at the start of a VHD. LVHD
+    images keep the dynamic header right after the footer copy, so both are
+    read at once.
+    :param fd: file descriptor of the image, or of the device it lies on
+    :param offset: offset of the image in fd
+    :return: VhdHeader, or None if there is no VHD at offset
+    """
+
+    data = _pread(fd, FOOTER_SIZE + HEADER_SIZE, offset)
+    if data[:len(FOOTER_COOKIE)] != FOOTER_COOKIE:
+        return None
+
+    footer = data[:FOOTER_SIZE]
+    (checksum,) = _unpack('>I', footer, _FOOTER_CHECKSUM)
+    if checksum != _checksum(footer, _FOOTER_CHECKSUM):
+        raise VhdFormatError("Invalid footer checksum")
+
+    (disk_type,) = _unpack('>I', data, _FOOTER_DISK_TYPE)
+    vhd = VhdHeader(disk_type, ord(data[_FOOTER_HIDDEN]) != 0,
+                    data[_FOOTER_UUID:_FOOTER_UUID + 16])
+    vhd.bytes_read = len(data)
+
+    if disk_type == DISK_TYPE_FIXED:
+        return vhd
+
+    (header_offset,) = _unpack('>Q', data, _FOOTER_DATA_OFFSET)
+    if header_offset == FOOTER_SIZE:
+        header = data[FOOTER_SIZE:]
+    else:
+        header = _pread(fd, HEADER_SIZE, offset + header_offset)
+        vhd.bytes_read += HEADER_SIZE
+
+    if header[:len(HEADER_COOKIE)] != HEADER_COOKIE:
+        raise VhdFormatError("Invalid dynamic header cookie")
+
+    (checksum,) = _unpack('>I', header, _HEADER_CHECKSUM)
+    if checksum != _checksum(header, _HEADER_CHECKSUM):
+        raise VhdFormatError("Invalid dynamic header checksum")
+
+    vhd.header_offset = header_offset
+    vhd.header = header
+    vhd.parent_uuid = header[_HEADER_PARENT_UUID:_HEADER_PARENT_UUID + 16]
+
+    parent_name = header[_HEADER_PARENT_NAME:
+                         _HEADER_PARENT_NAME + _HEADER_PARENT_NAME_SIZE]
+    parent_name = parent_name.decode('utf-16-be').split(u'\x00', 1)[0]
+    vhd.parent_name = parent_name.encode('utf-8')
+
+    for i in range(_LOCATOR_COUNT):
+        code, data_space, data_len, _reserved, data_offset = \
+            _unpack(_LOCATOR_FORMAT, header,
+                    _HEADER_LOCATORS + i * _LOCATOR_SIZE)
+        if code in _LOCATOR_ENCODINGS:
+            vhd.locators.append(ParentLocator(i, code, data_space, data_len,
+                                              data_offset))
+
+    return vhd
+
+
+def _replace(text, replacements):
+    for old, new in replacements:
+        text = text.replace(old, new)
+    return text
+
+
+def setParent(fd, vhd, parent_uuid, replacements, parent_lv_name, offset=0):
+    """
+    Points a differencing VHD to a renamed parent, as vhd-util modify -p
+    would: the parent uuid is set, and the parent name and the paths in the
+    parent locators are rewritten. Every path must name the old parent; the
+    substitutions keep their length, so the locators are rewritten in place.
+    Nothing is written if the VHD does not have the expected layout.
+    :param fd: file descriptor of the image opened for writing
+    :param vhd: VhdHeader read from fd
+    :param parent_uuid: uuid in the footer of the parent
+    :param replacements: list of (old, new) substitutions turning the old
+    parent paths into the new ones
+    :param parent_lv_name: name of the parent LV, which every rewritten path
+    must end with
+    :param offset: offset of the image in fd
+    :return: (bytes read, bytes written)
+    """
+
+    if vhd.disk_type != DISK_TYPE_DIFF:
+        raise VhdFormatError("Not a differencing VHD")
+
+    header = vhd.header
+    writes = []
+    bytes_read = 0
+
+    parent_name = _replace(vhd.parent_name, replacements)
+    if _parentLvName(parent_name) != parent_lv_name:
+        raise VhdFormatError("Unexpected parent name %s" % vhd.parent_name)
+
+    encoded = parent_name.decode('utf-8').encode('utf-16-be')
+    if len(encoded) > _HEADER_PARENT_NAME_SIZE:
+        raise VhdFormatError("Parent name too long")
+    header = _splice(header, _HEADER_PARENT_NAME,
+                     encoded.ljust(_HEADER_PARENT_NAME_SIZE, '\x00'))
+    header = _splice(header, _HEADER_PARENT_UUID, parent_uuid)
+
+    for loc in vhd.locators:
+        encoding = _LOCATOR_ENCODINGS[loc.code]
+        data = _pread(fd, loc.data_len, offset + loc.data_offset)
+        bytes_read += loc.data_len
+        path = data.decode(encoding).rstrip(u'\x00').encode('utf-8')
+        new_path = _replace(path, replacements)
+        if _parentLvName(new_path) != parent_lv_name:
+            raise VhdFormatError("Unexpected parent locator %s" % path)
+
+        new_data = new_path.decode('utf-8').encode(encoding)
+        if len(new_data) > loc.getSpace():
+            raise VhdFormatError("Parent locator too long")
+
+        if len(new_data) != loc.data_len:
+            header = _splice(header,
+                             _HEADER_LOCATORS + loc.index * _LOCATOR_SIZE + 8,
+                             struct.pack('>I', len(new_data)))
+        # the old data is overwritten in full, so no stale bytes remain
+        writes.append((loc, new_data.ljust(max(loc.data_len, len(new_data)), '\x00'),
+                       len(new_data)))
+
+    header = _splice(header, _HEADER_CHECKSUM,
+                     struct.pack('>I', _checksum(header, _HEADER_CHECKSUM)))
+
+    # the locators first, the header makes the change visible
+    bytes_written = len(header)
+    for loc, data, data_len in writes:
+        _pwrite(fd, data, offset + loc.data_offset)
+        loc.data_len = data_len
+        bytes_written += len(data)
+    _pwrite(fd, header, offset + vhd.header_offset)
+    os.fsync(fd)
+
+    vhd.header = header
+    vhd.parent_uuid = parent_uuid
+    vhd.parent_name = parent_name
+    return bytes_read, bytes_written
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Bounded pool of threads running blocking calls (subprocesses, disk and
+# network I/O) concurrently
+#
+
+import sys
+import threading
+
+
+class WorkResult(object):
+    """ Outcome of a call made by the pool """
+
+    __slots__ = ('item', 'value', 'error')
+
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.error = None  # exc_info of the exception raised by the call
+
+    def get(self):
+        """
+        :return: the value returned by the call, raises its exception if it
+        failed
+        """
+
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+def run(func, items, workers):
+    """
+    Calls func(item) for every item, on at most workers threads. Exceptions
+    are caught and kept in the results, so every item is processed.
+    :param func: function to call
+    :param items: list of arguments for func
+    :param workers: maximum number of concurrent calls
+    :return: list of WorkResult, in the order of items
+    """
+
+    results = [WorkResult(item) for item in items]
+    pending = range(len(results))
+    pending.reverse()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                result = results[pending.pop()]
+            finally:
+                lock.release()
+
+            try:
+                result.value = func(result.item)
+            except:
+                result.error = sys.exc_info()
+
+    workers = min(workers, len(results))
+    if workers <= 1:
+        worker()
+        return results
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def runAll(func, items, workers):
+    """
+    Same as run, but raises the exception of the first failed call once all
+    calls are done
+    :return: list of the values returned by func, in the order of items
+    """
+
+    return [result.get() for result in run(func, items, workers)]
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Boots a storm of VMs on VDILUNSR VDIs, one per target, with the SM
+# framework, XAPI and iscsiadm replaced by the stand-ins of fakesm, and
+# reports the percentiles of the latency of their vdi-attach. Each attach
+# runs in its own SM process, all at once, as xapi runs them. Every
+# emulated command spawns a process; --cmd-delay adds the latency of the
+# real iscsiadm to each of them, and --udev-delay the random time udev takes
+# to link the LUN of a login under /dev/iscsi, which the attach waits for.
+#
+# The storm is run as is, then after the prepare call of the vdilun host
+# plugin logged in to all the targets, which leaves each attach a lookup.
+#
+# Usage: python attach_bench.py [options], see --help
+#
+
+import os
+import imp
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import uuid as uuidlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import lvmgen
+from resign_bench import run_forked
+from session_bench import fake_host, sm_call, SR_UUID, TARGET, PORT
+
+PLUGIN = os.path.normpath(os.path.join(lvmgen.SM_DIR, os.pardir, os.pardir,
+                                      os.pardir, 'etc', 'xapi.d', 'plugins',
+                                      'vdilun'))
+IQN_FORMAT = 'iqn.2017-10.com.example:vm-%04d'
+GRACE = 60
+
+
+def attach(base_dir, delays, vdi_uuid, iqn):
+    import fakehost
+    fakehost.CMD_DELAY, fakehost.UDEV_DELAY = delays
+    return sm_call(base_dir, GRACE, 'attach', vdi_uuid, True, iqn)
+
+
+def prepare(base_dir, delays, vdis, workers):
+    """
+    Runs the prepare call of the plugin
+    :param delays: (cmd_delay, udev_delay) of the fake host
+    :param vdis: list of (vdi_uuid, iqn)
+    :return: seconds taken by the call
+    """
+
+    fake_host(base_dir)
+
+    import fakehost
+    import fakexapi
+
+    fakehost.CMD_DELAY, fakehost.UDEV_DELAY = delays
+    dconf = {'target': TARGET, 'port': str(PORT), 'SRmaster': 'true'}
+    fakexapi.pool = fakexapi.Pool()
+    sr_ref = fakexapi.pool.addSr(SR_UUID, dconf)
+    for vdi_uuid, iqn in vdis:
+        fakexapi.pool.vdis['OpaqueRef:%s' % vdi_uuid] = {
+            'uuid': vdi_uuid, 'location': iqn, 'SR': sr_ref}
+
+    plugin = imp.load_source('vdilun', PLUGIN)
+    start = time.time()
+    report = json.loads(plugin.prepare(
+        fakexapi.Session(fakexapi.pool),
+        {'vdi_uuids': ','.join([vdi_uuid for vdi_uuid, _iqn in vdis]),
+         'grace': str(GRACE), 'workers': str(workers)}))
+    seconds = time.time() - start
+    failed = [entry for entry in report.values() if 'path' not in entry]
+    assert not failed, failed
+    return seconds
+
+
+def storm(base_dir, delays, vdis):
+    """
+    Runs the attach of every VDI at once, each in its own process
+    :return: list of the seconds taken by each attach
+    """
+
+    children = []
+    for vdi_uuid, iqn in vdis:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                try:
+                    os.close(read_fd)
+                    os.write(write_fd, json.dumps(
+                        attach(base_dir, delays, vdi_uuid, iqn)))
+                    status = 0
+                except:
+                    import traceback
+                    traceback.print_exc()
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+
+    latencies = []
+    for pid, read_fd in children:
+        data = os.read(read_fd, 4096)
+        os.close(read_fd)
+        _pid, status = os.waitpid(pid, 0)
+        assert status == 0, "Attach failed"
+        latencies.append(json.loads(data))
+    return latencies
+
+
+def count_logins(base_dir):
+    fd = open(os.path.join(base_dir, 'commands'))
+    try:
+        return len([line for line in fd
+                    if line.startswith('iscsiadm ') and ' -l' in line])
+    finally:
+        fd.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(name, vms, latencies, logins, total):
+    print "%-8s %3d VMs: attach p50 %6.3fs p90 %6.3fs p99 %6.3fs max " \
+        "%6.3fs, %3d logins by the attaches, all attached in %6.2fs" % \
+        (name, vms, percentile(latencies, 0.5), percentile(latencies, 0.9),
+         percentile(latencies, 0.99), max(latencies), logins, total)
+    sys.stdout.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--vms', type='int', default=50,
+                      help="VMs booted at once, one VDI each [%default]")
+    parser.add_option('--workers', type='int', default=16,
+                      help="concurrent logins of prepare [%default]")
+    parser.add_option('--cmd-delay', type='float', default=0.05,
+                      help="seconds added to each emulated command "
+                           "[%default]")
+    parser.add_option('--udev-delay', type='float', default=0,
+                      help="most seconds udev takes to link the LUN of a "
+                           "login [%default]")
+    options, _args = parser.parse_args(argv[1:])
+
+    vdis = [(str(uuidlib.uuid4()), IQN_FORMAT % i)
+            for i in range(options.vms)]
+    delays = (options.cmd_delay, options.udev_delay)
+
+    for prepared in (False, True):
+        base_dir = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            if prepared:
+                run_forked(prepare, base_dir, delays, vdis,
+                           options.workers)
+                logins = count_logins(base_dir)
+            else:
+                logins = 0
+            latencies = storm(base_dir, delays, vdis)
+            total = time.time() - start
+            logins = count_logins(base_dir) - logins
+        finally:
+            shutil.rmtree(base_dir)
+        report(prepared and 'prepared' or 'storm', options.vms, latencies,
+               logins, total)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Times the wait of VDILUNSR for the LUN of a target to appear under
+# /dev/iscsi, as udev links it after a login. A process makes the
+# directories of the target and the link to the device after a random
+# delay, and the waiter reports how long after the link appeared it
+# returned. The polling of util.wait_for_path, which the attach used, is
+# compared with devwait, on inotify and on its polling fallback, for a
+# single LUN and for a batch of LUNs waited for at once as the vdilun
+# plugin does.
+#
+# Usage: python devwait_bench.py [options], see --help
+#
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+
+import srgen
+
+import util
+import devwait
+import VDILUNSR
+
+from attach_bench import percentile
+
+IQN_FORMAT = 'iqn.2017-10.com.example:vm-%04d'
+PORTAL = '127.0.0.1:3260'
+
+
+def lun_path(base_dir, i):
+    return os.path.join(base_dir, 'iscsi', IQN_FORMAT % i, PORTAL, 'LUN0')
+
+
+def udev(base_dir, count, max_delay):
+    """
+    Links the LUN of count targets, each after a random delay, in a child
+    process
+    :return: (pid of the child, read end of a pipe giving the time each
+    link appeared)
+    """
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write_fd)
+        return pid, read_fd
+
+    status = 1
+    try:
+        try:
+            os.close(read_fd)
+            # the state of random is inherited from the parent
+            random.seed()
+            device = os.path.join(base_dir, 'sda')
+            open(device, 'w').close()
+            start = time.time()
+            delays = sorted([(random.uniform(0, max_delay), i)
+                             for i in range(count)])
+            times = []
+            for delay, i in delays:
+                time.sleep(max(start + delay - time.time(), 0))
+                path = lun_path(base_dir, i)
+                os.makedirs(os.path.dirname(path))
+                # a waiter may wake before symlink returns
+                times.append('%d %f' % (i, time.time()))
+                os.symlink(device, path)
+            os.write(write_fd, '\n'.join(times))
+            status = 0
+        except:
+            import traceback
+            traceback.print_exc()
+    finally:
+        os._exit(status)
+
+
+def appeared(pid, read_fd):
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    _pid, status = os.waitpid(pid, 0)
+    assert status == 0, "udev failed"
+    times = {}
+    for line in data.splitlines():
+        i, seconds = line.split()
+        times[int(i)] = float(seconds)
+    return times
+
+
+def single(waiter, trials, max_delay):
+    """
+    :return: list of the seconds each wait returned after the link appeared
+    """
+
+    lags = []
+    for _i in range(trials):
+        base_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(base_dir, 'iscsi'))
+            pid, read_fd = udev(base_dir, 1, max_delay)
+            assert waiter(lun_path(base_dir, 0), VDILUNSR.MAX_TIMEOUT), \
+                "LUN not found"
+            returned = time.time()
+            lags.append(returned - appeared(pid, read_fd)[0])
+        finally:
+            shutil.rmtree(base_dir)
+    return lags
+
+
+def batch(count, max_delay):
+    """
+    Waits for count LUNs at once with devwait.waitForPaths
+    :return: seconds the wait returned after the last link appeared
+    """
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(base_dir, 'iscsi'))
+        pid, read_fd = udev(base_dir, count, max_delay)
+        paths = [lun_path(base_dir, i) for i in range(count)]
+        ready = devwait.waitForPaths(paths, VDILUNSR.MAX_TIMEOUT)
+        returned = time.time()
+        assert len(ready) == count, "LUNs not found"
+        return returned - max(appeared(pid, read_fd).values())
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def report(name, lags):
+    print "%-24s %4d waits: returned after the link p50 %6.3fs p90 %6.3fs " \
+        "p99 %6.3fs max %6.3fs" % \
+        (name, len(lags), percentile(lags, 0.5), percentile(lags, 0.9),
+         percentile(lags, 0.99), max(lags))
+    sys.stdout.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--trials', type='int', default=50,
+                      help="waits for a single LUN per waiter [%default]")
+    parser.add_option('--max-delay', type='float', default=1.0,
+                      help="most seconds before a link appears [%default]")
+    parser.add_option('--luns', type='int', default=200,
+                      help="LUNs of the batch [%default]")
+    options, _args = parser.parse_args(argv[1:])
+
+    report('util.wait_for_path', single(util.wait_for_path, options.trials,
+                                        options.max_delay))
+
+    # polled first, as devwait keeps its inotify instances once made
+    ctypes = devwait.ctypes
+    devwait.ctypes = None
+    try:
+        report('devwait polling', single(devwait.waitForPath,
+                                         options.trials, options.max_delay))
+        polled = [batch(options.luns, options.max_delay) for _i in range(5)]
+    finally:
+        devwait.ctypes = ctypes
+
+    report('devwait inotify', single(devwait.waitForPath, options.trials,
+                                     options.max_delay))
+    report('batch %d polling' % options.luns, polled)
+    report('batch %d inotify' % options.luns,
+           [batch(options.luns, options.max_delay) for _i in range(5)])
+
+if __name__ == '__main__':
+    main(sys.argv)
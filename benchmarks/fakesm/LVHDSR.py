@@ -0,0 +1,39 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the LVHDSR module of the SM framework: load creates the LVM
+# cache of the VG and activates its MGT volume
+#
+
+import os
+
+import SR
+import lvmcache
+import fakehost
+from lvhdutil import VG_LOCATION, VG_PREFIX
+from lvutil import MDVOLUME_NAME
+
+
+class LVHDSR(SR.SR):
+
+    def load(self, sr_uuid):
+        self.uuid = sr_uuid
+        self.vgname = VG_PREFIX + sr_uuid
+        self.path = os.path.join(VG_LOCATION, self.vgname)
+        self.lvmCache = lvmcache.LVMCache(self.vgname)
+        self.lvmCache.refresh()
+        if fakehost.host.vg_name == self.vgname:
+            self.lvmCache.activateNoRefcount(MDVOLUME_NAME)
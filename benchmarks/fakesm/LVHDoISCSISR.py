@@ -0,0 +1,51 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the LVHDoISCSISR module of the SM framework: the LUN is the
+# device image of the emulated host
+#
+
+import LVHDSR
+import fakehost
+import iscsilib
+
+
+class _ISCSI(object):
+
+    def __init__(self, dconf, device):
+        self.target = dconf.get('target', '127.0.0.1')
+        self.portal = '%s:%s' % (self.target, dconf.get('port', '3260'))
+        self.targetIQN = dconf.get('targetIQN', 'iqn.2017-10.com.example:lun')
+        self.path = device
+        self.attached = False
+
+    def attach(self, sr_uuid):
+        # the node record, which the discovery of the real attach creates
+        iscsilib.exn_on_failure(["iscsiadm", "-m", "node", "-T",
+                                 self.targetIQN, "-p", self.portal, "-o",
+                                 "new"], "Failed to create the node record.")
+        iscsilib.exn_on_failure(["iscsiadm", "-m", "node", "-T",
+                                 self.targetIQN, "-p", self.portal, "-l"],
+                                "Failed to login to target.")
+        self.attached = True
+
+
+class LVHDoISCSISR(LVHDSR.LVHDSR):
+
+    def load(self, sr_uuid):
+        self.uuid = sr_uuid
+        self.dconf['device'] = fakehost.host.device
+        self.iscsi = _ISCSI(self.dconf, fakehost.host.device)
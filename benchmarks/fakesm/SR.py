@@ -0,0 +1,47 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the SR module of the SM framework, the drivers get a session
+# of the fakexapi pool
+#
+
+import fakexapi
+
+_drivers = []
+
+
+class SR(object):
+
+    def __init__(self, srcmd, sr_uuid):
+        self.srcmd = srcmd
+        self.dconf = srcmd.dconf
+        self.sr_ref = srcmd.params.get('sr_ref')
+        self.session = None
+        if fakexapi.pool:
+            self.session = fakexapi.Session(fakexapi.pool, fakexapi.MARSHAL)
+        self.uuid = sr_uuid
+        self.vdis = {}
+        self.load(sr_uuid)
+
+    def load(self, sr_uuid):
+        pass
+
+    def _db_update(self):
+        pass
+
+
+def registerSR(driver):
+    _drivers.append(driver)
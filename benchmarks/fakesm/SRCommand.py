@@ -0,0 +1,30 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the SRCommand module of the SM framework
+#
+
+
+class SRCommand(object):
+
+    def __init__(self, dconf, cmd='sr_create', params=None):
+        self.dconf = dconf
+        self.cmd = cmd
+        self.params = params or {}
+
+
+def run(driver, driver_info):
+    raise NotImplementedError("The stand-in drivers are run by the harness")
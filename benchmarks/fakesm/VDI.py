@@ -0,0 +1,55 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#
+# Stand-in for the VDI module of the SM framework, the VDI records are the
+# ones of the fakexapi pool
+#
+
+
+class VDI(object):
+
+    def __init__(self, sr, uuid):
+        self.sr = sr
+        self.session = sr.session
+        self.uuid = uuid
+        self.label = ''
+        self.location = ''
+        self.size = 0
+        self.utilisation = 0
+        self.path = None
+        self.ref = None
+        self.load(uuid)
+
+    def load(self, vdi_uuid):
+        pass
+
+    def attach(self, sr_uuid, vdi_uuid):
+        return {'params': self.path}
+
+    def get_params(self):
+        return {'uuid': self.uuid, 'location': self.location,
+                'size': self.size}
+
+    def _db_introduce(self):
+        return self.session.xenapi.VDI.add(
+            {'uuid': self.uuid, 'location': self.location,
+             'name_label': self.label, 'size': str(self.size),
+             'SR': self.sr.sr_ref})
+
+    def _db_forget(self):
+        self.session.xenapi.VDI.remove(self.session.xenapi.VDI.get_by_uuid(
+            self.uuid))
@@ -0,0 +1,34 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#
+# Stand-in for the XenAPIPlugin module of XAPI host plugins
+#
+
+import sys
+
+
+def dispatch(fn_table):
+    """
+    Calls a function of a plugin as host-call-plugin does, with the session
+    of the fakexapi pool: argv holds the name of the function then its
+    arguments as key=value
+    """
+
+    import fakexapi
+
+    args = dict([arg.split('=', 1) for arg in sys.argv[2:]])
+    print fn_table[sys.argv[1]](fakexapi.Session(fakexapi.pool), args)
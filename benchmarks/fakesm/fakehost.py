@@ -0,0 +1,569 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Emulates the LVM, vhd-util and iscsiadm commands run by the driver on a
+# device image file. Activating an LV copies its start out of the image
+# into a file at the LV path, deactivating it copies the sectors changed in
+# the file back, so writes made to the image meanwhile are kept as they are
+# on a real PV.
+#
+# Every emulated command also spawns /bin/true, so the process count and
+# the cost of the spawns stay close to a real host. pvcreate, vgcfgrestore
+# and lvremove write the PV label and metadata area of the image.
+#
+# An iscsiadm login links the LUN0 of the target under iscsi/ of the device
+# directory to an image of luns/, created on the first login, and a logout
+# removes the link. Node records are directories of nodes/, and a login needs
+# the record of its target. A sendtargets discovery lists the images of
+# luns/ as targets. Logged in sessions, and the block devices of their LUN0,
+# are listed under sys/ as in /sys/class. The state is on disk, so it is
+# shared by the processes of a run.
+#
+
+import os
+import re
+import time
+import random
+import zlib
+import shutil
+import threading
+import subprocess
+
+import pvgen
+import lvmconfigparser
+
+SECTOR_SIZE = 512
+# bytes of a VHD LV mapped to its file on activation, the generated VHDs
+# fit in it
+LV_MAP_SIZE = 64 * 1024
+MDVOLUME_NAME = 'MGT'
+
+SPAWN = os.environ.get('FAKESM_SPAWN', '1') == '1'
+# seconds added to every command, to model the latency of the LVM tools
+CMD_DELAY = float(os.environ.get('FAKESM_CMD_DELAY', '0'))
+# upper bound of the random seconds udev takes to link the LUN of a login
+UDEV_DELAY = float(os.environ.get('FAKESM_UDEV_DELAY', '0'))
+
+# the host used by the stand-in modules, set by the harness
+host = None
+
+
+class CommandError(Exception):
+
+    def __init__(self, cmd, reason):
+        Exception.__init__(self, "%s: %s" % (' '.join(cmd), reason))
+        self.cmd = cmd
+        self.reason = reason
+
+
+def spawn():
+    if SPAWN:
+        subprocess.Popen(['/bin/true']).wait()
+    if CMD_DELAY:
+        time.sleep(CMD_DELAY)
+
+
+def _parseConfig(path):
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(path)
+    return parser.toDict()
+
+
+def _vgInfo(config):
+    for key, value in config.iteritems():
+        if type(value) == dict:
+            return key, value
+    raise CommandError(['vgcfgrestore'], "No volume group in config")
+
+
+_SEQNO_RE = re.compile(r'seqno = (\d+)')
+
+
+def _dropSections(text, names):
+    """
+    :return: the config text without the sections of the given names
+    """
+
+    out = []
+    depth = 0
+    for line in text.splitlines(True):
+        stripped = line.strip()
+        if depth:
+            if stripped.endswith('{'):
+                depth += 1
+            elif stripped == '}':
+                depth -= 1
+            continue
+        if stripped.endswith('{') and stripped[:-1].strip() in names:
+            depth = 1
+            continue
+        out.append(line)
+    return ''.join(out)
+
+
+def _sectorCrcs(data):
+    return [zlib.crc32(data[start:start + SECTOR_SIZE])
+            for start in range(0, len(data), SECTOR_SIZE)]
+
+
+# size of the LUN images created by iscsiadm logins
+LUN_SIZE = 64 * 1024 * 1024
+
+# options taking a value, by command
+_VALUE_OPTIONS = {
+    'pvcreate': ('--config', '-u', '--restorefile'),
+    'vgcfgbackup': ('--config', '-f'),
+    'vgcfgrestore': ('--config', '-f'),
+    'iscsiadm': ('-m', '-p', '-T', '-t', '-o', '--op', '-n', '-v'),
+}
+
+
+def _stripOptions(args, with_value=('--config',)):
+    """
+    :return: (options, positional arguments) of a command
+    """
+
+    options = {}
+    positional = []
+    i = 0
+    while i < len(args):
+        if args[i] in with_value:
+            options[args[i]] = args[i + 1]
+            i += 2
+        elif args[i].startswith('-'):
+            options[args[i]] = True
+            i += 1
+        else:
+            positional.append(args[i])
+            i += 1
+    return options, positional
+
+
+def diskName(number):
+    """
+    :return: name of the block device of the LUN0 of a session, as sdb
+    """
+
+    letters = ''
+    while number:
+        number, letter = divmod(number - 1, 26)
+        letters = chr(ord('a') + letter) + letters
+    return 'sd' + letters
+
+
+def diskNumber(number):
+    """
+    :return: (major, minor) of the block device of a session
+    """
+
+    return 8, number * 16
+
+
+class FakeHost(object):
+    """ A device image holding one VG, and the directory of its LV nodes """
+
+    def __init__(self, device, dev_dir, vg_name=None, config_text=None,
+                 command_log=None):
+        """
+        :param vg_name: VG of the device, None for a host running iSCSI
+        commands only
+        :param command_log: file every command is appended to, shared by
+        the processes of a run
+        """
+
+        self.device = device
+        self.dev_dir = dev_dir
+        self.iscsi_dir = os.path.join(dev_dir, 'iscsi')
+        self.nodes_dir = os.path.join(dev_dir, 'nodes')
+        self.sys_dir = os.path.join(dev_dir, 'sys')
+        self.vg_name = vg_name
+        self.config_text = config_text
+        self.vg_info = {'logical_volumes': {}}
+        if config_text:
+            self.vg_info = _vgInfo(_parseConfig(self._textFile(config_text)))[1]
+        self.command_log = command_log
+        self.lock = threading.Lock()
+        self.commands = []
+        # checksums of the sectors of the active LVs when they were mapped.
+        # LVs left active by a previous run are found from their files, and
+        # what it wrote to them is written to the image, as it is on a PV
+        # even once the process which wrote it is killed.
+        self.mapped = {}
+        for lv_name in self.vg_info['logical_volumes']:
+            if os.path.exists(self.lvPath(lv_name)):
+                offset, size = self.lvOffset(lv_name)
+                image = open(self.device, 'rb')
+                try:
+                    image.seek(offset)
+                    self.mapped[lv_name] = _sectorCrcs(image.read(size))
+                finally:
+                    image.close()
+                self.flush(lv_name)
+        self.active = set(self.mapped)
+
+    def _textFile(self, text):
+        path = os.path.join(self.dev_dir, '.config')
+        fd = open(path, 'w')
+        try:
+            fd.write(text)
+        finally:
+            fd.close()
+        return path
+
+    def _readFile(self, path):
+        fd = open(path, 'rb')
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def lvPath(self, lv_name):
+        return os.path.join(self.dev_dir, self.vg_name, lv_name)
+
+    def lvOffset(self, lv_name):
+        """
+        :return: (offset, size) in the image of the start of the LV
+        """
+
+        lv = self.vg_info['logical_volumes'][lv_name]
+        segment = lv['segment1']
+        pv_name, start_pe = segment['stripes'][:2]
+        extent_size = self.vg_info['extent_size'] * SECTOR_SIZE
+        pe_start = self.vg_info['physical_volumes'][pv_name]['pe_start']
+        size = segment['extent_count'] * extent_size
+        if lv_name != MDVOLUME_NAME:
+            size = min(size, LV_MAP_SIZE)
+        return pe_start * SECTOR_SIZE + start_pe * extent_size, size
+
+    def run(self, cmd):
+        """
+        Runs an emulated command
+        :param cmd: command list
+        :return: stdout of the command
+        """
+
+        spawn()
+        self.lock.acquire()
+        try:
+            self.commands.append(cmd)
+            if self.command_log:
+                fd = open(self.command_log, 'a')
+                try:
+                    fd.write(' '.join(cmd) + '\n')
+                finally:
+                    fd.close()
+            name = os.path.basename(cmd[0])
+            handler = getattr(self, '_cmd_' + name.replace('-', '_'), None)
+            if handler is None:
+                raise CommandError(cmd, "Unknown command")
+            options, args = _stripOptions(cmd[1:],
+                                          _VALUE_OPTIONS.get(name, ('--config',)))
+            return handler(cmd, options, args) or ''
+        finally:
+            self.lock.release()
+
+    def _cmd_pvdisplay(self, cmd, options, args):
+        return "  --- Physical volume ---\n" \
+               "  PV Name               %s\n" \
+               "  VG Name               %s\n" % (args[0], self.vg_name)
+
+    def _cmd_vgcfgbackup(self, cmd, options, args):
+        if args[0] != self.vg_name:
+            raise CommandError(cmd, "Volume group not found")
+        shutil.copyfile(self._textFile(self.config_text), options['-f'])
+
+    def _cmd_lvs(self, cmd, options, args):
+        return ''.join(["  %s %s\n" % (lv_name, self.vg_name)
+                        for lv_name in self.vg_info['logical_volumes']])
+
+    def _cmd_pvcreate(self, cmd, options, args):
+        _vgInfo(_parseConfig(options['--restorefile']))
+        fd = os.open(self.device, os.O_RDWR)
+        try:
+            pvgen.write_label(fd, options['-u'], os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+    def _cmd_vgcfgrestore(self, cmd, options, args):
+        fd = open(options['-f'])
+        try:
+            text = fd.read()
+        finally:
+            fd.close()
+
+        vg_name, vg_info = _vgInfo(_parseConfig(options['-f']))
+        if vg_name != args[0]:
+            raise CommandError(cmd, "Volume group %s not in config" % args[0])
+        fd = os.open(self.device, os.O_RDWR)
+        try:
+            pvgen.write_metadata(fd, pvgen.metadata_text(text, vg_name))
+        finally:
+            os.close(fd)
+
+        self.vg_name = vg_name
+        self.vg_info = vg_info
+        self.config_text = text
+        self.active = set()
+        self.mapped = {}
+        if not os.path.isdir(os.path.join(self.dev_dir, vg_name)):
+            os.mkdir(os.path.join(self.dev_dir, vg_name))
+
+    def _lvNames(self, cmd, args):
+        lv_names = []
+        for path in args:
+            vg_name, lv_name = path.split('/')[-2:]
+            if vg_name != self.vg_name or \
+                    lv_name not in self.vg_info['logical_volumes']:
+                raise CommandError(cmd, "LV %s not found" % path)
+            lv_names.append(lv_name)
+        return lv_names
+
+    def _cmd_lvchange(self, cmd, options, args):
+        for lv_name in self._lvNames(cmd, args):
+            if '-ay' in options and lv_name not in self.active:
+                self.activate(lv_name)
+            elif '-an' in options and lv_name in self.active:
+                self.deactivate(lv_name)
+
+    def _cmd_lvremove(self, cmd, options, args):
+        lv_names = self._lvNames(cmd, args)
+        for lv_name in lv_names:
+            if lv_name in self.active:
+                self.active.remove(lv_name)
+                del self.mapped[lv_name]
+                os.remove(self.lvPath(lv_name))
+            del self.vg_info['logical_volumes'][lv_name]
+        self._commit(_dropSections(self.config_text, set(lv_names)))
+
+    def _commit(self, text):
+        """
+        Writes a new version of the VG metadata to the image
+        """
+
+        seqno = int(_SEQNO_RE.search(text).group(1))
+        self.config_text = _SEQNO_RE.sub('seqno = %d' % (seqno + 1), text, 1)
+        fd = os.open(self.device, os.O_RDWR)
+        try:
+            pvgen.write_metadata(fd, pvgen.metadata_text(self.config_text,
+                                                         self.vg_name))
+        finally:
+            os.close(fd)
+
+    def _cmd_iscsiadm(self, cmd, options, args):
+        if options.get('-m') == 'discovery':
+            return self._discovery(options['-p'])
+        if '-T' in options and '-p' not in options and '-u' in options:
+            # logout of every portal of the target
+            target_dir = os.path.join(self.iscsi_dir, options['-T'])
+            if os.path.isdir(target_dir):
+                for portal in os.listdir(target_dir):
+                    options['-p'] = portal
+                    self._cmd_iscsiadm(cmd, options, args)
+            return
+        if '-T' not in options or '-p' not in options:
+            return
+        iqn, portal = options['-T'], options['-p']
+        record = os.path.join(self.nodes_dir, iqn,
+                              '%s,1' % ','.join(portal.rsplit(':', 1)))
+        lun_path = os.path.join(self.iscsi_dir, iqn, portal, 'LUN0')
+        if options.get('-o') == 'new':
+            if not os.path.isdir(record):
+                os.makedirs(record)
+        elif options.get('-o') == 'delete':
+            if not os.path.isdir(record):
+                raise CommandError(cmd, "no records found")
+            shutil.rmtree(os.path.dirname(record))
+        elif '-l' in options:
+            if not os.path.isdir(record):
+                raise CommandError(cmd, "no records found")
+            if os.path.lexists(lun_path):
+                raise CommandError(cmd, "session exists")
+            image = os.path.join(self.dev_dir, 'luns', iqn)
+            if not os.path.exists(image):
+                if not os.path.isdir(os.path.dirname(image)):
+                    os.makedirs(os.path.dirname(image))
+                fd = open(image, 'wb')
+                try:
+                    fd.truncate(LUN_SIZE)
+                finally:
+                    fd.close()
+            self._addSession(portal, iqn)
+            self._linkLun(image, lun_path)
+        elif '-u' in options and os.path.lexists(lun_path):
+            os.remove(lun_path)
+            os.rmdir(os.path.dirname(lun_path))
+            os.rmdir(os.path.dirname(os.path.dirname(lun_path)))
+            self._removeSession(portal, iqn)
+
+    def _discovery(self, portal):
+        """
+        Lists the targets of luns/, creating their node records as
+        sendtargets discovery does
+        """
+
+        luns_dir = os.path.join(self.dev_dir, 'luns')
+        iqns = os.path.isdir(luns_dir) and sorted(os.listdir(luns_dir)) or []
+        for iqn in iqns:
+            record = os.path.join(self.nodes_dir, iqn,
+                                  '%s,1' % ','.join(portal.rsplit(':', 1)))
+            if not os.path.isdir(record):
+                os.makedirs(record)
+        return ''.join(['%s,1 %s\n' % (portal, iqn) for iqn in iqns])
+
+    def _linkLun(self, image, lun_path):
+        """
+        Links the LUN of a login as udev does, after a random delay of up to
+        UDEV_DELAY in a detached process, so the command returns before the
+        link appears as iscsiadm does
+        """
+
+        def link():
+            if not os.path.isdir(os.path.dirname(lun_path)):
+                os.makedirs(os.path.dirname(lun_path))
+            os.symlink(image, lun_path)
+
+        if not UDEV_DELAY:
+            link()
+            return
+
+        delay = random.uniform(0, UDEV_DELAY)
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        status = 1
+        try:
+            try:
+                if os.fork() == 0:
+                    time.sleep(delay)
+                    link()
+                status = 0
+            except:
+                pass
+        finally:
+            os._exit(status)
+
+    def _addSession(self, portal, iqn):
+        sessions_dir = os.path.join(self.sys_dir, 'iscsi_session')
+        if not os.path.isdir(sessions_dir):
+            os.makedirs(sessions_dir)
+        number = 1
+        while True:
+            try:
+                os.mkdir(os.path.join(sessions_dir, 'session%d' % number))
+                break
+            except OSError:
+                number += 1
+        connection = os.path.join(self.sys_dir, 'iscsi_connection',
+                                  'connection%d:0' % number)
+        os.makedirs(connection)
+        # the LUN0 of the session, linked from class/block as in sysfs
+        name = diskName(number)
+        block = os.path.join(sessions_dir, 'session%d' % number, 'device',
+                             'target%d:0:0' % number, '%d:0:0:0' % number,
+                             'block', name)
+        os.makedirs(os.path.join(block, 'holders'))
+        block_class = os.path.join(self.sys_dir, 'block')
+        if not os.path.isdir(block_class):
+            os.makedirs(block_class)
+        os.symlink(block, os.path.join(block_class, name))
+        address, port = portal.rsplit(':', 1)
+        # the target name is written last, the session is complete with it
+        for path, value in (
+                (os.path.join(connection, 'persistent_address'), address),
+                (os.path.join(connection, 'persistent_port'), port),
+                (os.path.join(block, 'dev'), '%d:%d' % diskNumber(number)),
+                (os.path.join(sessions_dir, 'session%d' % number,
+                              'targetname'), iqn)):
+            fd = open(path, 'w')
+            try:
+                fd.write(value + '\n')
+            finally:
+                fd.close()
+
+    def _removeSession(self, portal, iqn):
+        sessions_dir = os.path.join(self.sys_dir, 'iscsi_session')
+        for name in os.listdir(sessions_dir):
+            connection = os.path.join(self.sys_dir, 'iscsi_connection',
+                                      'connection%s:0' % name[len('session'):])
+            values = []
+            for path in (os.path.join(sessions_dir, name, 'targetname'),
+                         os.path.join(connection, 'persistent_address'),
+                         os.path.join(connection, 'persistent_port')):
+                try:
+                    values.append(self._readFile(path).strip())
+                except IOError:
+                    # a session being added by another process
+                    break
+            if values == [iqn] + portal.rsplit(':', 1):
+                os.remove(os.path.join(self.sys_dir, 'block',
+                                       diskName(int(name[len('session'):]))))
+                shutil.rmtree(connection)
+                shutil.rmtree(os.path.join(sessions_dir, name))
+                return
+
+    def activate(self, lv_name):
+        offset, size = self.lvOffset(lv_name)
+        image = open(self.device, 'rb')
+        try:
+            image.seek(offset)
+            data = image.read(size)
+        finally:
+            image.close()
+
+        fd = open(self.lvPath(lv_name), 'wb')
+        try:
+            fd.write(data)
+        finally:
+            fd.close()
+        self.mapped[lv_name] = _sectorCrcs(data)
+        self.active.add(lv_name)
+
+    def flush(self, lv_name):
+        """
+        Writes the sectors of an active LV changed since it was mapped to the
+        image
+        """
+
+        offset, size = self.lvOffset(lv_name)
+        data = self._readFile(self.lvPath(lv_name))[:size]
+        crcs = _sectorCrcs(data)
+        mapped = self.mapped[lv_name]
+
+        image = open(self.device, 'r+b')
+        try:
+            for i in range(len(crcs)):
+                if i >= len(mapped) or crcs[i] != mapped[i]:
+                    image.seek(offset + i * SECTOR_SIZE)
+                    image.write(data[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE])
+        finally:
+            image.close()
+        self.mapped[lv_name] = crcs
+
+    def flushAll(self):
+        """
+        Writes the changes of every active LV to the image, as they are on a
+        real PV when the driver is killed
+        """
+
+        for lv_name in self.active:
+            self.flush(lv_name)
+
+    def deactivate(self, lv_name):
+        self.flush(lv_name)
+        os.remove(self.lvPath(lv_name))
+        del self.mapped[lv_name]
+        self.active.remove(lv_name)
@@ -0,0 +1,140 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for a XAPI session, answering the calls of the drivers from the
+# SR, PBD and VDI records of a pool held in memory. A marshalled session
+# passes the arguments and results of the calls through XML-RPC, and counts
+# the calls and the bytes they would send.
+#
+
+import re
+import xmlrpclib
+
+# the pool of the session given to the drivers, set by the harness
+pool = None
+# the sessions given to the drivers are marshalled
+MARSHAL = False
+# uuid of the host the drivers run on
+HOST_UUID = 'f1d7a2c4-3b5e-4c8f-9a6d-2e0b7c1f5a93'
+
+_FIELD_RE = re.compile(r'^field "([^"]+)" = "([^"]*)"$')
+
+
+class _Class(object):
+    """ The records of a class, with the get_<field> and set_<field> calls
+    of XAPI """
+
+    def __init__(self, records):
+        self.records = records
+
+    def get_record(self, ref):
+        return self.records[ref]
+
+    def get_by_uuid(self, uuid):
+        for ref, record in self.records.iteritems():
+            if record.get('uuid') == uuid:
+                return ref
+        raise KeyError("UUID_INVALID %s" % uuid)
+
+    def get_all_records(self):
+        return dict(self.records)
+
+    def get_all_records_where(self, expr):
+        match = _FIELD_RE.match(expr)
+        if not match:
+            raise ValueError("Unsupported query %s" % expr)
+        field, value = match.groups()
+        return dict([(ref, record) for ref, record in self.records.iteritems()
+                     if record.get(field) == value])
+
+    def add(self, record):
+        ref = 'OpaqueRef:%d' % len(self.records)
+        self.records[ref] = record
+        return ref
+
+    def remove(self, ref):
+        del self.records[ref]
+
+    def __getattr__(self, name):
+        if name.startswith('get_'):
+            return lambda ref: self.records[ref][name[4:]]
+        if name.startswith('set_'):
+            return lambda ref, value: self.records[ref].__setitem__(name[4:],
+                                                                    value)
+        raise AttributeError(name)
+
+
+class _Marshalled(object):
+    """ The calls of a class through XML-RPC """
+
+    def __init__(self, cls, stats):
+        self.cls = cls
+        self.stats = stats
+
+    def __getattr__(self, name):
+        func = getattr(self.cls, name)
+
+        def call(*args):
+            request = xmlrpclib.dumps(args, name, allow_none=True)
+            self.stats['calls'] += 1
+            self.stats['bytes'] += len(request)
+            result = func(*xmlrpclib.loads(request)[0])
+            response = xmlrpclib.dumps((result,), methodresponse=True,
+                                       allow_none=True)
+            self.stats['bytes'] += len(response)
+            return xmlrpclib.loads(response)[0][0]
+        return call
+
+
+class _XenAPI(object):
+
+    def __init__(self, pool, stats=None):
+        self.host = _Class(pool.hosts)
+        self.SR = _Class(pool.srs)
+        self.PBD = _Class(pool.pbds)
+        self.VDI = _Class(pool.vdis)
+        if stats is not None:
+            for name in ('host', 'SR', 'PBD', 'VDI'):
+                setattr(self, name, _Marshalled(getattr(self, name), stats))
+
+
+class Pool(object):
+    """ host, SR, PBD and VDI records, by opaque ref """
+
+    def __init__(self):
+        self.host_ref = 'OpaqueRef:host-0'
+        self.hosts = {self.host_ref: {'uuid': HOST_UUID}}
+        self.srs = {}
+        self.pbds = {}
+        self.vdis = {}
+
+    def addSr(self, sr_uuid, device_config, sm_config=None, sr_type='vdilun'):
+        sr_ref = 'OpaqueRef:sr-%d' % len(self.srs)
+        pbd_ref = 'OpaqueRef:pbd-%d' % len(self.pbds)
+        self.srs[sr_ref] = {'uuid': sr_uuid, 'type': sr_type,
+                            'sm_config': sm_config or {},
+                            'virtual_allocation': '0', 'VDIs': [],
+                            'PBDs': [pbd_ref]}
+        self.pbds[pbd_ref] = {'SR': sr_ref, 'host': self.host_ref,
+                              'device_config': device_config}
+        return sr_ref
+
+
+class Session(object):
+
+    def __init__(self, pool, marshal=False):
+        self.stats = marshal and {'calls': 0, 'bytes': 0} or None
+        self.xenapi = _XenAPI(pool, self.stats)
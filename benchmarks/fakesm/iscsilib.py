@@ -0,0 +1,76 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the iscsilib module of the SM framework
+#
+
+import os
+import time
+
+import util
+import fakehost
+
+
+def exn_on_failure(cmd, message):
+    try:
+        return util.pread2(cmd), ''
+    except util.CommandException, e:
+        raise Exception("%s: %s" % (message, e.reason))
+
+
+def set_chap_settings(portal, target, username, password, username_in,
+                      password_in):
+    exn_on_failure(["iscsiadm", "-m", "node", "-T", target, "-p", portal,
+                    "--op", "update", "-n", "node.session.auth.username",
+                    "-v", username], "Failed to set the CHAP settings")
+
+
+def discovery(target, port, chapuser, chappassword, targetIQN="any",
+              interfaceArray=["default"]):
+    cmd = ["iscsiadm", "-m", "discovery", "-t", "sendtargets", "-p",
+           "%s:%s" % (target, port)]
+    stdout, _stderr = exn_on_failure(cmd, "Discovery failed")
+    targets = []
+    for line in stdout.splitlines():
+        portal, iqn = line.split()
+        portal, tpgt = portal.split(',')
+        targets.append((portal, tpgt, iqn))
+    return targets
+
+
+def wait_for_devs(targetIQN, portal):
+    # polls as the SM framework does, in the directory of the fake host
+    path = os.path.join(fakehost.host.iscsi_dir, targetIQN, portal)
+    for i in range(0, 15):
+        if os.path.exists(path):
+            return True
+        time.sleep(1)
+    return False
+
+
+def logout(portal, target, all=False):
+    cmd = ["iscsiadm", "-m", "node", "-T", target, "-u"]
+    if not all:
+        cmd[3:3] = ["-p", portal]
+    exn_on_failure(cmd, "Failed to logout from the target")
+
+
+def ensure_daemon_running_ok(localiqn):
+    pass
+
+
+def set_replacement_tmo(portal, target, mpath):
+    pass
@@ -0,0 +1,48 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+#
+# Stand-in for the lock module of the SM framework: flock on a file per
+# lock, under FAKESM_LOCK_DIR
+#
+
+import os
+import fcntl
+
+LOCK_DIR = os.environ.get('FAKESM_LOCK_DIR', '/tmp/fakesm-lock')
+
+
+class Lock(object):
+
+    def __init__(self, name, ns=None):
+        self.path = os.path.join(LOCK_DIR, ns or '.nil', name)
+        self.fd = None
+
+    def acquire(self):
+        lock_dir = os.path.dirname(self.path)
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:
+                if not os.path.isdir(lock_dir):
+                    raise
+        self.fd = open(self.path, 'a')
+        fcntl.flock(self.fd.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.fd.fileno(), fcntl.LOCK_UN)
+        self.fd.close()
+        self.fd = None
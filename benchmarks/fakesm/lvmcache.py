@@ -0,0 +1,76 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the lvmcache module of the SM framework
+#
+
+import os
+
+import util
+import fakehost
+from lvutil import LVM_BIN
+
+CMD_LVCHANGE = os.path.join(LVM_BIN, "lvchange")
+CMD_LVREMOVE = os.path.join(LVM_BIN, "lvremove")
+CMD_LVS = os.path.join(LVM_BIN, "lvs")
+
+
+class LVInfo(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.active = False
+        self.readonly = False
+        self.hidden = False
+
+
+class LVMCache(object):
+    """ The LVs of a VG, loaded with one lvs call """
+
+    def __init__(self, vgName):
+        self.vgName = vgName
+        self.lvs = {}
+
+    def refresh(self):
+        util.pread2([CMD_LVS, self.vgName])
+        self.lvs = {}
+        if fakehost.host.vg_name == self.vgName:
+            for lv_name in fakehost.host.vg_info['logical_volumes']:
+                self.lvs[lv_name] = LVInfo(lv_name)
+                self.lvs[lv_name].active = lv_name in fakehost.host.active
+
+    def checkLV(self, lvName):
+        return lvName in self.lvs
+
+    def _path(self, lvName):
+        return "%s/%s" % (self.vgName, lvName)
+
+    def activateNoRefcount(self, lvName, refresh=False):
+        util.pread2([CMD_LVCHANGE, '-ay', self._path(lvName)])
+        self.lvs[lvName].active = True
+
+    def deactivateNoRefcount(self, lvName):
+        util.pread2([CMD_LVCHANGE, '-an', self._path(lvName)])
+        self.lvs[lvName].active = False
+
+    def setReadonly(self, lvName, readonly):
+        util.pread2([CMD_LVCHANGE, readonly and '-pr' or '-prw',
+                     self._path(lvName)])
+        self.lvs[lvName].readonly = readonly
+
+    def remove(self, lvName):
+        util.pread2([CMD_LVREMOVE, '-f', self._path(lvName)])
+        del self.lvs[lvName]
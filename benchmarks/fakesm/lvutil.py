@@ -0,0 +1,29 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the lvutil module of the SM framework
+#
+
+import os
+
+LVM_BIN = "/sbin"
+CMD_PVCREATE = os.path.join(LVM_BIN, "pvcreate")
+MDVOLUME_NAME = 'MGT'
+
+
+def ensurePathExists(path):
+    if not os.path.exists(path):
+        raise OSError("No such device %s" % path)
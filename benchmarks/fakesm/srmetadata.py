@@ -0,0 +1,156 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the srmetadata module of the SM framework. The metadata keeps
+# the layout of the MGT volume: a header sector, the SR info up to sector 4,
+# then one record of 2 sectors per VDI, every field an XML element.
+#
+
+import os
+import xml.sax.saxutils
+from xml.dom import minidom
+
+SECTOR_SIZE = 512
+XML_HEADER = "<?xml version=\"1.0\" ?>"
+HDR_STRING = "XSSM"
+HEADER_SEP = ':'
+MD_MAJOR = 1
+MD_MINOR = 0
+XML_TAG = "SRMetadata"
+
+OFFSET_TAG = 'offset'
+ALLOCATION_TAG = 'allocation'
+NAME_LABEL_TAG = 'name_label'
+NAME_DESCRIPTION_TAG = 'name_description'
+VDI_TAG = 'vdi'
+VDI_DELETED_TAG = 'deleted'
+UUID_TAG = 'uuid'
+IS_A_SNAPSHOT_TAG = 'is_a_snapshot'
+SNAPSHOT_OF_TAG = 'snapshot_of'
+TYPE_TAG = 'type'
+VDI_TYPE_TAG = 'vdi_type'
+READ_ONLY_TAG = 'read_only'
+MANAGED_TAG = 'managed'
+SNAPSHOT_TIME_TAG = 'snapshot_time'
+METADATA_OF_POOL_TAG = 'metadata_of_pool'
+
+SR_INFO_SIZE_IN_SECTORS = 4
+VDI_INFO_SIZE_IN_SECTORS = 2
+
+
+def buildHeader(length, major=MD_MAJOR, minor=MD_MINOR):
+    return HEADER_SEP.join([HDR_STRING, str(length), str(major), str(minor)])
+
+
+def getSector(text):
+    assert len(text) <= SECTOR_SIZE, "Metadata sector overflow"
+    return text.ljust(SECTOR_SIZE, '\x00')
+
+
+def getXMLTag(tag, value):
+    return "<%s>%s</%s>" % (tag, xml.sax.saxutils.escape(str(value)), tag)
+
+
+def _parseXML(text):
+    """
+    :return: dict of the elements of text, the children of an element being
+    a nested dict
+    """
+
+    def parse(node):
+        values = {}
+        for child in node.childNodes:
+            if child.nodeType != child.ELEMENT_NODE:
+                continue
+            if [n for n in child.childNodes if n.nodeType == n.ELEMENT_NODE]:
+                values[child.nodeName] = parse(child)
+            else:
+                values[child.nodeName] = ''.join(
+                    [n.data for n in child.childNodes]).encode('utf-8')
+        return values
+
+    return parse(minidom.parseString(text).documentElement)
+
+
+class LVMMetadataHandler(object):
+
+    def __init__(self, path, write=True):
+        self.path = path
+        self.write = write
+
+    def _read(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            header = os.read(fd, SECTOR_SIZE).rstrip('\x00')
+            length = int(header.split(HEADER_SEP)[1])
+            os.lseek(fd, 0, 0)
+            return os.read(fd, length)
+        finally:
+            os.close(fd)
+
+    def getMetadata(self, params={}):
+        data = self._read()
+
+        sr_info = data[SECTOR_SIZE:SECTOR_SIZE * SR_INFO_SIZE_IN_SECTORS]
+        sr_info = sr_info.replace('\x00', '')
+        sr_info = _parseXML('<%s>%s</%s>' % (XML_TAG, sr_info[len(XML_HEADER):],
+                                             XML_TAG))
+
+        vdi_info = {}
+        offset = SECTOR_SIZE * SR_INFO_SIZE_IN_SECTORS
+        while offset < len(data):
+            record = data[offset:offset + SECTOR_SIZE * VDI_INFO_SIZE_IN_SECTORS]
+            record = record.replace('\x00', '')
+            vdi = _parseXML('%s<%s>%s</%s>' % (XML_HEADER, XML_TAG, record,
+                                               XML_TAG))[VDI_TAG]
+            vdi[OFFSET_TAG] = offset
+            if vdi.get(VDI_DELETED_TAG) != '1':
+                vdi_info[offset] = vdi
+            offset += SECTOR_SIZE * VDI_INFO_SIZE_IN_SECTORS
+
+        return sr_info, vdi_info
+
+    def getSRInfo(self, sr_info):
+        return getSector(XML_HEADER + getXMLTag(UUID_TAG, sr_info[UUID_TAG]) +
+                         getXMLTag(ALLOCATION_TAG, sr_info[ALLOCATION_TAG])) + \
+            getSector(getXMLTag(NAME_LABEL_TAG, sr_info[NAME_LABEL_TAG])) + \
+            getSector(getXMLTag(NAME_DESCRIPTION_TAG,
+                                sr_info[NAME_DESCRIPTION_TAG]))
+
+    def getVdiInfo(self, vdi):
+        sector1 = "<%s>%s%s" % (VDI_TAG,
+                                getXMLTag(NAME_LABEL_TAG, vdi[NAME_LABEL_TAG]),
+                                getXMLTag(NAME_DESCRIPTION_TAG,
+                                          vdi[NAME_DESCRIPTION_TAG]))
+        sector2 = ''
+        for tag, value in vdi.iteritems():
+            if tag not in (NAME_LABEL_TAG, NAME_DESCRIPTION_TAG, OFFSET_TAG):
+                sector2 += getXMLTag(tag, value)
+        if VDI_DELETED_TAG not in vdi:
+            sector2 += getXMLTag(VDI_DELETED_TAG, '0')
+        return getSector(sector1) + getSector(sector2 + "</%s>" % VDI_TAG)
+
+    def writeMetadata(self, sr_info, vdi_info):
+        records = [self.getVdiInfo(vdi_info[offset])
+                   for offset in sorted(vdi_info.keys())]
+        md = self.getSRInfo(sr_info) + ''.join(records)
+        md = getSector(buildHeader(SECTOR_SIZE + len(md))) + md
+
+        fd = os.open(self.path, os.O_WRONLY)
+        try:
+            os.write(fd, md)
+        finally:
+            os.close(fd)
@@ -0,0 +1,103 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the util module of the SM framework, running the commands on
+# the emulated host of fakehost
+#
+
+import os
+import sys
+import time
+import traceback
+import uuid as uuidlib
+
+import fakehost
+
+# file the log is appended to, None drops it
+LOG_FILE = os.environ.get('FAKESM_LOG')
+
+
+class CommandException(Exception):
+
+    def __init__(self, code, cmd="", reason='exec failed'):
+        self.code = code
+        self.cmd = cmd
+        self.reason = reason
+        Exception.__init__(self, "%s: %s" % (cmd, reason))
+
+
+def SMlog(message, ident="SM", priority=None):
+    if LOG_FILE:
+        fd = open(LOG_FILE, 'a')
+        try:
+            fd.write("%s %s: %s\n" % (time.strftime("%b %d %H:%M:%S"), ident,
+                                      message))
+        finally:
+            fd.close()
+
+
+def logException(tag):
+    info = sys.exc_info()
+    SMlog("***** %s: EXCEPTION %s, %s" % (tag, info[0], info[1]))
+    for line in traceback.format_exception(*info):
+        SMlog(line.rstrip())
+
+
+def doexec(args, inputtext=None):
+    try:
+        return 0, fakehost.host.run(args), ''
+    except fakehost.CommandError, e:
+        return 1, '', e.reason
+
+
+def pread(cmdlist, close_stdin=False, scramble=None, expect_rc=0, quiet=False):
+    rc, stdout, stderr = doexec(cmdlist)
+    if rc != expect_rc:
+        raise CommandException(rc, str(cmdlist), stderr.strip())
+    return stdout
+
+
+def pread2(cmdlist, quiet=False):
+    return pread(cmdlist, quiet=quiet)
+
+
+def wait_for_path(path, timeout):
+    for i in range(timeout):
+        if os.path.exists(path):
+            return True
+        time.sleep(1)
+    return False
+
+
+def roundup(divisor, value):
+    if value == 0:
+        value = 1
+    if value % divisor != 0:
+        return (int(value) / divisor + 1) * divisor
+    return value
+
+
+def _convertDNS(name):
+    return name
+
+
+def get_this_host():
+    import fakexapi
+    return fakexapi.HOST_UUID
+
+
+def gen_uuid():
+    return str(uuidlib.uuid4())
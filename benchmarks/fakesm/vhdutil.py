@@ -0,0 +1,81 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the vhdutil module of the SM framework. Each call spawns a
+# process like vhd-util does, and reads or rewrites the image with vhdheader.
+#
+
+import os
+import struct
+import uuid as uuidlib
+
+import vhdgen
+import fakehost
+import vhdheader
+
+VDI_TYPE_VHD = 'vhd'
+LOCK_TYPE_SR = 'sr'
+
+
+def _readHeader(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return vhdheader.readHeader(fd)
+    finally:
+        os.close(fd)
+
+
+def _getVHDParentNoCheck(path):
+    fakehost.spawn()
+    vhd = _readHeader(path)
+    if not vhd:
+        return None
+    return vhd.getParentLvName()
+
+
+def setParent(path, parentPath, parentRaw):
+    fakehost.spawn()
+    vhd = _readHeader(path)
+    parent = _readHeader(parentPath)
+    assert vhd and parent, "Not a VHD"
+
+    # vhd-util stores the path it is given, in the locators too
+    old_dir, old_name = os.path.split(vhd.parent_name)
+    new_dir, new_name = os.path.split(parentPath)
+    parent_lv_name = vhdheader._parentLvName(parentPath)
+    replacements = [(vhd.parent_name, parentPath), (old_dir, new_dir),
+                    (old_name, new_name)]
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        vhdheader.setParent(fd, vhd, parent.uuid, replacements, parent_lv_name)
+    finally:
+        os.close(fd)
+
+
+def create(path, size, static, msize=0):
+    fakehost.spawn()
+    vhdgen.create_vhd(path, size, uuidlib.uuid4().bytes)
+
+
+def getSizeVirt(path):
+    fakehost.spawn()
+    fd = open(path, 'rb')
+    try:
+        # current size field of the footer copy
+        return struct.unpack_from('>Q', fd.read(vhdgen.SECTOR_SIZE), 48)[0]
+    finally:
+        fd.close()
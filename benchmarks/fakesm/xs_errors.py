@@ -0,0 +1,29 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Stand-in for the xs_errors module of the SM framework
+#
+
+
+class XenError(Exception):
+
+    def __init__(self, key, opterr=None):
+        self.key = key
+        self.opterr = opterr
+        message = key
+        if opterr:
+            message = "%s [opterr=%s]" % (key, opterr)
+        Exception.__init__(self, message)
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Checks whether the LUNs of VDILUNSR are in use, on a host whose sysfs,
+# /proc and xen-backend devices are fake trees: iscsiadm logins of fakesm
+# list their sessions and block devices under sys/, some of the LUNs are
+# open by fake tapdisk processes, some are used by blkback VBDs, some have a
+# device-mapper device stacked on them, the others are idle.
+#
+# The check of iscsistate must find exactly the LUNs in use. It is compared
+# with the check VDILUNSR made before, which ran pidof and took a LUN
+# whose target had a directory under /dev/iscsi as in use, and is timed
+# with and without the snapshot of the host cached.
+#
+# Usage: python inuse_bench.py [options], see --help
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+from session_bench import fake_host, TARGET, PORT
+from scan_bench import load_sr
+
+import iscsiindex
+import iscsistate
+
+IQN_FORMAT = 'iqn.2017-10.com.example:vm-%04d'
+# pid of the first fake process
+FIRST_PID = 1000
+DEVNULL = open(os.devnull, 'w')
+
+
+def write(path, value):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd = open(path, 'w')
+    try:
+        fd.write(value + '\n')
+    finally:
+        fd.close()
+
+
+def make_host(base_dir, luns, processes):
+    """
+    Logs in to the targets and opens some of their LUNs
+    :return: list of (iqn, expected use of its LUN: None, 'tapdisk',
+    'blkback' or 'holder')
+    """
+
+    host = fake_host(base_dir)
+    portal = '%s:%d' % (TARGET, PORT)
+    proc_dir = os.path.join(base_dir, 'proc')
+    iscsistate.PROC_DIR = proc_dir
+    iscsistate.XEN_BACKEND_DIR = os.path.join(base_dir, 'xen-backend')
+    iscsistate.BLOCK_DEV_DIR = os.path.join(base_dir, 'dev-nodes')
+
+    targets = []
+    sessions = {}
+    for i in range(luns):
+        iqn = IQN_FORMAT % i
+        for op in (['-o', 'new'], ['-l']):
+            host.run(['iscsiadm', '-m', 'node', '-p', portal, '-T', iqn] + op)
+        sessions = iscsiindex.listSessions()
+        name = iscsistate.sessionDevices(sessions[(portal, iqn)])[0]
+
+        use = [None, None, 'tapdisk', None, 'blkback', None, 'holder'][i % 7]
+        if use == 'tapdisk':
+            pid = FIRST_PID + i
+            write(os.path.join(proc_dir, str(pid), 'comm'), 'tapdisk')
+            os.mkdir(os.path.join(proc_dir, str(pid), 'fd'))
+            os.symlink(os.path.join(iscsistate.BLOCK_DEV_DIR, name),
+                       os.path.join(proc_dir, str(pid), 'fd', '5'))
+        elif use == 'blkback':
+            major, minor = iscsistate.deviceNumber(name)
+            write(os.path.join(iscsistate.XEN_BACKEND_DIR,
+                               'vbd-%d-51712' % i, 'physical_device'),
+                  '%x:%x' % (major, minor))
+        elif use == 'holder':
+            os.mkdir(os.path.join(host.sys_dir, 'block', name, 'holders',
+                                  'dm-%d' % i))
+        targets.append((iqn, use))
+
+    # other processes, with files open, as on a real host
+    for i in range(processes):
+        pid = str(FIRST_PID + luns + i)
+        write(os.path.join(proc_dir, pid, 'comm'), 'xapi')
+        os.mkdir(os.path.join(proc_dir, pid, 'fd'))
+        for fd in range(3):
+            os.symlink('/dev/null', os.path.join(proc_dir, pid, 'fd',
+                                                 str(fd)))
+    return targets
+
+
+def old_check(iqn):
+    """
+    The check of VDILUNSR before iscsistate, pidof scans the /proc of the
+    machine running the benchmark
+    """
+
+    subprocess.call(['pidof', '-s', 'iscsid'], stdout=DEVNULL)
+    return os.path.isdir(os.path.join(iscsiindex.DEV_DIR, iqn))
+
+
+def timed(func, items):
+    """
+    :return: (results of func for each item, mean seconds per call)
+    """
+
+    start = time.time()
+    results = [func(item) for item in items]
+    return results, (time.time() - start) / len(items)
+
+
+def report(name, results, expected, seconds):
+    wrong = len([1 for result, use in zip(results, expected)
+                 if result != bool(use)])
+    print "%-22s %4d LUNs: %4d in use, %4d wrong, %8.3fms per check" % \
+        (name, len(results), len([1 for result in results if result]),
+         wrong, seconds * 1000)
+    sys.stdout.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--luns', type='int', default=100,
+                      help="LUNs logged in [%default]")
+    parser.add_option('--processes', type='int', default=300,
+                      help="other processes of the host [%default]")
+    options, _args = parser.parse_args(argv[1:])
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        targets = make_host(base_dir, options.luns, options.processes)
+        iqns = [iqn for iqn, _use in targets]
+        expected = [use for _iqn, use in targets]
+        portal = '%s:%d' % (TARGET, PORT)
+
+        results, seconds = timed(old_check, iqns)
+        report('pidof + /dev/iscsi', results, expected, seconds)
+
+        results, seconds = timed(
+            lambda iqn: iscsistate.lunState(portal, iqn, 0).inUse(), iqns)
+        report('sysfs, no cache', results, expected, seconds)
+        assert results == [bool(use) for use in expected]
+
+        iscsistate.invalidate()
+        results, seconds = timed(
+            lambda iqn: iscsistate.lunState(portal, iqn).inUse(), iqns)
+        report('sysfs, cached', results, expected, seconds)
+        assert results == [bool(use) for use in expected]
+
+        for iqn, use in targets[:7]:
+            state = iscsistate.lunState(portal, iqn)
+            assert bool(state.tapdisks) == (use == 'tapdisk'), (iqn, state)
+            assert bool(state.vbds) == (use == 'blkback'), (iqn, state)
+            assert bool(state.holders) == (use == 'holder'), (iqn, state)
+
+        # the check of VDI delete and resize
+        import fakexapi
+        sr = load_sr(base_dir, 0, iqns[:7])
+        for record in fakexapi.pool.vdis.values():
+            vdi = sr.vdi(record['uuid'])
+            assert vdi._inUse() == bool(expected[iqns.index(vdi.iqn)]), \
+                vdi.iqn
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
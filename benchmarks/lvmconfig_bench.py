@@ -0,0 +1,356 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Benchmarks lvmconfigparser and lvmconfigmodel on synthetic VG configs,
+# against the implementations they replaced. Their results are checked by
+# tests/test_lvmconfigparser.py and tests/test_lvmresign.py.
+#
+# Usage: python lvmconfig_bench.py [num_lvs ...]
+#
+
+import gc
+import copy
+import os
+import sys
+import time
+import types
+import tempfile
+import StringIO
+
+import lvmgen
+import lvmconfigparser
+import lvmconfigmodel
+import lvmresign
+
+try:
+    import simplejson as json
+except:
+    import json
+
+DEFAULT_SIZES = [10, 1000, 10000]
+SEGMENTS_PER_LV = 4
+# the legacy serializer is quadratic, it is only timed up to this many LVs
+LEGACY_SERIALIZE_MAX_LVS = 1000
+
+
+class LegacyParser(object):
+    """ The line based parser lvmconfigparser used before the streaming
+    tokenizer, kept here as the baseline """
+
+    def __init__(self):
+        self.root = {}
+        self.cur_entry = self.root
+        self.prev_entries = []
+        self.current_line = 0
+
+    def parse(self, config_file):
+        fd = open(config_file)
+        lines = []
+        for line in fd.readlines():
+            line = line.strip()
+            comment_idx = line.find('#')
+            if comment_idx >= 0:
+                line = line[:comment_idx]
+            if len(line):
+                lines.append(line)
+        fd.close()
+
+        while self.current_line < len(lines):
+            line = lines[self.current_line]
+            if line.find('=') >= 0:
+                key, value = line.split('=')
+                key = key.strip()
+                value = value.strip()
+                if value == '[':
+                    while True:
+                        self.current_line += 1
+                        line = lines[self.current_line].strip()
+                        value += line
+                        if line == ']':
+                            break
+                self.cur_entry[key] = json.loads(value)
+            elif line.endswith('{'):
+                key = line.split('{')[0].strip()
+                self.cur_entry[key] = {}
+                self.prev_entries.append(self.cur_entry)
+                self.cur_entry = self.cur_entry[key]
+            elif line.endswith('}'):
+                self.cur_entry = self.prev_entries.pop()
+            self.current_line += 1
+
+        return self.root
+
+
+class LegacySerializer(object):
+    """ The string concatenating serializer lvmconfigparser used before
+    iterConfig, kept here as the baseline """
+
+    def __init__(self, root):
+        self.root = root
+        self.out_str = ""
+
+    def toConfigString(self):
+        self._toString(self.root, 0)
+        return self.out_str
+
+    def _toString(self, data, indent):
+        indent_sp = '\t' * indent
+
+        if type(data) == dict:
+            for key in data:
+                if type(data[key]) == dict:
+                    self.out_str += indent_sp + "%s {\n" % key
+                else:
+                    self.out_str += indent_sp + "%s = " % key
+
+                self._toString(data[key], indent + 1)
+
+                if type(data[key]) == dict:
+                    self.out_str += indent_sp + "}\n"
+                else:
+                    self.out_str += indent_sp + "\n"
+
+        elif type(data) == list:
+            self.out_str += "["
+            for v in data:
+                self._toString(v, indent)
+                self.out_str += " , "
+            if len(data):
+                self.out_str = self.out_str[:-3]
+            self.out_str += "]\n"
+
+        elif type(data) == str or type(data) == unicode:
+            self.out_str += '"%s"' % data
+
+        else:
+            self.out_str += "%s" % data
+
+
+def best_of(runs, func, *args):
+    best = None
+    result = None
+    for i in range(runs):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def parse_streaming(path):
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(path)
+    return parser.toDict()
+
+
+def parse_legacy(path):
+    return LegacyParser().parse(path)
+
+
+def bench_parse(num_lvs):
+    text, vg_name, _uuids = lvmgen.gen_vg_config(num_lvs, SEGMENTS_PER_LV)
+    fd, path = tempfile.mkstemp()
+    os.write(fd, text)
+    os.close(fd)
+
+    try:
+        runs = max(1, min(5, 10000 / num_lvs))
+        legacy_time, _ = best_of(runs, parse_legacy, path)
+        new_time, _ = best_of(runs, parse_streaming, path)
+    finally:
+        os.remove(path)
+
+    print "parse  %6d LVs %8d bytes: legacy %8.3fs  streaming %8.3fs  (x%.1f)" % \
+        (num_lvs, len(text), legacy_time, new_time, legacy_time / new_time)
+
+
+def serialize_streaming(config_dict, path):
+    fd = open(path, 'w')
+    try:
+        lvmconfigparser.LvmConfigParser(config_dict).write(fd)
+    finally:
+        fd.close()
+
+
+def serialize_legacy(config_dict, path):
+    fd = open(path, 'w')
+    try:
+        fd.write(LegacySerializer(config_dict).toConfigString())
+    finally:
+        fd.close()
+
+
+def bench_serialize(num_lvs):
+    text, vg_name, _uuids = lvmgen.gen_vg_config(num_lvs, SEGMENTS_PER_LV)
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(StringIO.StringIO(text))
+    config_dict = parser.toDict()
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        runs = max(1, min(5, 10000 / num_lvs))
+        new_time, _ = best_of(runs, serialize_streaming, config_dict, path)
+        size = os.path.getsize(path)
+
+        if num_lvs <= LEGACY_SERIALIZE_MAX_LVS:
+            legacy_time, _ = best_of(runs, serialize_legacy, config_dict, path)
+            legacy = "%8.3fs" % legacy_time
+        else:
+            legacy = " skipped"
+    finally:
+        os.remove(path)
+
+    print "write  %6d LVs %8d bytes: legacy %s  streaming %8.3fs" % \
+        (num_lvs, size, legacy, new_time)
+
+
+def deep_size(root):
+    """ Bytes used by the objects reachable from root """
+
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def bench_model(num_lvs):
+    text, vg_name, uuids = lvmgen.gen_vg_config(num_lvs, SEGMENTS_PER_LV)
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(StringIO.StringIO(text))
+    config_dict = parser.toDict()
+
+    start = time.time()
+    config = lvmconfigmodel.fromDict(config_dict)
+    build_time = time.time() - start
+
+    assert config.toDict() == config_dict, "model changed the config"
+
+    dict_size = deep_size(config_dict)
+    model_size = deep_size(config)
+
+    lvs = config_dict[vg_name]['logical_volumes']
+    vg = config.vg
+    lv_ids = [lvs['VHD-' + uuid]['id'] for uuid in uuids]
+    probes = lv_ids[::max(1, num_lvs / 100)]
+
+    # lookup of an LV by its LVM id
+    start = time.time()
+    for lv_id in probes:
+        for lv in lvs.itervalues():
+            if lv['id'] == lv_id:
+                break
+    dict_lookup = (time.time() - start) / len(probes)
+
+    start = time.time()
+    for lv_id in probes:
+        vg.getLvById(lv_id)
+    model_lookup = (time.time() - start) / len(probes)
+
+    # rename of every LV by VHD uuid
+    start = time.time()
+    for uuid in uuids:
+        lvs['VHD-x' + uuid[1:]] = lvs.pop('VHD-' + uuid)
+    dict_rename = (time.time() - start) / num_lvs
+
+    start = time.time()
+    for uuid in uuids:
+        vg.renameVhdLv(uuid, 'x' + uuid[1:])
+    model_rename = (time.time() - start) / num_lvs
+
+    print "model  %6d LVs: memory dict %7.1fMB model %7.1fMB  build %.3fs" % \
+        (num_lvs, dict_size / 1048576.0, model_size / 1048576.0, build_time)
+    print "                   lookup by id dict %9.2fus model %6.2fus  " \
+        "rename dict %5.2fus model %5.2fus" % \
+        (dict_lookup * 1e6, model_lookup * 1e6, dict_rename * 1e6,
+         model_rename * 1e6)
+
+
+def resign_deepcopy(config_dict, old_vg_name, new_vg_name, pv_ids, device,
+                    lv_ids, lv_names):
+    """ The deepcopy based resign _resignLvm used before lvmresign, kept
+    here as the baseline """
+
+    resigned = copy.deepcopy(config_dict)
+    vg_info = resigned.pop(old_vg_name)
+    resigned[new_vg_name] = vg_info
+
+    for pv in vg_info['physical_volumes']:
+        vg_info['physical_volumes'][pv]['id'] = pv_ids[pv]
+        vg_info['physical_volumes'][pv]['device'] = device
+
+    lvs = vg_info['logical_volumes']
+    for lv_name in lvs.keys():
+        lvs[lv_name]['id'] = lv_ids[lv_name]
+        if lv_name in lv_names:
+            lvs[lv_names[lv_name]] = lvs.pop(lv_name)
+
+    return lvmconfigparser.LvmConfigParser(resigned).toConfigString()
+
+
+def resign_view(*args):
+    return lvmresign.ResignedLvmConfig(*args).toConfigString()
+
+
+def bench_resign(num_lvs):
+    text, vg_name, uuids = lvmgen.gen_vg_config(num_lvs, SEGMENTS_PER_LV)
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(StringIO.StringIO(text))
+    config_dict = parser.toDict()
+
+    rand = lvmgen.random.Random(1)
+    vg_info = config_dict[vg_name]
+    pv_ids = dict([(pv, lvmgen.gen_lvm_id(rand))
+                   for pv in vg_info['physical_volumes']])
+    lv_ids = dict([(lv, lvmgen.gen_lvm_id(rand))
+                   for lv in vg_info['logical_volumes']])
+    lv_names = dict([('VHD-' + uuid, 'VHD-' + lvmgen.gen_uuid(rand))
+                     for uuid in uuids])
+    args = (config_dict, vg_name, lvmgen.VG_PREFIX + lvmgen.gen_uuid(rand),
+            pv_ids, '/dev/sdz', lv_ids, lv_names)
+
+    runs = max(1, min(5, 10000 / num_lvs))
+    legacy_time, _ = best_of(runs, resign_deepcopy, *args)
+    new_time, _ = best_of(runs, resign_view, *args)
+
+    print "resign %6d LVs: deepcopy %8.3fs  view %8.3fs" % \
+        (num_lvs, legacy_time, new_time)
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or DEFAULT_SIZES
+    for num_lvs in sizes:
+        bench_parse(num_lvs)
+    for num_lvs in sizes:
+        bench_serialize(num_lvs)
+    for num_lvs in sizes:
+        bench_model(num_lvs)
+    for num_lvs in sizes:
+        bench_resign(num_lvs)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,133 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Generators for synthetic LVHD volume group configs, laid out the way
+# vgcfgbackup writes them.
+#
+
+import os
+import sys
+import random
+
+SM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'ReLVHDoISCSISR-1.0', 'opt', 'xensource', 'sm')
+sys.path.insert(0, os.path.normpath(SM_DIR))
+
+VG_PREFIX = "VG_XenStorage-"
+EXTENT_SIZE = 8192  # sectors, 4MiB
+PE_START = 20608
+
+_UUID_CHARS = "0123456789abcdef"
+_LVM_CHARS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def gen_uuid(rand):
+    s = ''.join([rand.choice(_UUID_CHARS) for i in range(32)])
+    return '-'.join([s[:8], s[8:12], s[12:16], s[16:20], s[20:]])
+
+
+def gen_lvm_id(rand):
+    s = ''.join([rand.choice(_LVM_CHARS) for i in range(32)])
+    return '-'.join([s[:6], s[6:10], s[10:14], s[14:18], s[18:22],
+                     s[22:26], s[26:]])
+
+
+def _lv(out, name, lv_id, segments):
+    out.append("\t\t%s {\n" % name)
+    out.append("\t\t\tid = \"%s\"\n" % lv_id)
+    out.append("\t\t\tstatus = [\"READ\", \"WRITE\", \"VISIBLE\"]\n")
+    out.append("\t\t\tflags = []\n")
+    out.append("\t\t\tsegment_count = %d\n" % len(segments))
+    for i, (start, pe, count) in enumerate(segments):
+        out.append("\n\t\t\tsegment%d {\n" % (i + 1))
+        out.append("\t\t\t\tstart_extent = %d\n" % start)
+        out.append("\t\t\t\textent_count = %d\t# %d Megabytes\n" % (count, count * 4))
+        out.append("\n\t\t\t\ttype = \"striped\"\n")
+        out.append("\t\t\t\tstripe_count = 1\t# linear\n")
+        out.append("\n\t\t\t\tstripes = [\n")
+        out.append("\t\t\t\t\t\"pv0\", %d\n" % pe)
+        out.append("\t\t\t\t]\n")
+        out.append("\t\t\t}\n")
+    out.append("\t\t}\n")
+
+
+def gen_vg_config(num_lvs, segments_per_lv=1, extents_per_segment=2,
+                  seed=0, device="/dev/sdb", sr_uuid=None, vdi_uuids=None,
+                  mgt_extents=1):
+    """
+    Generates the text of a vgcfgbackup file for an LVHD VG
+    :param num_lvs: number of VHD LVs besides MGT
+    :param sr_uuid: uuid of the SR, random if None
+    :param vdi_uuids: uuids of the VHD LVs, num_lvs random ones if None
+    :param mgt_extents: size of the MGT LV in extents
+    :return: (config text, vg name, list of VHD uuids)
+    """
+
+    rand = random.Random(seed)
+    sr_uuid = sr_uuid or gen_uuid(rand)
+    vg_name = VG_PREFIX + sr_uuid
+    if vdi_uuids is None:
+        vdi_uuids = [gen_uuid(rand) for i in range(num_lvs)]
+    num_lvs = len(vdi_uuids)
+    pe_count = mgt_extents + num_lvs * segments_per_lv * extents_per_segment + 16
+
+    out = []
+    out.append("# Generated by LVM2 version 2.02.88(2)-RHEL5 (2014-04-03): "
+               "Tue Oct  3 12:00:00 2017\n\n")
+    out.append("contents = \"Text Format Volume Group\"\n")
+    out.append("version = 1\n\n")
+    out.append("description = \"Created *after* executing "
+               "'vgcfgbackup -f /tmp/tmpXYZ %s'\"\n\n" % vg_name)
+    out.append("creation_host = \"xenhost\"\t# Linux xenhost 2.6.32.43-0.4.1"
+               ".xs1.8.0.835.170778xen #1 SMP Tue Oct 3 2017 x86_64\n")
+    out.append("creation_time = 1507046400\t# Tue Oct  3 12:00:00 2017\n\n")
+    out.append("%s {\n" % vg_name)
+    out.append("\tid = \"%s\"\n" % gen_lvm_id(rand))
+    out.append("\tseqno = 42\n")
+    out.append("\tstatus = [\"RESIZEABLE\", \"READ\", \"WRITE\"]\n")
+    out.append("\tflags = []\n")
+    out.append("\textent_size = %d\t\t# 4 Megabytes\n" % EXTENT_SIZE)
+    out.append("\tmax_lv = 0\n")
+    out.append("\tmax_pv = 0\n")
+    out.append("\tmetadata_copies = 0\n\n")
+    out.append("\tphysical_volumes {\n\n")
+    out.append("\t\tpv0 {\n")
+    out.append("\t\t\tid = \"%s\"\n" % gen_lvm_id(rand))
+    out.append("\t\t\tdevice = \"%s\"\t# Hint only\n\n" % device)
+    out.append("\t\t\tstatus = [\"ALLOCATABLE\"]\n")
+    out.append("\t\t\tflags = []\n")
+    out.append("\t\t\tdev_size = %d\n" % (PE_START + pe_count * EXTENT_SIZE))
+    out.append("\t\t\tpe_start = %d\n" % PE_START)
+    out.append("\t\t\tpe_count = %d\n" % pe_count)
+    out.append("\t\t}\n\t}\n\n")
+    out.append("\tlogical_volumes {\n\n")
+    _lv(out, "MGT", gen_lvm_id(rand), [(0, 0, mgt_extents)])
+
+    # segments of the LVs are interleaved like they are on a long lived SR
+    pe = mgt_extents
+    lv_segments = [[] for i in range(num_lvs)]
+    for seg in range(segments_per_lv):
+        for i in range(num_lvs):
+            lv_segments[i].append((seg * extents_per_segment, pe,
+                                   extents_per_segment))
+            pe += extents_per_segment
+
+    for i in range(num_lvs):
+        out.append("\n")
+        _lv(out, "VHD-" + vdi_uuids[i], gen_lvm_id(rand), lv_segments[i])
+
+    out.append("\t}\n}\n")
+    return ''.join(out), vg_name, vdi_uuids
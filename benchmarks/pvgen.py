@@ -0,0 +1,127 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Writes the LVM2 label and metadata area of a PV, laid out the way pvcreate
+# and the LVM tools write them: the label in sector 1, one metadata area
+# from 4KiB up to the first extent, holding the VG metadata in a circular
+# buffer after its header.
+#
+
+import os
+import struct
+
+import lvmgen
+import lvmlabel
+
+SECTOR_SIZE = 512
+LABEL_SECTOR = 1
+MDA_OFFSET = 4096
+
+
+def _pwrite(fd, data, offset):
+    os.lseek(fd, offset, 0)
+    assert os.write(fd, data) == len(data), "Short write"
+
+
+def _pread(fd, size, offset):
+    os.lseek(fd, offset, 0)
+    return os.read(fd, size)
+
+
+def mda_size(pe_start=lvmgen.PE_START):
+    """
+    :return: size of the metadata area, which ends at the first extent
+    """
+
+    return pe_start * SECTOR_SIZE - MDA_OFFSET
+
+
+def write_label(fd, pv_uuid, device_size, pe_start=lvmgen.PE_START):
+    """
+    Writes the label of a PV and an empty metadata area, as pvcreate does
+    :param pv_uuid: PV uuid, with or without the dashes
+    :param device_size: size of the device in bytes
+    :param pe_start: start of the first extent in sectors
+    """
+
+    pv_uuid = pv_uuid.replace('-', '')
+    assert len(pv_uuid) == 32, "Invalid PV uuid"
+
+    pv_header = struct.pack('<32sQ', pv_uuid, device_size)
+    pv_header += struct.pack('<QQQQ', pe_start * SECTOR_SIZE, 0, 0, 0)
+    pv_header += struct.pack('<QQQQ', MDA_OFFSET, mda_size(pe_start), 0, 0)
+
+    label = bytearray(SECTOR_SIZE)
+    struct.pack_into('<8sQII8s', label, 0, lvmlabel.LABEL_ID, LABEL_SECTOR, 0,
+                     32, lvmlabel.LABEL_TYPE)
+    label[32:32 + len(pv_header)] = pv_header
+    struct.pack_into('<I', label, 16, lvmlabel.calcCrc(str(label[20:])))
+
+    for sector in range(lvmlabel.LABEL_SCAN_SECTORS):
+        if sector != LABEL_SECTOR:
+            _pwrite(fd, '\0' * SECTOR_SIZE, sector * SECTOR_SIZE)
+    _pwrite(fd, str(label), LABEL_SECTOR * SECTOR_SIZE)
+    _write_mda_header(fd, mda_size(pe_start), None)
+
+
+def _write_mda_header(fd, size, locn):
+    header = bytearray(lvmlabel.MDA_HEADER_SIZE)
+    struct.pack_into('<I16sIQQ', header, 0, 0, lvmlabel.MDA_MAGIC,
+                     lvmlabel.MDA_VERSION, MDA_OFFSET, size)
+    if locn:
+        struct.pack_into('<QQII', header, 40, locn[0], locn[1], locn[2], 0)
+    struct.pack_into('<I', header, 0, lvmlabel.calcCrc(str(header[4:])))
+    _pwrite(fd, str(header), MDA_OFFSET)
+
+
+def write_metadata(fd, text, offset=None, pe_start=lvmgen.PE_START):
+    """
+    Commits VG metadata to the metadata area, as the LVM tools do
+    :param text: metadata text
+    :param offset: offset of the metadata in the area, by default right
+    after the metadata it replaces. The metadata wraps around the end of
+    the area.
+    """
+
+    size = mda_size(pe_start)
+    data = text + '\0'
+    assert len(data) <= size - lvmlabel.MDA_HEADER_SIZE, "Metadata too large"
+
+    if offset is None:
+        header = _pread(fd, lvmlabel.MDA_HEADER_SIZE, MDA_OFFSET)
+        prev_offset, prev_size = struct.unpack_from('<QQ', header, 40)
+        offset = lvmlabel.MDA_HEADER_SIZE
+        if prev_size:
+            offset = (prev_offset + prev_size + SECTOR_SIZE - 1) / \
+                SECTOR_SIZE * SECTOR_SIZE
+            if offset >= size:
+                offset -= size - lvmlabel.MDA_HEADER_SIZE
+
+    wrap = max(offset + len(data) - size, 0)
+    _pwrite(fd, data[:len(data) - wrap], MDA_OFFSET + offset)
+    if wrap:
+        _pwrite(fd, data[len(data) - wrap:], MDA_OFFSET + lvmlabel.MDA_HEADER_SIZE)
+    _write_mda_header(fd, size, (offset, len(data), lvmlabel.calcCrc(data)))
+
+
+def metadata_text(config_text, vg_name):
+    """
+    :return: the text of a vgcfgbackup file as the metadata area holds it,
+    the VG section first
+    """
+
+    start = config_text.index('%s {' % vg_name)
+    return config_text[start:] + config_text[:start]
@@ -0,0 +1,468 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Runs ReLVHDoISCSISR.create end to end on generated SR images, with the SM
+# framework, the LVM tools, vhd-util and iscsiadm replaced by the stand-ins
+# of fakesm, and reports the latency, the processes spawned and the peak
+# RSS of each resign. Every emulated command spawns a process; --cmd-delay
+# adds the latency of the real tools to each of them.
+#
+# Each resign runs in its own process, so its peak RSS is measured apart
+# from the generation of the image and from the other runs. The resigned
+# image is checked: the VG and the SR metadata carry the new uuids, the
+# snapshots are gone, and every VHD points to its renamed parent.
+#
+# Each resign is then run again, as a retried sr-create would, and must find
+# that the LUN needs no resign.
+#
+# With --crash, the resign is killed at each phase boundary instead, and
+# between pvcreate and vgcfgrestore, after
+# the writes to the active LVs reached the image, then run again on the same
+# image, which must resume it and end with the same checked image. The
+# crashed resign runs on a single worker and the images are generated from
+# a fixed seed, so a crash point falls on the same VHD on every run.
+#
+# Usage: python resign_bench.py [options], see --help
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import uuid as uuidlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import srgen
+import lvmgen
+
+DEFAULT_LVS = '100,500,1000'
+DEFAULT_DEPTHS = '1,3'
+DEFAULT_SNAPSHOTS = '0,0.5'
+DEFAULT_PRUNE = 'false,true'
+
+# exit status of a resign killed by an injected crash
+CRASH_STATUS = 17
+# phases of the resign, each crashed before and after it runs
+CRASH_PHASES = ['read_pv_metadata', 'open_journal', 'prune_snapshots',
+                'resign_lvm', 'load', 'resign_sr_metadata', 'delete_snapshots',
+                'resign_vdis', 'deactivate']
+# commands of the resign, each crashed after it ran
+CRASH_COMMANDS = ['pvcreate']
+# crashes inside resign_vdis, after this many parents were set
+CRASH_SET_PARENTS = 10
+TARGET = '127.0.0.1'
+PORTAL = '%s:3260' % TARGET
+TARGET_IQN = 'iqn.2017-10.com.example:bench'
+
+
+class Crashed(Exception):
+    pass
+
+
+def run_forked(func, *args):
+    """
+    Runs func in a child process
+    :return: (value returned by func, peak RSS of the child in KiB)
+    """
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read_fd)
+            try:
+                result = {'value': func(*args)}
+            except Exception, e:
+                import traceback
+                result = {'error': traceback.format_exc()}
+                status = 1
+            os.write(write_fd, json.dumps(result))
+            os.close(write_fd)
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    _pid, status, rusage = os.wait4(pid, 0)
+
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == CRASH_STATUS:
+        raise Crashed()
+    result = json.loads(data)
+    if 'error' in result:
+        raise RuntimeError("Child failed:\n%s" % result['error'])
+    return result['value'], rusage.ru_maxrss
+
+
+def generate(base_dir, num_lvs, depth, snapshots):
+    device = os.path.join(base_dir, 'lun.img')
+    _text, vg_name, sr_uuid, vdis = srgen.gen_sr(device, num_lvs, depth,
+                                                 snapshots)
+    return {'vg_name': vg_name, 'sr_uuid': sr_uuid, 'lvs': len(vdis),
+            'snapshots': len([vdi for vdi in vdis if vdi.snapshot_of]),
+            'kept': len([vdi for vdi in vdis if not vdi.snapshot_of])}
+
+
+def read_label(device):
+    import lvmlabel
+
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return lvmlabel.readPvMetadata(fd)
+    finally:
+        os.close(fd)
+
+
+def install_crash(host, crash):
+    """
+    Kills the process at a crash point of the resign
+    :param crash: (phase or command, 'before' or 'after'), or
+    ('set_parent', count)
+    """
+
+    import resignmetrics
+
+    def die():
+        host.flushAll()
+        os._exit(CRASH_STATUS)
+
+    phase, when = crash
+    run = resignmetrics.ResignMetrics.run
+    run_lv = resignmetrics.ResignMetrics.runLv
+    command = host.run
+    calls = [0]
+
+    def crashing_run(self, name, func, *args, **kwargs):
+        if name == phase and when == 'before':
+            die()
+        value = run(self, name, func, *args, **kwargs)
+        if name == phase and when == 'after':
+            die()
+        return value
+
+    def crashing_run_lv(self, lv_name, name, func, *args, **kwargs):
+        value = run_lv(self, lv_name, name, func, *args, **kwargs)
+        if name == phase:
+            host.lock.acquire()
+            calls[0] += 1
+            if calls[0] == when:
+                die()
+            host.lock.release()
+        return value
+
+    def crashing_command(cmd):
+        value = command(cmd)
+        if os.path.basename(cmd[0]) == phase and when == 'after':
+            die()
+        return value
+
+    resignmetrics.ResignMetrics.run = crashing_run
+    resignmetrics.ResignMetrics.runLv = crashing_run_lv
+    host.run = crashing_command
+
+
+def resign(base_dir, sr, prune, workers, cmd_delay, new_uuid, crash=None,
+           force=False, pool_srs=()):
+    """
+    Resigns the image
+    :param crash: crash point, see install_crash
+    :param pool_srs: (sr uuid, SCSIid) of the SRs of the pool
+    :return: dict of the results, 'outcome' is 'resigned', 'resumed' or
+    'unchanged'
+    """
+
+    dev_dir = os.path.join(base_dir, 'dev')
+    if not os.path.isdir(dev_dir):
+        os.mkdir(dev_dir)
+    os.environ['FAKESM_DEV_DIR'] = dev_dir
+
+    import fakehost
+    import fakexapi
+    import SRCommand
+    import xs_errors
+    import ReLVHDoISCSISR
+
+    # the host state is the one left on the image, by the generation or
+    # by a crashed resign
+    fakehost.CMD_DELAY = cmd_delay
+    device = os.path.join(base_dir, 'lun.img')
+    pv = read_label(device)
+    host = fakehost.FakeHost(device, dev_dir, pv.vg_name, pv.text)
+    fakehost.host = host
+    fakexapi.pool = fakexapi.Pool()
+    for sr_uuid, scsi_id in pool_srs:
+        fakexapi.pool.addSr(sr_uuid, {'SCSIid': scsi_id},
+                            sr_type='lvmoiscsi')
+    if crash:
+        install_crash(host, crash)
+
+    metrics_file = os.path.join(base_dir, 'metrics.log')
+    dconf = {'target': TARGET,
+             'targetIQN': TARGET_IQN,
+             'SCSIid': 'bench',
+             'vdi_workers': str(workers),
+             'prune_snapshots': prune and 'true' or 'false',
+             'metrics_file': metrics_file,
+             'force': force and 'true' or 'false'}
+
+    start = time.time()
+    driver = ReLVHDoISCSISR.ReLVHDoISCSISR(SRCommand.SRCommand(dconf), new_uuid)
+    message = ''
+    try:
+        driver.create(new_uuid, 0)
+    except xs_errors.XenError, e:
+        message = str(e)
+        if message.find("successfully resigned") == -1 and \
+                message.find("already been resigned") == -1:
+            raise
+    seconds = time.time() - start
+
+    # a resumed resign keeps the uuid of the interrupted one
+    resigned_uuid = host.vg_name[len(lvmgen.VG_PREFIX):]
+    outcome = 'resigned'
+    if message.find("already been resigned") != -1:
+        outcome = 'unchanged'
+    elif message.find("interrupted resign") != -1:
+        outcome = 'resumed'
+    if resigned_uuid != new_uuid:
+        assert outcome != 'resigned' and message.find(resigned_uuid) != -1, \
+            message
+    check(host, sr, resigned_uuid)
+    assert not os.path.lexists(lun_path(dev_dir)), "Session left logged in"
+
+    fd = open(metrics_file)
+    try:
+        record = json.loads(fd.readlines()[-1])
+    finally:
+        fd.close()
+    assert record['status'] == outcome, (record['status'], outcome)
+    assert record['io_scope'] == 'lun', record['io_scope']
+
+    return {'seconds': seconds, 'spawns': record['spawns'],
+            'sr_uuid': resigned_uuid, 'outcome': outcome,
+            'commands': len(host.commands),
+            'phases': [(phase['name'], phase['seconds'], phase['spawns'])
+                       for phase in record['phases']]}
+
+
+def lun_path(dev_dir):
+    return os.path.join(dev_dir, 'iscsi', TARGET_IQN, PORTAL, 'LUN0')
+
+
+def logout(base_dir):
+    """
+    Logs out the session left by a crashed resign, as the SM process which
+    held it is gone
+    """
+
+    import fakehost
+
+    dev_dir = os.path.join(base_dir, 'dev')
+    assert os.path.lexists(lun_path(dev_dir)), "No session left"
+    host = fakehost.FakeHost(None, dev_dir)
+    host.run(['iscsiadm', '-m', 'node', '-T', TARGET_IQN, '-u'])
+
+
+def check(host, sr, new_uuid):
+    """
+    Checks the resigned image
+    """
+
+    import srmetadata
+    import vhdheader
+    import resignjournal
+    import ReLVHDoISCSISR
+
+    new_vg_name = lvmgen.VG_PREFIX + new_uuid
+    assert host.vg_name == new_vg_name, host.vg_name
+
+    pv = read_label(host.device)
+    assert pv.vg_name == new_vg_name, pv.vg_name
+    assert [pv.pv_uuid] == [pv_info['id'] for pv_info in
+                            host.vg_info['physical_volumes'].values()]
+    assert not host.active, "LVs left active: %s" % sorted(host.active)
+
+    lv_names = set(host.vg_info['logical_volumes'].keys())
+    lv_names.remove('MGT')
+    assert len(lv_names) == sr['kept'], \
+        "%d LVs left, %d expected" % (len(lv_names), sr['kept'])
+
+    offset, size = host.lvOffset('MGT')
+    temp_fd, mgt_file = tempfile.mkstemp()
+    image = os.open(host.device, os.O_RDONLY)
+    try:
+        os.lseek(image, offset, 0)
+        os.write(temp_fd, os.read(image, size))
+        os.close(temp_fd)
+        sr_info, vdi_info = srmetadata.LVMMetadataHandler(mgt_file, False).getMetadata()
+        journal = resignjournal.ResignJournal(
+            image, offset + size - ReLVHDoISCSISR.JOURNAL_SIZE,
+            ReLVHDoISCSISR.JOURNAL_SIZE)
+        entries = journal.read()
+        assert entries and entries[-1] == {'phase': 'completed'}, \
+            "Resign journal not completed"
+    finally:
+        os.remove(mgt_file)
+
+    assert sr_info[srmetadata.UUID_TAG] == new_uuid
+    vdi_uuids = set([vdi[srmetadata.UUID_TAG] for vdi in vdi_info.itervalues()])
+    assert vdi_uuids == set([lv_name[4:] for lv_name in lv_names]), \
+        "SR metadata does not match the LVs"
+
+    old_vg_name = sr['vg_name']
+    try:
+        for lv_name in lv_names:
+            vhd = vhdheader.readHeader(image, host.lvOffset(lv_name)[0])
+            parent_lv_name = vhd.getParentLvName()
+            if not parent_lv_name:
+                continue
+            assert parent_lv_name in lv_names, \
+                "%s has a missing parent %s" % (lv_name, parent_lv_name)
+            assert vhd.parent_name.replace('--', '-').find(old_vg_name) == -1, \
+                "%s still points to %s" % (lv_name, vhd.parent_name)
+            parent = vhdheader.readHeader(image, host.lvOffset(parent_lv_name)[0])
+            assert vhd.parent_uuid == parent.uuid
+    finally:
+        os.close(image)
+
+
+def bench(options, num_lvs, depth, snapshots, prune):
+    base_dir = tempfile.mkdtemp()
+    try:
+        sr, _rss = run_forked(generate, base_dir, num_lvs, depth, snapshots)
+        result, rss = run_forked(resign, base_dir, sr, prune, options.workers,
+                                 options.cmd_delay, str(uuidlib.uuid4()))
+        retry, _rss = run_forked(resign, base_dir, sr, prune, options.workers,
+                                 options.cmd_delay, str(uuidlib.uuid4()))
+        assert retry['outcome'] == 'unchanged', retry['outcome']
+        assert retry['sr_uuid'] == result['sr_uuid']
+    finally:
+        shutil.rmtree(base_dir)
+
+    print "resign %5d LVs depth %d snapshots %4d prune %-5s: %8.2fs " \
+        "%5d spawns %7.1fMB peak RSS, retry %6.3fs %2d spawns" % \
+        (sr['lvs'], depth, sr['snapshots'], prune and 'yes' or 'no',
+         result['seconds'], result['spawns'], rss / 1024.0, retry['seconds'],
+         retry['spawns'])
+    if options.verbose:
+        for name, seconds, spawns in result['phases']:
+            print "    %-20s %8.3fs %5d spawns" % (name, seconds, spawns)
+    sys.stdout.flush()
+
+
+def crash_points():
+    points = []
+    for phase in CRASH_PHASES:
+        points.append((phase, 'before'))
+        points.append((phase, 'after'))
+    for command in CRASH_COMMANDS:
+        points.append((command, 'after'))
+    points.append(('set_parent', CRASH_SET_PARENTS))
+    return points
+
+
+def crash_resign(base_dir, sr, prune, crash, workers, cmd_delay):
+    """
+    Resigns the image, killed at a crash point, then runs the resign again
+    on the image the crash left
+    :param crash: crash point, see install_crash
+    :return: (outcome, crashed uuid, result of the second resign). The
+    outcome is 'resumed' if the second resign completed the crashed one,
+    'restarted' if it resigned the image again, and 'not reached' if the
+    crash point was not reached, with no second resign.
+    """
+
+    crashed_uuid = str(uuidlib.uuid4())
+    try:
+        run_forked(resign, base_dir, sr, prune, 1, cmd_delay, crashed_uuid,
+                   crash)
+    except Crashed:
+        run_forked(logout, base_dir)
+        result, _rss = run_forked(resign, base_dir, sr, prune, workers,
+                                  cmd_delay, str(uuidlib.uuid4()))
+        outcome = result['sr_uuid'] == crashed_uuid and 'resumed' \
+            or 'restarted'
+        return outcome, crashed_uuid, result
+    return 'not reached', crashed_uuid, None
+
+
+def crash_test(options, num_lvs, depth, snapshots, prune):
+    """
+    Crashes the resign at every crash point, and checks that the next resign
+    completes it
+    """
+
+    for crash in crash_points():
+        base_dir = tempfile.mkdtemp()
+        try:
+            sr, _rss = run_forked(generate, base_dir, num_lvs, depth, snapshots)
+            outcome = crash_resign(base_dir, sr, prune, crash, options.workers,
+                                   options.cmd_delay)[0]
+        finally:
+            shutil.rmtree(base_dir)
+
+        print "crash %4d LVs depth %d snapshots %4d prune %-5s %6s %-18s: %s" % \
+            (sr['lvs'], depth, sr['snapshots'], prune and 'yes' or 'no',
+             crash[1], crash[0], outcome)
+        sys.stdout.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--lvs', default=DEFAULT_LVS,
+                      help="comma separated approximate LV counts [%default]")
+    parser.add_option('--depths', default=DEFAULT_DEPTHS,
+                      help="comma separated numbers of base copies below "
+                           "each VDI [%default]")
+    parser.add_option('--snapshots', default=DEFAULT_SNAPSHOTS,
+                      help="comma separated fractions of the base copies "
+                           "with a snapshot [%default]")
+    parser.add_option('--prune', default=DEFAULT_PRUNE,
+                      help="comma separated prune_snapshots values [%default]")
+    parser.add_option('--workers', type='int', default=8,
+                      help="vdi_workers of the resign [%default]")
+    parser.add_option('--cmd-delay', type='float', default=0.0,
+                      help="seconds added to every emulated command [%default]")
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help="print the time of every phase")
+    parser.add_option('--crash', action='store_true', default=False,
+                      help="crash the resign at every phase boundary and "
+                           "check that it is resumed, instead of timing it")
+    options, _args = parser.parse_args(argv[1:])
+
+    run = options.crash and crash_test or bench
+    for num_lvs in [int(v) for v in options.lvs.split(',')]:
+        for depth in [int(v) for v in options.depths.split(',')]:
+            for snapshots in [float(v) for v in options.snapshots.split(',')]:
+                for prune in [v.strip() == 'true' for v in options.prune.split(',')]:
+                    run(options, num_lvs, depth, snapshots, prune)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Onboards an array of per-VM LUNs into a VDILUNSR, with the SM framework,
+# XAPI and iscsiadm replaced by the stand-ins of fakesm, and reports how
+# long it takes. The array is a set of LUN images, most holding a VHD, some
+# empty, and one already known to XAPI.
+#
+# The LUNs are introduced one vdi-introduce at a time, each in its own SM
+# process, then by one sr-scan with targetIQNs=* per worker count. Every
+# emulated command spawns a process; --cmd-delay adds the latency of the
+# real tools to each of them. The scan must introduce every LUN holding a
+# VHD but the known one, and a second scan must introduce nothing.
+#
+# Usage: python scan_bench.py [options], see --help
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import uuid as uuidlib
+
+import vhdgen
+from resign_bench import run_forked
+from session_bench import fake_host, SR_UUID, TARGET, PORT
+
+DEFAULT_WORKERS = '1,16'
+VDI_SIZE = 8 * 1024 * 1024
+IQN_FORMAT = 'iqn.2017-10.com.example:vm-%04d'
+# one LUN in EMPTY_EVERY holds no VHD
+EMPTY_EVERY = 10
+
+
+def make_array(base_dir, luns):
+    """
+    Writes the LUN images of the array
+    :return: (IQNs of the LUNs holding a VHD, IQNs of the empty ones)
+    """
+
+    luns_dir = os.path.join(base_dir, 'dev', 'luns')
+    os.makedirs(luns_dir)
+    vhds, empty = [], []
+    for i in range(luns):
+        iqn = IQN_FORMAT % i
+        path = os.path.join(luns_dir, iqn)
+        if i % EMPTY_EVERY == EMPTY_EVERY - 1:
+            open(path, 'wb').close()
+            empty.append(iqn)
+        else:
+            vhdgen.create_vhd(path, VDI_SIZE, uuidlib.uuid4().bytes)
+            vhds.append(iqn)
+    return vhds, empty
+
+
+def load_sr(base_dir, cmd_delay, known, **dconf):
+    """
+    :param known: IQNs of the VDIs known to XAPI
+    :return: the VDILUNSR of a run
+    """
+
+    fake_host(base_dir)
+
+    import fakehost
+    import fakexapi
+    import SRCommand
+    import VDILUNSR
+
+    fakehost.CMD_DELAY = cmd_delay
+    dconf.update({'target': TARGET, 'port': str(PORT), 'SRmaster': 'true',
+                  'localIQN': 'iqn.2017-10.com.example:host',
+                  'session_grace': '0'})
+    fakexapi.pool = fakexapi.Pool()
+    sr_ref = fakexapi.pool.addSr(SR_UUID, dconf)
+    for iqn in known:
+        fakexapi.pool.vdis['OpaqueRef:%s' % iqn] = {
+            'uuid': str(uuidlib.uuid4()), 'location': iqn,
+            'size': str(VDI_SIZE), 'SR': sr_ref}
+
+    params = {'sr_ref': sr_ref, 'vdi_sm_config': {}}
+    return VDILUNSR.VDILUNSR(SRCommand.SRCommand(dconf, params=params),
+                             SR_UUID)
+
+
+def introduce(base_dir, cmd_delay, iqn):
+    """
+    Introduces the VDI of a LUN as vdi-introduce does
+    :return: True if the LUN was introduced
+    """
+
+    sr = load_sr(base_dir, cmd_delay, [])
+    sr.srcmd.params['vdi_sm_config']['targetIQN'] = iqn
+    vdi_uuid = str(uuidlib.uuid4())
+    try:
+        sr.vdi(vdi_uuid).introduce(SR_UUID, vdi_uuid)
+    except Exception, e:
+        if getattr(e, 'key', None) != 'VDIMissing':
+            raise
+        return False
+    return True
+
+
+def scan(base_dir, cmd_delay, known, workers):
+    """
+    Runs sr-scan
+    :return: IQNs of the VDIs introduced
+    """
+
+    import fakexapi
+
+    sr = load_sr(base_dir, cmd_delay, known, targetIQNs='*',
+                 scan_workers=str(workers))
+    sr.scan(SR_UUID)
+    assert not os.listdir(os.path.join(base_dir, 'dev', 'sys',
+                                       'iscsi_session')), "Sessions left"
+    return [record['location'] for record in fakexapi.pool.vdis.values()
+            if record['location'] not in known]
+
+
+def count_iscsiadm(base_dir):
+    path = os.path.join(base_dir, 'commands')
+    if not os.path.exists(path):
+        return 0
+    fd = open(path)
+    try:
+        count = len([line for line in fd if line.startswith('iscsiadm ')])
+    finally:
+        fd.close()
+    os.remove(path)
+    return count
+
+
+def report(name, luns, seconds, introduced, commands):
+    print "%-22s %4d LUNs: %8.2fs, %5.1f LUNs/s, %4d introduced, " \
+        "%5d iscsiadm" % (name, luns, seconds, luns / seconds, introduced,
+                          commands)
+    sys.stdout.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--luns', type='int', default=200,
+                      help="LUNs of the array [%default]")
+    parser.add_option('--workers', default=DEFAULT_WORKERS,
+                      help="comma separated scan_workers values [%default]")
+    parser.add_option('--cmd-delay', type='float', default=0.0,
+                      help="seconds added to each emulated command "
+                           "[%default]")
+    parser.add_option('--skip-introduce', action='store_true',
+                      default=False,
+                      help="skip the runs of vdi-introduce")
+    options, _args = parser.parse_args(argv[1:])
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        vhds, _empty = make_array(base_dir, options.luns)
+        known = vhds[:1]
+        expected = sorted(vhds[1:])
+
+        if not options.skip_introduce:
+            start = time.time()
+            introduced = 0
+            for iqn in expected:
+                done, _rss = run_forked(introduce, base_dir,
+                                        options.cmd_delay, iqn)
+                introduced += done
+            assert introduced == len(expected)
+            report('vdi-introduce', len(expected), time.time() - start,
+                   introduced, count_iscsiadm(base_dir))
+
+        for workers in [int(v) for v in options.workers.split(',')]:
+            start = time.time()
+            introduced, _rss = run_forked(scan, base_dir, options.cmd_delay,
+                                          known, workers)
+            seconds = time.time() - start
+            assert sorted(introduced) == expected, \
+                "%d introduced, %d expected" % (len(introduced), len(expected))
+            report('sr-scan %d workers' % workers, options.luns, seconds,
+                   len(introduced), count_iscsiadm(base_dir))
+
+        # every LUN holding a VHD is known to XAPI, the scan runs the
+        # discovery and probes the empty LUNs only
+        start = time.time()
+        introduced, _rss = run_forked(scan, base_dir, options.cmd_delay,
+                                      known + expected, 1)
+        assert not introduced, "%d introduced again" % len(introduced)
+        report('sr-scan, VHDs known', options.luns, time.time() - start, 0,
+               count_iscsiadm(base_dir))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
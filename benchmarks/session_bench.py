@@ -0,0 +1,317 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Runs the life cycle of a VDILUNSR VDI, vdi-create then VM starts and stops,
+# with every SM call in its own process as xapi runs them, and counts the
+# iscsiadm commands it makes. The SM framework, XAPI and iscsiadm are the
+# stand-ins of fakesm. The session of the VDI must be logged in once, and
+# logged out once the grace period after the last stop is over. A VM started
+# after that logs in again on the node record kept from the first login, and
+# vdi-delete deletes the record.
+#
+# The concurrent run then has several processes attach and detach VDIs of
+# the same target at once, which must share a single session. The boot run
+# starts a VM on a session logged in before the SM ran, as after a boot,
+# which must be adopted from the index rebuilt from sysfs. The dead holder
+# run has a process hold the session as an SM operation and exit without
+# releasing it: the next VM stop must drop its hold and log out.
+#
+# Usage: python session_bench.py [options], see --help
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import uuid as uuidlib
+
+from resign_bench import run_forked
+
+DEFAULT_GRACES = '0,2'
+SR_UUID = '8e6f5d2a-6f54-4cd4-9a0c-58b8f7c4e0a1'
+TARGET = '127.0.0.1'
+PORT = 3260
+TARGET_IQN = 'iqn.2017-10.com.example:vdilun'
+VDI_SIZE = 8 * 1024 * 1024
+
+
+def fake_host(base_dir):
+    """
+    :return: the FakeHost of a run, the SM modules set to use it
+    """
+
+    os.environ['FAKESM_LOCK_DIR'] = os.path.join(base_dir, 'lock')
+
+    import fakehost
+    import iscsiindex
+    import iscsisessions
+
+    host = fakehost.FakeHost(None, os.path.join(base_dir, 'dev'),
+                             command_log=os.path.join(base_dir, 'commands'))
+    fakehost.host = host
+    iscsiindex.DEV_DIR = host.iscsi_dir
+    iscsiindex.SYSFS_DIR = host.sys_dir
+    iscsiindex.NODE_DIRS = [host.nodes_dir]
+    iscsiindex.INDEX_DIR = os.path.join(base_dir, 'run', 'iscsi-index')
+    iscsisessions.SESSION_DIR = os.path.join(base_dir, 'run', 'sessions')
+    return host
+
+
+def sm_call(base_dir, grace, op, vdi_uuid, located, iqn=TARGET_IQN):
+    """
+    Runs a VDI call of VDILUNSR
+    :param op: 'create', 'attach', 'detach' or 'delete'
+    :param located: the VDI record holds the IQN of its LUN
+    :param iqn: IQN of the target of the VDI
+    :return: seconds taken by the call
+    """
+
+    fake_host(base_dir)
+
+    import fakexapi
+    import SRCommand
+    import VDILUNSR
+
+    dconf = {'target': TARGET, 'port': str(PORT), 'SRmaster': 'true',
+             'localIQN': 'iqn.2017-10.com.example:host',
+             'session_grace': str(grace)}
+    fakexapi.pool = fakexapi.Pool()
+    sr_ref = fakexapi.pool.addSr(SR_UUID, dconf)
+    if located:
+        fakexapi.pool.vdis['OpaqueRef:vdi'] = {
+            'uuid': vdi_uuid, 'location': iqn, 'size': str(VDI_SIZE),
+            'SR': sr_ref}
+
+    params = {'sr_ref': sr_ref, 'vdi_sm_config': {'targetIQN': iqn}}
+    sr = VDILUNSR.VDILUNSR(SRCommand.SRCommand(dconf, params=params), SR_UUID)
+    vdi = sr.vdi(vdi_uuid)
+
+    start = time.time()
+    if op == 'create':
+        vdi.create(SR_UUID, vdi_uuid, VDI_SIZE)
+    elif op == 'attach':
+        vdi.attach(SR_UUID, vdi_uuid)
+    elif op == 'detach':
+        vdi.detach(SR_UUID, vdi_uuid)
+    else:
+        # the SR of the stand-ins does not load its VDIs
+        sr.vdis[vdi_uuid] = vdi
+        vdi.delete(SR_UUID, vdi_uuid)
+    return time.time() - start
+
+
+def count_commands(base_dir):
+    """
+    :return: dict of the iscsiadm commands run, 'login', 'logout', 'new'
+    and 'delete', and 'all' of them
+    """
+
+    fd = open(os.path.join(base_dir, 'commands'))
+    try:
+        commands = [line.split() for line in fd]
+    finally:
+        fd.close()
+    commands = [cmd for cmd in commands if cmd and cmd[0] == 'iscsiadm']
+    return {'all': len(commands),
+            'login': len([cmd for cmd in commands if '-l' in cmd]),
+            'logout': len([cmd for cmd in commands if '-u' in cmd]),
+            'new': len([cmd for cmd in commands if 'new' in cmd]),
+            'delete': len([cmd for cmd in commands if 'delete' in cmd])}
+
+
+def logged_in(base_dir):
+    return os.path.lexists(os.path.join(base_dir, 'dev', 'iscsi', TARGET_IQN,
+                                        '%s:%d' % (TARGET, PORT), 'LUN0'))
+
+
+def wait_logout(base_dir, grace):
+    """
+    :return: seconds after the grace period the session was logged out in
+    """
+
+    deadline = time.time() + grace
+    while logged_in(base_dir):
+        assert time.time() < deadline + 10, "Session not logged out"
+        time.sleep(0.05)
+    return max(time.time() - deadline, 0)
+
+
+def life_cycle(options, grace):
+    base_dir = tempfile.mkdtemp()
+    try:
+        vdi_uuid = str(uuidlib.uuid4())
+        times = {'create': [], 'attach': [], 'detach': []}
+
+        seconds, _rss = run_forked(sm_call, base_dir, grace, 'create',
+                                   vdi_uuid, False)
+        times['create'].append(seconds)
+        for _i in range(options.cycles):
+            for op in ('attach', 'detach'):
+                seconds, _rss = run_forked(sm_call, base_dir, grace, op,
+                                           vdi_uuid, True)
+                times[op].append(seconds)
+        lag = wait_logout(base_dir, grace)
+
+        # a VM started once the session was logged out
+        for op in ('attach', 'detach'):
+            seconds, _rss = run_forked(sm_call, base_dir, grace, op,
+                                       vdi_uuid, True)
+            times[op].append(seconds)
+        wait_logout(base_dir, grace)
+
+        run_forked(sm_call, base_dir, grace, 'delete', vdi_uuid, True)
+        counts = count_commands(base_dir)
+        assert counts['login'] == counts['logout'], counts
+        assert counts['new'] == counts['delete'] == 1, counts
+        assert not os.listdir(os.path.join(base_dir, 'dev', 'nodes')), \
+            "Node record left"
+    finally:
+        shutil.rmtree(base_dir)
+
+    print "life cycle grace %3ds: create + %d starts + 1 start: %3d logins " \
+        "%3d logouts %d records created %d deleted, %3d iscsiadm; logout " \
+        "%.2fs after the grace, create %.3fs attach %.3fs detach %.3fs" % \
+        (grace, options.cycles, counts['login'], counts['logout'],
+         counts['new'], counts['delete'], counts['all'], lag,
+         mean(times['create']), mean(times['attach']), mean(times['detach']))
+    sys.stdout.flush()
+
+
+def concurrent(options, grace):
+    base_dir = tempfile.mkdtemp()
+    try:
+        def attach_detach(vdi_uuid):
+            sm_call(base_dir, grace, 'attach', vdi_uuid, True)
+            time.sleep(0.1)
+            sm_call(base_dir, grace, 'detach', vdi_uuid, True)
+
+        pids = []
+        for _i in range(options.processes):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    try:
+                        attach_detach(str(uuidlib.uuid4()))
+                        status = 0
+                    except:
+                        import traceback
+                        traceback.print_exc()
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            _pid, status = os.waitpid(pid, 0)
+            assert status == 0, "SM process failed"
+
+        wait_logout(base_dir, grace)
+        counts = count_commands(base_dir)
+        assert counts['login'] == counts['logout'] == 1, counts
+    finally:
+        shutil.rmtree(base_dir)
+
+    print "concurrent grace %3ds: %d processes: %3d logins %3d logouts" % \
+        (grace, options.processes, counts['login'], counts['logout'])
+    sys.stdout.flush()
+
+
+def boot(options, grace):
+    base_dir = tempfile.mkdtemp()
+    try:
+        def login_at_boot():
+            host = fake_host(base_dir)
+            portal = '%s:%d' % (TARGET, PORT)
+            for op in (['-o', 'new'], ['-l']):
+                host.run(['iscsiadm', '-m', 'node', '-p', portal,
+                          '-T', TARGET_IQN] + op)
+
+        run_forked(login_at_boot)
+        vdi_uuid = str(uuidlib.uuid4())
+        for op in ('attach', 'detach'):
+            run_forked(sm_call, base_dir, grace, op, vdi_uuid, True)
+        wait_logout(base_dir, grace)
+        counts = count_commands(base_dir)
+        # the login at boot is logged too
+        assert counts['login'] == counts['logout'] == 1, counts
+    finally:
+        shutil.rmtree(base_dir)
+
+    print "boot grace %3ds: start on a session of the boot: %3d logins " \
+        "%3d logouts" % (grace, counts['login'] - 1, counts['logout'])
+    sys.stdout.flush()
+
+
+def dead_holder(options, grace):
+    base_dir = tempfile.mkdtemp()
+    try:
+        def hold_and_exit():
+            host = fake_host(base_dir)
+
+            import iscsiindex
+            import iscsisessions
+
+            portal = '%s:%d' % (TARGET, PORT)
+
+            def login():
+                host.run(['iscsiadm', '-m', 'node', '-p', portal,
+                          '-T', TARGET_IQN, '-l'])
+                return iscsiindex.lunPath(portal, TARGET_IQN)
+
+            iscsisessions.SessionPool(grace).acquire(
+                portal, TARGET_IQN, 'scan-%s' % SR_UUID, login, os.getpid())
+
+        run_forked(hold_and_exit)
+        vdi_uuid = str(uuidlib.uuid4())
+        for op in ('attach', 'detach'):
+            run_forked(sm_call, base_dir, grace, op, vdi_uuid, True)
+        wait_logout(base_dir, grace)
+        counts = count_commands(base_dir)
+        assert counts['login'] == counts['logout'] == 1, counts
+    finally:
+        shutil.rmtree(base_dir)
+
+    print "dead holder grace %3ds: start after a holder died: %3d logins " \
+        "%3d logouts" % (grace, counts['login'], counts['logout'])
+    sys.stdout.flush()
+
+
+def mean(values):
+    return sum(values) / len(values)
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--graces', default=DEFAULT_GRACES,
+                      help="comma separated session_grace values [%default]")
+    parser.add_option('--cycles', type='int', default=3,
+                      help="VM starts and stops after the vdi-create "
+                           "[%default]")
+    parser.add_option('--processes', type='int', default=8,
+                      help="SM processes of the concurrent run [%default]")
+    options, _args = parser.parse_args(argv[1:])
+
+    for grace in [int(v) for v in options.graces.split(',')]:
+        life_cycle(options, grace)
+        concurrent(options, grace)
+        boot(options, grace)
+        dead_holder(options, grace)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
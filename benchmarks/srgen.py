@@ -0,0 +1,233 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Generates the device image of an LVHD SR for the resign benchmark: the
+# vgcfgbackup text of its VG, a VHD at the start of every LV, and the SR
+# metadata in its MGT volume.
+#
+# The VDIs come in families: a chain of hidden base copies, the active
+# VDI on top of it, and snapshots hanging off the base copies, the way
+# repeated snapshots leave an LVHD SR.
+#
+
+import os
+import re
+import sys
+import random
+import shutil
+import tempfile
+import uuid as uuidlib
+
+import lvmgen
+import pvgen
+import vhdgen
+import vhdheader
+
+# stand-ins for the modules of the SM framework, found before the driver
+FAKESM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakesm')
+sys.path.insert(0, FAKESM_DIR)
+
+import srmetadata
+
+SECTOR_SIZE = 512
+EXTENT_BYTES = lvmgen.EXTENT_SIZE * SECTOR_SIZE
+VHD_SIZE = 8 * 1024 * 1024 * 1024
+# bytes of an MGT record, as laid out by srmetadata
+VDI_RECORD_SIZE = 2 * SECTOR_SIZE
+SR_INFO_SIZE = 4 * SECTOR_SIZE
+
+_PV_ID_RE = re.compile(r'pv0 {\s*id = "([^"]+)"')
+
+
+class Vdi(object):
+
+    def __init__(self, uuid, parent=None, hidden=False, snapshot_of=None):
+        self.uuid = uuid
+        self.parent = parent
+        self.hidden = hidden
+        self.snapshot_of = snapshot_of
+
+
+def gen_vdis(num_lvs, chain_depth, snapshot_ratio, seed=0):
+    """
+    Lays out the VDIs of an SR
+    :param num_lvs: approximate number of VHD LVs
+    :param chain_depth: number of hidden base copies below each active VDI
+    :param snapshot_ratio: fraction of the base copies which have a snapshot
+    :return: list of Vdi, parents first
+    """
+
+    rand = random.Random(seed)
+    vdis = []
+
+    def new_uuid():
+        return str(uuidlib.UUID(int=rand.getrandbits(128), version=4))
+
+    while len(vdis) < num_lvs:
+        parent = None
+        snapshots = []
+        for level in range(chain_depth):
+            base = Vdi(new_uuid(), parent, hidden=True)
+            vdis.append(base)
+            if rand.random() < snapshot_ratio:
+                snapshots.append(base)
+            parent = base
+        active = Vdi(new_uuid(), parent)
+        vdis.append(active)
+        for base in snapshots:
+            vdis.append(Vdi(new_uuid(), base, snapshot_of=active.uuid))
+
+    return vdis
+
+
+def mapper_path(vg_name, lv_name):
+    """
+    :return: the device mapper path of an LV, which LVHD records as the
+    parent of the VHDs
+    """
+
+    return '/dev/mapper/%s-%s' % (vg_name.replace('-', '--'),
+                                  lv_name.replace('-', '--'))
+
+
+def gen_metadata(sr_uuid, vdis):
+    """
+    :return: the content of the MGT volume, written by the srmetadata of
+    fakesm
+    """
+
+    sr_info = {srmetadata.UUID_TAG: sr_uuid,
+               srmetadata.ALLOCATION_TAG: 'thick',
+               srmetadata.NAME_LABEL_TAG: 'Benchmark SR',
+               srmetadata.NAME_DESCRIPTION_TAG: 'Generated by srgen'}
+
+    vdi_info = {}
+    for i, vdi in enumerate(vdis):
+        vdi_info[SR_INFO_SIZE + i * VDI_RECORD_SIZE] = {
+            srmetadata.UUID_TAG: vdi.uuid,
+            srmetadata.NAME_LABEL_TAG: vdi.hidden and 'base copy' or 'disk %d' % i,
+            srmetadata.NAME_DESCRIPTION_TAG: '',
+            srmetadata.IS_A_SNAPSHOT_TAG: vdi.snapshot_of and '1' or '0',
+            srmetadata.SNAPSHOT_OF_TAG: vdi.snapshot_of or '',
+            srmetadata.TYPE_TAG: 'user',
+            srmetadata.VDI_TYPE_TAG: 'vhd',
+            srmetadata.READ_ONLY_TAG: vdi.hidden and '1' or '0',
+            srmetadata.MANAGED_TAG: vdi.hidden and '0' or '1',
+            srmetadata.SNAPSHOT_TIME_TAG: '19700101T00:00:00Z',
+            srmetadata.METADATA_OF_POOL_TAG: ''}
+
+    temp_fd, path = tempfile.mkstemp()
+    os.close(temp_fd)
+    try:
+        srmetadata.LVMMetadataHandler(path).writeMetadata(sr_info, vdi_info)
+        fd = open(path, 'rb')
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+    finally:
+        os.remove(path)
+
+
+def gen_sr(device, num_lvs, chain_depth=1, snapshot_ratio=0.5, seed=0):
+    """
+    Writes the image of an SR
+    :param device: path of the image, created sparse
+    :return: (vgcfgbackup text, VG name, SR uuid, list of Vdi)
+    """
+
+    rand = random.Random(seed)
+    sr_uuid = str(uuidlib.UUID(int=rand.getrandbits(128), version=4))
+    vdis = gen_vdis(num_lvs, chain_depth, snapshot_ratio, seed)
+
+    metadata = gen_metadata(sr_uuid, vdis)
+    mgt_extents = (len(metadata) + EXTENT_BYTES - 1) / EXTENT_BYTES
+
+    text, vg_name, _uuids = lvmgen.gen_vg_config(
+        len(vdis), seed=seed, device=device, sr_uuid=sr_uuid,
+        vdi_uuids=[vdi.uuid for vdi in vdis], mgt_extents=mgt_extents)
+
+    extents_per_lv = 2
+    lv_offsets = {}
+    for i, vdi in enumerate(vdis):
+        lv_offsets[vdi.uuid] = lvmgen.PE_START * SECTOR_SIZE + \
+            (mgt_extents + i * extents_per_lv) * EXTENT_BYTES
+
+    device_size = lvmgen.PE_START * SECTOR_SIZE + \
+        (mgt_extents + len(vdis) * extents_per_lv + 16) * EXTENT_BYTES
+
+    work_dir = tempfile.mkdtemp()
+    image = open(device, 'wb')
+    try:
+        image.truncate(device_size)
+        image.seek(lvmgen.PE_START * SECTOR_SIZE)
+        image.write(metadata)
+
+        for vdi in vdis:
+            path = os.path.join(work_dir, 'VHD-' + vdi.uuid)
+            parent = None
+            if vdi.parent:
+                # vhdgen needs the parent file for its timestamp
+                parent = (path + '.parent', uuidlib.UUID(vdi.parent.uuid).bytes)
+                open(parent[0], 'w').close()
+            vhdgen.create_vhd(path, VHD_SIZE, uuidlib.UUID(vdi.uuid).bytes,
+                              parent=parent, hidden=vdi.hidden)
+            if vdi.parent:
+                set_parent_name(path, mapper_path(vg_name, 'VHD-' + vdi.parent.uuid))
+                os.remove(parent[0])
+
+            fd = open(path, 'rb')
+            try:
+                image.seek(lv_offsets[vdi.uuid])
+                image.write(fd.read())
+            finally:
+                fd.close()
+            os.remove(path)
+    finally:
+        image.close()
+        shutil.rmtree(work_dir)
+
+    mda_text = pvgen.metadata_text(text, vg_name)
+    fd = os.open(device, os.O_RDWR)
+    try:
+        pvgen.write_label(fd, _PV_ID_RE.search(text).group(1), device_size)
+        # the metadata wraps around the end of the metadata area, as on a PV
+        # whose VG was updated many times
+        pvgen.write_metadata(fd, mda_text, pvgen.mda_size() -
+                             len(mda_text) / 2 / SECTOR_SIZE * SECTOR_SIZE)
+    finally:
+        os.close(fd)
+
+    return text, vg_name, sr_uuid, vdis
+
+
+def set_parent_name(path, parent_path):
+    """
+    Points the parent name and the locators of a VHD generated in a work
+    directory to the path of its parent on the SR
+    """
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        vhd = vhdheader.readHeader(fd)
+        old_path = vhd.parent_name
+        old_dir, old_name = os.path.split(old_path)
+        replacements = [(old_path, parent_path), (old_dir, '/dev/mapper'),
+                        (old_name, os.path.basename(parent_path))]
+        vhdheader.setParent(fd, vhd, vhd.parent_uuid, replacements,
+                            vhdheader._parentLvName(parent_path))
+    finally:
+        os.close(fd)
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Runs the SR lookups of VDILUNSR sr-probe and sr-create in a pool of
+# thousands of SRs, as with an SR per LUN, and reports the XAPI calls they
+# make, the bytes these send through XML-RPC and their latency. XAPI is the
+# marshalled session of fakesm.
+#
+# Each lookup is run without the host-local index of the SRs, then with it,
+# and is compared with reading the records of every SR of the pool, as the
+# lookups did before. The lookup of a target whose SR was forgotten must
+# find that the index is stale.
+#
+# Usage: python srlookup_bench.py [options], see --help
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import uuid as uuidlib
+
+import srgen
+
+import fakexapi
+import SRCommand
+import VDILUNSR
+import srindex
+
+TARGET_FORMAT = '10.%d.%d.%d'
+# VDIs of each SR in the records
+SR_VDIS = 8
+
+
+def target(i):
+    return TARGET_FORMAT % (i / 65536 % 256, i / 256 % 256, i % 256)
+
+
+def sr_record(i, sr_type):
+    """
+    :return: record of an SR, with the fields of a XAPI SR record
+    """
+
+    sr_uuid = str(uuidlib.uuid4())
+    return {
+        'uuid': sr_uuid, 'name_label': 'SR-%05d' % i,
+        'name_description': 'iSCSI SR [%s (%s)]' % (target(i), sr_uuid),
+        'allowed_operations': ['forget', 'VDI.create', 'VDI.snapshot',
+                               'plug', 'update', 'destroy', 'VDI.destroy',
+                               'scan', 'VDI.clone', 'VDI.resize', 'unplug'],
+        'current_operations': {},
+        'VDIs': ['OpaqueRef:%s' % uuidlib.uuid4() for _i in range(SR_VDIS)],
+        'PBDs': ['OpaqueRef:%s' % uuidlib.uuid4()],
+        'virtual_allocation': '0', 'physical_utilisation': '0',
+        'physical_size': str(1024 ** 4), 'type': sr_type,
+        'content_type': 'user', 'shared': True,
+        'other_config': {'auto-scan': 'false'}, 'tags': [],
+        'sm_config': {'datatype': 'ISCSI', 'target': target(i),
+                      'targetIQN': 'iqn.2010-01.com.example:sr-%05d' % i,
+                      'allocation': 'thick', 'use_vhd': 'true',
+                      'devserial': 'scsi-%032x' % i},
+        'blobs': {}, 'local_cache_enabled': False,
+        'introduced_by': 'OpaqueRef:NULL', 'clustered': False,
+        'is_tools_sr': False}
+
+
+def make_pool(srs, vdilun_srs):
+    """
+    :return: the pool, and the targets of its VDILUNSR SRs
+    """
+
+    pool = fakexapi.Pool()
+    targets = []
+    for i in range(srs):
+        sr_type = 'lvmoiscsi'
+        if i % (srs / vdilun_srs) == 0 and len(targets) < vdilun_srs:
+            sr_type = 'vdilun'
+            targets.append(target(i))
+        pool.srs['OpaqueRef:sr-%05d' % i] = sr_record(i, sr_type)
+    return pool, targets
+
+
+def load_sr(pool, sr_target):
+    """
+    :return: a VDILUNSR of a new SR on a target, as sr-probe and sr-create
+    load it
+    """
+
+    fakexapi.pool = pool
+    sr_ref = pool.addSr(str(uuidlib.uuid4()), {})
+    dconf = {'target': sr_target, 'SRmaster': 'true',
+             'localIQN': 'iqn.2017-10.com.example:host'}
+    sr = VDILUNSR.VDILUNSR(SRCommand.SRCommand(dconf,
+                                               params={'sr_ref': sr_ref}),
+                           pool.srs[sr_ref]['uuid'])
+    sr.session.stats.update({'calls': 0, 'bytes': 0})
+    return sr, sr_ref
+
+
+def lookup(pool, op, sr_target):
+    """
+    Runs sr-probe or sr-create on a target
+    :return: (found, seconds, XAPI calls, bytes sent)
+    """
+
+    sr, sr_ref = load_sr(pool, sr_target)
+    start = time.time()
+    if op == 'probe':
+        found = 'SR' in sr.probe().split('SRlist')[1]
+    else:
+        try:
+            sr.create(sr.uuid, 0)
+            found = False
+        except Exception, e:
+            if getattr(e, 'key', None) != 'SRInUse':
+                raise
+            found = True
+    seconds = time.time() - start
+    if op == 'probe' or found:
+        del pool.srs[sr_ref]
+    return found, seconds, sr.session.stats['calls'], sr.session.stats['bytes']
+
+
+def full_scan(pool, sr_target):
+    """
+    The lookup as it was, from the records of every SR of the pool
+    """
+
+    sr, sr_ref = load_sr(pool, sr_target)
+    start = time.time()
+    SRs = sr.session.xenapi.SR.get_all_records()
+    found = False
+    for record in SRs.values():
+        if record['sm_config'].get('target') == sr_target and \
+                record['type'] == VDILUNSR.SR_TYPE_VDILUN:
+            found = True
+    del pool.srs[sr_ref]
+    return found, time.time() - start, sr.session.stats['calls'], \
+        sr.session.stats['bytes']
+
+
+def report(name, result):
+    found, seconds, calls, size = result
+    print "%-34s %-5s %8.3fs %3d calls %10d bytes" % (name, found, seconds,
+                                                     calls, size)
+    sys.stdout.flush()
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--srs', type='int', default=10000,
+                      help="SRs of the pool [%default]")
+    parser.add_option('--vdilun-srs', type='int', default=20,
+                      help="VDILUNSR SRs among them [%default]")
+    options, _args = parser.parse_args(argv[1:])
+
+    fakexapi.MARSHAL = True
+    base_dir = tempfile.mkdtemp()
+    try:
+        srindex.INDEX_FILE = os.path.join(base_dir, 'vdilun-srs')
+        pool, targets = make_pool(options.srs, options.vdilun_srs)
+        used = targets[-1]
+        free = target(options.srs + 1)
+        print "%d SRs, %d VDILUNSR SRs" % (options.srs, len(targets))
+
+        report('full scan, used target', full_scan(pool, used))
+        for name, op, sr_target, found in (
+                ('probe, used target', 'probe', used, True),
+                ('probe, free target', 'probe', free, False),
+                ('create, used target', 'create', used, True)):
+            if os.path.exists(srindex.INDEX_FILE):
+                os.remove(srindex.INDEX_FILE)
+            for indexed in ('cold', 'indexed'):
+                result = lookup(pool, op, sr_target)
+                assert result[0] == found, (name, result)
+                report('%s, %s' % (name, indexed), result)
+
+        # forget the SR of the used target, the index still has it
+        for sr_ref, record in pool.srs.items():
+            if record['sm_config'].get('target') == used and \
+                    record['type'] == 'vdilun':
+                del pool.srs[sr_ref]
+        result = lookup(pool, 'probe', used)
+        assert not result[0], "Forgotten SR found"
+        report('probe, forgotten SR', result)
+        assert srindex.SrIndex().lookup(used) is None, "Stale entry kept"
+
+        result = lookup(pool, 'create', free)
+        assert not result[0]
+        report('create, free target', result)
+        assert srindex.SrIndex().lookup(free), "Created SR not indexed"
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
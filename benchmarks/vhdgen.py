@@ -0,0 +1,124 @@
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Generates sparse VHD files laid out the way vhd-util creates them in LVHD
+# LVs: footer copy, dynamic header, BAT, parent locators, footer.
+#
+
+import os
+import struct
+import time
+
+SECTOR_SIZE = 512
+BLOCK_SIZE = 2 * 1024 * 1024
+VHD_EPOCH = 946684800  # 2000-01-01 00:00:00 UTC
+
+DISK_TYPE_DYNAMIC = 3
+DISK_TYPE_DIFF = 4
+
+PLAT_CODE_MACX = 0x4D616358
+PLAT_CODE_W2KU = 0x57326B75
+PLAT_CODE_W2RU = 0x57327275
+
+
+def _checksum(data):
+    return ~sum(bytearray(data)) & 0xffffffff
+
+
+def _geometry(size):
+    sectors = min(size / SECTOR_SIZE, 65535 * 16 * 255)
+    if sectors >= 65535 * 16 * 63:
+        spt, heads = 255, 16
+        cyl_heads = sectors / spt
+    else:
+        spt = 17
+        cyl_heads = sectors / spt
+        heads = max((cyl_heads + 1023) / 1024, 4)
+        if cyl_heads >= heads * 1024 or heads > 16:
+            spt, heads = 31, 16
+            cyl_heads = sectors / spt
+        if cyl_heads >= heads * 1024:
+            spt, heads = 63, 16
+            cyl_heads = sectors / spt
+    return (cyl_heads / heads) << 16 | heads << 8 | spt
+
+
+def _footer(size, disk_type, uuid, hidden):
+    footer = bytearray(SECTOR_SIZE)
+    struct.pack_into('>8sIIQI4sIIQQIII16sBB', footer, 0,
+                     'conectix', 2, 0x00010000, SECTOR_SIZE,
+                     int(time.time()) - VHD_EPOCH, 'tap\0', 0x00010003, 0,
+                     size, size, _geometry(size), disk_type, 0, uuid, 0,
+                     hidden and 1 or 0)
+    struct.pack_into('>I', footer, 64, _checksum(footer))
+    return footer
+
+
+def create_vhd(path, size, uuid, parent=None, hidden=False):
+    """
+    Writes an empty dynamic VHD, or a differencing one with parent locators
+    :param path: path of the file
+    :param size: virtual size in bytes, a multiple of 2MiB
+    :param uuid: 16 bytes uuid of the VHD
+    :param parent: (path, uuid) of the parent
+    :param hidden: set the hidden flag of the footer
+    """
+
+    max_bat = size / BLOCK_SIZE
+    bat_offset = 3 * SECTOR_SIZE
+    bat_size = (max_bat * 4 + SECTOR_SIZE - 1) / SECTOR_SIZE * SECTOR_SIZE
+    loc_offset = bat_offset + bat_size
+
+    disk_type = DISK_TYPE_DYNAMIC
+    header = bytearray(1024)
+    struct.pack_into('>8sQQIII', header, 0, 'cxsparse', 0xffffffffffffffff,
+                     bat_offset, 0x00010000, max_bat, BLOCK_SIZE)
+
+    locators = []
+    if parent:
+        disk_type = DISK_TYPE_DIFF
+        parent_path, parent_uuid = parent
+        rel_path = './' + os.path.basename(parent_path)
+        name = parent_path.decode('utf-8').encode('utf-16-be')
+        struct.pack_into('>16sI', header, 40, parent_uuid,
+                         int(os.stat(parent_path).st_mtime) - VHD_EPOCH)
+        header[64:64 + len(name)] = name
+
+        entries = [(PLAT_CODE_MACX, 'file://' + rel_path),
+                   (PLAT_CODE_W2KU, parent_path.decode('utf-8').encode('utf-16-le')),
+                   (PLAT_CODE_W2RU, rel_path.decode('utf-8').encode('utf-16-le'))]
+        for i, (code, data) in enumerate(entries):
+            offset = loc_offset + i * SECTOR_SIZE
+            struct.pack_into('>IIIIQ', header, 576 + i * 24, code, 1,
+                             len(data), 0, offset)
+            locators.append((offset, data))
+        loc_offset += len(entries) * SECTOR_SIZE
+
+    struct.pack_into('>I', header, 36, _checksum(header))
+    footer = _footer(size, disk_type, uuid, hidden)
+
+    fd = open(path, 'wb')
+    try:
+        fd.write(footer)
+        fd.write(header)
+        fd.write('\xff' * (max_bat * 4) + '\0' * (bat_size - max_bat * 4))
+        for offset, data in locators:
+            fd.seek(offset)
+            fd.write(data.ljust(SECTOR_SIZE, '\0'))
+        fd.seek(loc_offset)
+        fd.write(footer)
+    finally:
+        fd.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Benchmarks the per-VDI cost of repointing VHD parents after a resign, with
+# vhdheader against vhd-util, on VHD files generated on local disk. The
+# VHDs are renamed the way a resign renames the LVs, then every child is
+# pointed to its renamed parent and checked.
+#
+# Usage: python vhdheader_bench.py [num_vdis ...]
+#
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+import subprocess
+
+import lvmgen
+import vhdgen
+import vhdheader
+
+DEFAULT_SIZES = [10, 100, 1000]
+VHD_SIZE = 8 * 1024 * 1024 * 1024
+VHD_UTIL = '/usr/bin/vhd-util'
+
+
+def make_chains(base_dir, num_vdis):
+    """
+    Creates num_vdis / 2 base VHDs, each with a child, in the directory of a
+    VG, then renames the directory and the VHDs to new uuids
+    :return: (VG directory, old VG name, list of (child, parent, old parent)
+    LV names)
+    """
+
+    old_vg_name = lvmgen.VG_PREFIX + str(uuid.uuid4())
+    vg_name = lvmgen.VG_PREFIX + str(uuid.uuid4())
+    old_dir = os.path.join(base_dir, old_vg_name)
+    os.mkdir(old_dir)
+
+    chains = []
+    for i in range(max(1, num_vdis / 2)):
+        parent_uuid = uuid.uuid4()
+        child_uuid = uuid.uuid4()
+        parent_path = os.path.join(old_dir, 'VHD-%s' % parent_uuid)
+        vhdgen.create_vhd(parent_path, VHD_SIZE, parent_uuid.bytes,
+                          hidden=True)
+        vhdgen.create_vhd(os.path.join(old_dir, 'VHD-%s' % child_uuid),
+                          VHD_SIZE, child_uuid.bytes,
+                          parent=(parent_path, parent_uuid.bytes))
+        chains.append(('VHD-%s' % child_uuid, 'VHD-%s' % parent_uuid))
+
+    vg_dir = os.path.join(base_dir, vg_name)
+    os.rename(old_dir, vg_dir)
+
+    renamed = []
+    for child, parent in chains:
+        new_child = 'VHD-%s' % uuid.uuid4()
+        new_parent = 'VHD-%s' % uuid.uuid4()
+        os.rename(os.path.join(vg_dir, child), os.path.join(vg_dir, new_child))
+        os.rename(os.path.join(vg_dir, parent), os.path.join(vg_dir, new_parent))
+        renamed.append((new_child, new_parent, parent))
+
+    return vg_dir, old_vg_name, renamed
+
+
+def read_header(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return vhdheader.readHeader(fd)
+    finally:
+        os.close(fd)
+
+
+def set_parent_vhdheader(vg_dir, old_vg_name, chains):
+    vg_name = os.path.basename(vg_dir)
+    for child, parent, old_parent in chains:
+        path = os.path.join(vg_dir, child)
+        vhd = read_header(path)
+        assert vhd.getParentLvName() == old_parent
+        parent_vhd = read_header(os.path.join(vg_dir, parent))
+        replacements = [(old_vg_name, vg_name), (old_parent, parent)]
+
+        fd = os.open(path, os.O_RDWR)
+        try:
+            vhdheader.setParent(fd, vhd, parent_vhd.uuid, replacements, parent)
+        finally:
+            os.close(fd)
+
+
+def vhd_util(*args):
+    proc = subprocess.Popen((VHD_UTIL,) + args, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    assert proc.returncode == 0, stderr
+    return stdout
+
+
+def set_parent_vhd_util(vg_dir, old_vg_name, chains):
+    for child, parent, old_parent in chains:
+        path = os.path.join(vg_dir, child)
+        for line in vhd_util('read', '-p', '-n', path).split('\n'):
+            if line.find("decoded name") != -1:
+                assert line.split(':')[1].replace('--', '-')[-40:] == old_parent
+        vhd_util('modify', '-n', path, '-p', os.path.join(vg_dir, parent))
+
+
+def check(vg_dir, chains):
+    for child, parent, old_parent in chains:
+        path = os.path.join(vg_dir, child)
+        vhd = read_header(path)
+        assert vhd.getParentLvName() == parent, vhd.parent_name
+        assert vhd.parent_uuid == read_header(os.path.join(vg_dir, parent)).uuid
+        if os.path.exists(VHD_UTIL):
+            vhd_util('check', '-n', path)
+
+
+def bench(num_vdis):
+    base_dir = tempfile.mkdtemp()
+    try:
+        vg_dir, old_vg_name, chains = make_chains(base_dir, num_vdis)
+        start = time.time()
+        set_parent_vhdheader(vg_dir, old_vg_name, chains)
+        in_process = (time.time() - start) / len(chains)
+        check(vg_dir, chains)
+    finally:
+        shutil.rmtree(base_dir)
+
+    if not os.path.exists(VHD_UTIL):
+        print "parent %5d VHDs: vhdheader %8.1fus/VDI  vhd-util not installed" % \
+            (len(chains) * 2, in_process * 1e6)
+        return
+
+    base_dir = tempfile.mkdtemp()
+    try:
+        vg_dir, old_vg_name, chains = make_chains(base_dir, num_vdis)
+        start = time.time()
+        set_parent_vhd_util(vg_dir, old_vg_name, chains)
+        tool = (time.time() - start) / len(chains)
+        check(vg_dir, chains)
+    finally:
+        shutil.rmtree(base_dir)
+
+    print "parent %5d VHDs: vhd-util %8.1fus/VDI  vhdheader %8.1fus/VDI  (x%.0f)" % \
+        (len(chains) * 2, tool * 1e6, in_process * 1e6, tool / in_process)
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or DEFAULT_SIZES
+    for num_vdis in sizes:
+        bench(num_vdis)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Tests of the parser and serializer of lvmconfigparser: the configs read
+# must match those of the line based parser it replaced, and survive a
+# parse -> serialize -> parse round trip, on the synthetic VG configs of
+# lvmgen and on hand written layouts.
+#
+# Usage: python tests/test_lvmconfigparser.py
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'benchmarks'))
+
+import lvmgen
+import lvmconfigparser
+from lvmconfig_bench import LegacyParser
+
+# the larger configs span several reads of the parser
+SIZES = [1, 100, 2000]
+SEGMENTS_PER_LV = 4
+
+LAYOUT = """\
+# comment before the first section
+contents = "Text Format Volume Group"   # trailing comment
+version = 1
+VG_XenStorage-x { id = "abc" seqno = 3 status = ["RESIZEABLE", "READ",
+\t"WRITE"]
+  extent_size = 8192
+  physical_volumes {
+    pv0 {
+      device = "/dev/sdb"
+      pe_count = 100
+    }
+  }
+  logical_volumes { }
+  flags = [ ]
+}
+creation_time = 1507000000
+ratio = 0.5
+"""
+
+
+def parse(text):
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(StringIO.StringIO(text))
+    return parser.toDict()
+
+
+def serialize(config_dict):
+    return lvmconfigparser.LvmConfigParser(config_dict).toConfigString()
+
+
+class ParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_matches_legacy(self):
+        for num_lvs in SIZES:
+            text, vg_name, _uuids = lvmgen.gen_vg_config(num_lvs,
+                                                         SEGMENTS_PER_LV)
+            path = os.path.join(self.dir, 'config')
+            fd = open(path, 'w')
+            try:
+                fd.write(text)
+            finally:
+                fd.close()
+
+            parser = lvmconfigparser.LvmConfigParser()
+            parser.parse(path)
+            self.assertEqual(parser.toDict(), LegacyParser().parse(path))
+            self.assertEqual(
+                len(parser.toDict()[vg_name]['logical_volumes']), num_lvs + 1)
+
+    def test_layout(self):
+        config = parse(LAYOUT)
+        vg = config['VG_XenStorage-x']
+        self.assertEqual(config['contents'], 'Text Format Volume Group')
+        self.assertEqual(config['ratio'], 0.5)
+        self.assertEqual(vg['id'], 'abc')
+        self.assertEqual(vg['seqno'], 3)
+        self.assertEqual(vg['status'], ['RESIZEABLE', 'READ', 'WRITE'])
+        self.assertEqual(vg['physical_volumes']['pv0']['pe_count'], 100)
+        self.assertEqual(vg['logical_volumes'], {})
+        self.assertEqual(vg['flags'], [])
+
+    def test_escapes(self):
+        config = parse('description = "a \\"quoted\\" \\\\ path"\n'
+                       'tags = ["x\\"y"]\n')
+        self.assertEqual(config['description'], 'a "quoted" \\ path')
+        self.assertEqual(config['tags'], ['x"y'])
+
+    def test_errors(self):
+        for text in ['a {\n', '}\n', 'a = \n', 'a = [1, 2\n', 'a = [1 2]\n',
+                     'a b\n', 'a = ]\n']:
+            self.assertRaises(lvmconfigparser.ParseError, parse, text)
+
+
+class SerializerTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for num_lvs in SIZES:
+            text, _vg_name, _uuids = lvmgen.gen_vg_config(num_lvs,
+                                                          SEGMENTS_PER_LV)
+            config = parse(text)
+            self.assertEqual(parse(serialize(config)), config)
+
+    def test_round_trip_layout(self):
+        config = parse(LAYOUT)
+        self.assertEqual(parse(serialize(config)), config)
+
+    def test_round_trip_escapes(self):
+        config = {'a': 'back\\slash "quote"', 'b': [u'unicode', 'x"y', 1],
+                  'c': {'d': {}, 'e': 2.25, 'f': -1}}
+        self.assertEqual(parse(serialize(config)), config)
+
+    def test_write(self):
+        text, _vg_name, _uuids = lvmgen.gen_vg_config(100, SEGMENTS_PER_LV)
+        parser = lvmconfigparser.LvmConfigParser(parse(text))
+        output = StringIO.StringIO()
+        parser.write(output)
+        self.assertEqual(output.getvalue(), parser.toConfigString())
+
+    def test_legacy_parser_reads_output(self):
+        # the output stays readable by the line based parser, so by older
+        # versions of the driver
+        text, _vg_name, _uuids = lvmgen.gen_vg_config(100, SEGMENTS_PER_LV)
+        config = parse(text)
+        handle, path = tempfile.mkstemp()
+        try:
+            os.write(handle, serialize(config))
+            os.close(handle)
+            self.assertEqual(LegacyParser().parse(path), config)
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Tests of lvmlabel on PV images in a loop file. The images are laid out
+# by pvgen, and, where the LVM tools and loop devices are available, made
+# by pvcreate and vgcreate on a loop device attached to the file.
+#
+# Usage: python tests/test_lvmlabel.py
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'benchmarks'))
+
+import lvmgen
+import pvgen
+import lvmlabel
+
+SECTOR_SIZE = 512
+IMAGE_SIZE = 64 * 1024 * 1024
+PV_UUID = 'kX1gZr-tQ3v-Jm2a-Xq8b-Lw4c-Pn5d-Ye6fRs'
+LVM_TOOLS = ['losetup', 'pvcreate', 'vgcreate', 'lvcreate', 'lvremove',
+             'vgremove', 'vgs', 'pvs']
+
+
+def which(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep) + \
+            ['/sbin', '/usr/sbin']:
+        if os.access(os.path.join(directory, name), os.X_OK):
+            return True
+    return False
+
+
+def have_lvm_tools():
+    if os.geteuid() != 0:
+        return False
+    for name in LVM_TOOLS:
+        if not which(name):
+            return False
+    return True
+
+
+def read_pv(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return lvmlabel.readPvMetadata(fd)
+    finally:
+        os.close(fd)
+
+
+class LoopFileTest(unittest.TestCase):
+    """ A sparse image file, the backing file of the loop device of a PV """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.dir, 'pv.img')
+        fd = open(self.image, 'wb')
+        try:
+            fd.truncate(IMAGE_SIZE)
+        finally:
+            fd.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def pwrite(self, data, offset):
+        fd = os.open(self.image, os.O_RDWR)
+        try:
+            os.lseek(fd, offset, 0)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def pread(self, size, offset):
+        fd = os.open(self.image, os.O_RDONLY)
+        try:
+            os.lseek(fd, offset, 0)
+            return os.read(fd, size)
+        finally:
+            os.close(fd)
+
+
+class PvgenTest(LoopFileTest):
+    """ PVs laid out by pvgen """
+
+    def setUp(self):
+        LoopFileTest.setUp(self)
+        config, self.vg_name, _uuids = lvmgen.gen_vg_config(20,
+                                                           device=self.image)
+        self.text = pvgen.metadata_text(config, self.vg_name)
+
+    def write(self, text=None, offset=None):
+        fd = os.open(self.image, os.O_RDWR)
+        try:
+            pvgen.write_label(fd, PV_UUID, IMAGE_SIZE)
+            if text:
+                pvgen.write_metadata(fd, text, offset)
+        finally:
+            os.close(fd)
+
+    def test_no_label(self):
+        self.assertEqual(read_pv(self.image), None)
+
+    def test_empty_area(self):
+        self.write()
+        pv = read_pv(self.image)
+        self.assertEqual(pv.pv_uuid, PV_UUID)
+        self.assertEqual(pv.device_size, IMAGE_SIZE)
+        self.assertEqual(pv.text, None)
+        self.assertEqual(pv.vg_name, None)
+
+    def test_metadata(self):
+        self.write(self.text)
+        pv = read_pv(self.image)
+        self.assertEqual(pv.pv_uuid, PV_UUID)
+        self.assertEqual(pv.vg_name, self.vg_name)
+        self.assertEqual(pv.seqno, 42)
+        self.assertEqual(pv.text, self.text)
+
+    def test_newest_commit(self):
+        self.write(self.text)
+        fd = os.open(self.image, os.O_RDWR)
+        try:
+            newer = self.text.replace('seqno = 42', 'seqno = 43')
+            pvgen.write_metadata(fd, newer)
+        finally:
+            os.close(fd)
+        pv = read_pv(self.image)
+        self.assertEqual(pv.seqno, 43)
+        self.assertEqual(pv.text, newer)
+
+    def test_wrapped(self):
+        # the metadata starts before the end of the area and wraps around
+        offset = pvgen.mda_size() - len(self.text) / 2 / SECTOR_SIZE * \
+            SECTOR_SIZE
+        self.write(self.text, offset)
+        self.assertEqual(read_pv(self.image).text, self.text)
+
+    def test_past_first_read(self):
+        offset = lvmlabel.READ_SIZE + 16 * SECTOR_SIZE
+        self.write(self.text, offset)
+        self.assertEqual(read_pv(self.image).text, self.text)
+
+    def test_previous_metadata(self):
+        # pvcreate rewrites the label and the area header, the committed
+        # metadata is still in the circular buffer
+        offset = pvgen.mda_size() - len(self.text) / 2 / SECTOR_SIZE * \
+            SECTOR_SIZE
+        self.write(self.text, offset)
+        fd = os.open(self.image, os.O_RDWR)
+        try:
+            newer = self.text.replace('seqno = 42', 'seqno = 43')
+            pvgen.write_metadata(fd, newer)
+            pvgen.write_label(fd, PV_UUID, IMAGE_SIZE)
+            self.assertEqual(read_pv(self.image).text, None)
+            previous = lvmlabel.readPreviousMetadata(fd)
+        finally:
+            os.close(fd)
+        self.assertEqual(previous, [(self.vg_name, 43, newer),
+                                    (self.vg_name, 42, self.text)])
+
+    def test_no_previous_metadata(self):
+        self.write()
+        fd = os.open(self.image, os.O_RDONLY)
+        try:
+            self.assertEqual(lvmlabel.readPreviousMetadata(fd), [])
+        finally:
+            os.close(fd)
+
+    def test_bad_label_checksum(self):
+        self.write(self.text)
+        offset = pvgen.LABEL_SECTOR * SECTOR_SIZE + 40
+        self.pwrite(chr(ord(self.pread(1, offset)) ^ 0xff), offset)
+        self.assertRaises(lvmlabel.LvmLabelError, read_pv, self.image)
+
+    def test_bad_metadata_checksum(self):
+        self.write(self.text)
+        offset = pvgen.MDA_OFFSET + lvmlabel.MDA_HEADER_SIZE + 10
+        self.pwrite(chr(ord(self.pread(1, offset)) ^ 0xff), offset)
+        self.assertRaises(lvmlabel.LvmLabelError, read_pv, self.image)
+
+
+class LoopDeviceTest(LoopFileTest):
+    """ PVs made by the LVM tools on a loop device """
+
+    def setUp(self):
+        LoopFileTest.setUp(self)
+        self.device = None
+        self.vg_name = 'VG_lvmlabel_test_%d' % os.getpid()
+        if not have_lvm_tools():
+            LoopFileTest.tearDown(self)
+            self.skipTest("needs root and the LVM tools")
+        self.device = self.lvm('losetup', '-f', '--show', self.image).strip()
+        self.lvm('pvcreate', '-ff', '-y', '--metadatasize', '128k',
+                 self.device)
+        self.lvm('vgcreate', self.vg_name, self.device)
+
+    def tearDown(self):
+        if self.device:
+            try:
+                self.lvm('vgremove', '-f', self.vg_name)
+            finally:
+                self.lvm('losetup', '-d', self.device)
+        LoopFileTest.tearDown(self)
+
+    def lvm(self, *cmd):
+        process = subprocess.Popen(list(cmd), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        if process.returncode:
+            raise AssertionError("%s failed: %s" % (' '.join(cmd), stderr))
+        return stdout
+
+    def report(self, tool, field):
+        return self.lvm(tool, '--noheadings', '-o', field,
+                        tool == 'vgs' and self.vg_name or self.device).strip()
+
+    def check(self):
+        pv = read_pv(self.device)
+        self.assertEqual(pv.vg_name, self.vg_name)
+        self.assertEqual(pv.seqno, int(self.report('vgs', 'seqno')))
+        self.assertEqual(pv.pv_uuid, self.report('pvs', 'pv_uuid'))
+        self.assertEqual(pv.device_size, IMAGE_SIZE)
+        # the backing file holds the same bytes
+        self.assertEqual(read_pv(self.image).text, pv.text)
+        return pv
+
+    def lvcreate(self, lv_name):
+        # not activated, device-mapper needs udev
+        self.lvm('lvcreate', '-an', '-Zn', '-L', '4m', '-n', lv_name,
+                 self.vg_name)
+
+    def test_vg(self):
+        self.lvcreate('lv0')
+        pv = self.check()
+        self.failUnless(pv.text.find('lv0 {') != -1)
+
+    def test_wrapped(self):
+        # enough commits to go round the 128KiB metadata area
+        for i in range(60):
+            self.lvcreate('lv%d' % i)
+        for i in range(0, 60, 2):
+            self.lvm('lvremove', '-f', '%s/lv%d' % (self.vg_name, i))
+        pv = self.check()
+        self.assertEqual(pv.text.find('lv0 {'), -1)
+        self.failUnless(pv.text.find('lv59 {') != -1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Tests of lvmresign: the resigned config must be the one the deepcopy
+# based resign it replaced makes, and the original config left untouched.
+#
+# Usage: python tests/test_lvmresign.py
+#
+
+import os
+import sys
+import copy
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'benchmarks'))
+
+import lvmgen
+import lvmconfigparser
+import lvmresign
+from lvmconfig_bench import resign_deepcopy
+
+SIZES = [1, 100, 1000]
+SEGMENTS_PER_LV = 4
+DEVICE = '/dev/sdz'
+
+
+def parse(text):
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(StringIO.StringIO(text))
+    return parser.toDict()
+
+
+def resign_args(num_lvs, renamed=1.0):
+    """
+    :param renamed: fraction of the VHD LVs renamed
+    :return: the arguments of a resign of a generated config
+    """
+
+    text, vg_name, uuids = lvmgen.gen_vg_config(num_lvs, SEGMENTS_PER_LV)
+    config_dict = parse(text)
+
+    rand = lvmgen.random.Random(1)
+    vg_info = config_dict[vg_name]
+    pv_ids = dict([(pv, lvmgen.gen_lvm_id(rand))
+                   for pv in vg_info['physical_volumes']])
+    lv_ids = dict([(lv, lvmgen.gen_lvm_id(rand))
+                   for lv in vg_info['logical_volumes']])
+    lv_names = dict([('VHD-' + uuid, 'VHD-' + lvmgen.gen_uuid(rand))
+                     for uuid in uuids[:int(len(uuids) * renamed)]])
+    return (config_dict, vg_name, lvmgen.VG_PREFIX + lvmgen.gen_uuid(rand),
+            pv_ids, DEVICE, lv_ids, lv_names)
+
+
+class ResignTest(unittest.TestCase):
+
+    def test_matches_deepcopy(self):
+        for num_lvs in SIZES:
+            for renamed in (1.0, 0.5, 0.0):
+                args = resign_args(num_lvs, renamed)
+                original = copy.deepcopy(args[0])
+                resigned = lvmresign.ResignedLvmConfig(*args).toConfigString()
+                self.assertEqual(args[0], original)
+                self.assertEqual(parse(resigned),
+                                 parse(resign_deepcopy(*args)))
+
+    def test_substitutions(self):
+        args = resign_args(10)
+        (config_dict, old_vg_name, new_vg_name, pv_ids, device, lv_ids,
+         lv_names) = args
+        config = parse(lvmresign.ResignedLvmConfig(*args).toConfigString())
+
+        self.failIf(old_vg_name in config)
+        vg_info = config[new_vg_name]
+        self.assertEqual(vg_info['id'], config_dict[old_vg_name]['id'])
+        for pv, pv_info in vg_info['physical_volumes'].iteritems():
+            self.assertEqual(pv_info['id'], pv_ids[pv])
+            self.assertEqual(pv_info['device'], device)
+
+        lvs = vg_info['logical_volumes']
+        self.assertEqual(len(lvs), len(config_dict[old_vg_name]
+                                       ['logical_volumes']))
+        for lv_name in lv_ids:
+            new_name = lv_names.get(lv_name, lv_name)
+            self.assertEqual(lvs[new_name]['id'], lv_ids[lv_name])
+
+    def test_dropped(self):
+        args = resign_args(10)
+        lv_names = args[-1]
+        dropped = lv_names.keys()[:3]
+        config = parse(lvmresign.ResignedLvmConfig(
+            *args + (set(dropped),)).toConfigString())
+        lvs = config[args[2]]['logical_volumes']
+        self.assertEqual(len(lvs), len(args[5]) - len(dropped))
+        for lv_name in dropped:
+            self.failIf(lv_name in lvs or lv_names[lv_name] in lvs)
+
+    def test_write(self):
+        args = resign_args(100)
+        resigned = lvmresign.ResignedLvmConfig(*args)
+        output = StringIO.StringIO()
+        resigned.write(output)
+        self.assertEqual(output.getvalue(), resigned.toConfigString())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Tests of the resign journal: the resign of a generated image is killed at
+# each phase boundary, between pvcreate and vgcfgrestore, and inside
+# resign_vdis, and the next resign must resume it from the journal, or
+# restart it if the VG was not restored yet, and leave the checked image of
+# a completed resign. The resigns run in child processes, as in the resign
+# bench, whose crash points they use.
+#
+# Usage: python tests/test_resignjournal.py
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'benchmarks'))
+
+import resign_bench
+import lvmlabel
+import lvmconfigparser
+
+NUM_LVS = 30
+DEPTH = 2
+SNAPSHOTS = 0.5
+# the VG is restored by resign_lvm, a crash before it leaves nothing to
+# resume
+RESTARTED = ['read_pv_metadata', 'open_journal', 'prune_snapshots']
+
+
+def expected_outcome(crash, prune):
+    phase = crash[0]
+    if phase == 'prune_snapshots' and not prune:
+        return 'not reached'
+    if phase in RESTARTED or crash == ('resign_lvm', 'before'):
+        return 'restarted'
+    return 'resumed'
+
+
+class CrashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def generate(self):
+        """
+        :return: (directory of a generated image, its description)
+        """
+
+        base_dir = tempfile.mkdtemp(dir=self.dir)
+        sr = resign_bench.run_forked(resign_bench.generate, base_dir, NUM_LVS,
+                                     DEPTH, SNAPSHOTS)[0]
+        return base_dir, sr
+
+    def crash(self, crash, prune):
+        """
+        Crashes the resign of a generated image and runs it again, which
+        checks the image
+        :return: outcome, see resign_bench.crash_resign
+        """
+
+        base_dir, sr = self.generate()
+        outcome, crashed_uuid, result = resign_bench.crash_resign(
+            base_dir, sr, prune, crash, 4, 0.0)
+        self.assertEqual(outcome, expected_outcome(crash, prune),
+                         "%s %s, prune %s: %s" % (crash[1], crash[0], prune,
+                                                  outcome))
+        if outcome == 'resumed':
+            self.assertEqual(result['outcome'], 'resumed')
+            self.assertEqual(result['sr_uuid'], crashed_uuid)
+        elif outcome == 'restarted':
+            self.assertEqual(result['outcome'], 'resigned')
+        shutil.rmtree(base_dir)
+        return outcome
+
+    def test_crash_points(self):
+        for crash in resign_bench.crash_points():
+            self.crash(crash, False)
+
+    def test_crash_points_pruned(self):
+        for crash in resign_bench.crash_points():
+            self.crash(crash, True)
+
+    def test_pvcreate(self):
+        # the PV has a new label and no VG metadata, the VG is read from
+        # what its metadata area held
+        self.assertEqual(self.crash(('pvcreate', 'after'), True), 'resumed')
+
+    def test_pvcreate_without_journal(self):
+        # a PV without VG metadata and no journal of its restore is not
+        # resigned from the stale metadata of its metadata area. The MGT
+        # volume, which holds the journal, is erased.
+        base_dir, sr = self.generate()
+        crashed_uuid = '4f9c2d1e-3b7a-4e6f-9a8d-2c1b0e5f7a63'
+        self.assertRaises(resign_bench.Crashed, resign_bench.run_forked,
+                          resign_bench.resign, base_dir, sr, True, 1, 0.0,
+                          crashed_uuid, ('pvcreate', 'after'))
+        resign_bench.run_forked(resign_bench.logout, base_dir)
+
+        device = os.path.join(base_dir, 'lun.img')
+        fd = os.open(device, os.O_RDWR)
+        try:
+            vg_name, _seqno, text = lvmlabel.readPreviousMetadata(fd)[0]
+            self.assertEqual(vg_name, sr['vg_name'])
+            offset, size = mgt_extent(vg_name, text)
+            os.lseek(fd, offset, 0)
+            os.write(fd, '\0' * size)
+        finally:
+            os.close(fd)
+
+        try:
+            resign_bench.run_forked(resign_bench.resign, base_dir, sr, True, 4,
+                                    0.0, crashed_uuid)
+        except RuntimeError, e:
+            self.failUnless(str(e).find("no VG metadata") != -1, str(e))
+        else:
+            self.fail("Resigned a PV without VG metadata nor journal")
+        self.assertEqual(resign_bench.read_label(device).text, None)
+
+
+def mgt_extent(vg_name, text):
+    """
+    :param text: metadata text of the VG
+    :return: (offset, size) in the image of the MGT volume
+    """
+
+    parser = lvmconfigparser.LvmConfigParser()
+    parser.parse(StringIO.StringIO(text))
+    vg_info = parser.toDict()[vg_name]
+    segment = vg_info['logical_volumes']['MGT']['segment1']
+    pv_name, start_pe = segment['stripes'][:2]
+    extent_size = vg_info['extent_size'] * lvmlabel.SECTOR_SIZE
+    pe_start = vg_info['physical_volumes'][pv_name]['pe_start']
+    return (pe_start * lvmlabel.SECTOR_SIZE + start_pe * extent_size,
+            segment['extent_count'] * extent_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+#
+# Copyright (C) CloudOps Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Tests of vhdheader on VHD files laid out by vhdgen: the footer and the
+# dynamic header are decoded, and setParent rewrites the parent uuid, the
+# parent name and the MACX, W2KU and W2RU locators of a differencing VHD
+# the way the resign renames its parent.
+#
+# Usage: python tests/test_vhdheader.py
+#
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import uuid as uuidlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'benchmarks'))
+
+import lvmgen
+import vhdgen
+import vhdheader
+
+VHD_SIZE = 64 * 1024 * 1024
+# offsets of the fields the tests corrupt
+FOOTER_CHECKSUM = 64
+HEADER_CHECKSUM = 36
+
+
+def escape(name):
+    # device mapper names double the dashes of VG and LV names
+    return name.replace('-', '--')
+
+
+def mapper_name(vg_name, lv_name):
+    return '%s-%s' % (escape(vg_name), escape(lv_name))
+
+
+class VhdTest(unittest.TestCase):
+    """ A differencing VHD named after its LV, and its parent """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vg_name = lvmgen.VG_PREFIX + str(uuidlib.uuid4())
+        self.parent_lv_name = 'VHD-' + str(uuidlib.uuid4())
+        self.parent_uuid = uuidlib.uuid4().bytes
+        self.parent = os.path.join(self.dir, mapper_name(self.vg_name,
+                                                         self.parent_lv_name))
+        vhdgen.create_vhd(self.parent, VHD_SIZE, self.parent_uuid,
+                          hidden=True)
+
+        self.uuid = uuidlib.uuid4().bytes
+        self.path = os.path.join(self.dir, 'child.vhd')
+        vhdgen.create_vhd(self.path, VHD_SIZE, self.uuid,
+                          parent=(self.parent, self.parent_uuid))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path=None):
+        fd = os.open(path or self.path, os.O_RDONLY)
+        try:
+            return vhdheader.readHeader(fd)
+        finally:
+            os.close(fd)
+
+    def pwrite(self, data, offset):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.lseek(fd, offset, 0)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def pread(self, size, offset):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.lseek(fd, offset, 0)
+            return os.read(fd, size)
+        finally:
+            os.close(fd)
+
+    def locatorPaths(self, vhd):
+        """
+        :return: dict of the platform codes of the locators to their paths
+        """
+
+        paths = {}
+        for loc in vhd.locators:
+            data = self.pread(loc.data_len, loc.data_offset)
+            encoding = vhdheader._LOCATOR_ENCODINGS[loc.code]
+            paths[loc.code] = data.decode(encoding).encode('utf-8')
+        return paths
+
+    def setParent(self, replacements, parent_lv_name, parent_uuid):
+        vhd = self.read()
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            return vhdheader.setParent(fd, vhd, parent_uuid, replacements,
+                                       parent_lv_name)
+        finally:
+            os.close(fd)
+
+    def resign(self):
+        """
+        Renames the VG and the parent LV, as the resign does
+        :return: (new VG name, new parent LV name, new parent uuid)
+        """
+
+        vg_name = lvmgen.VG_PREFIX + str(uuidlib.uuid4())
+        parent_lv_name = 'VHD-' + str(uuidlib.uuid4())
+        parent_uuid = uuidlib.uuid4().bytes
+        replacements = [(escape(self.vg_name), escape(vg_name)),
+                        (self.vg_name, vg_name),
+                        (escape(self.parent_lv_name), escape(parent_lv_name)),
+                        (self.parent_lv_name, parent_lv_name)]
+        self.setParent(replacements, parent_lv_name, parent_uuid)
+        return vg_name, parent_lv_name, parent_uuid
+
+    def test_dynamic(self):
+        vhd = self.read(self.parent)
+        self.assertEqual(vhd.disk_type, vhdheader.DISK_TYPE_DYNAMIC)
+        self.assertEqual(vhd.uuid, self.parent_uuid)
+        self.failUnless(vhd.hidden)
+        self.assertEqual(vhd.getParentLvName(), None)
+        self.assertEqual(vhd.locators, [])
+
+    def test_differencing(self):
+        vhd = self.read()
+        self.assertEqual(vhd.disk_type, vhdheader.DISK_TYPE_DIFF)
+        self.assertEqual(vhd.uuid, self.uuid)
+        self.failIf(vhd.hidden)
+        self.assertEqual(vhd.header_offset, vhdheader.FOOTER_SIZE)
+        self.assertEqual(vhd.bytes_read,
+                         vhdheader.FOOTER_SIZE + vhdheader.HEADER_SIZE)
+        self.assertEqual(vhd.parent_uuid, self.parent_uuid)
+        self.assertEqual(vhd.parent_name, self.parent)
+        self.assertEqual(vhd.getParentLvName(), self.parent_lv_name)
+
+        name = os.path.basename(self.parent)
+        self.assertEqual(self.locatorPaths(vhd), {
+            vhdheader.PLAT_CODE_MACX: 'file://./' + name,
+            vhdheader.PLAT_CODE_W2KU: self.parent,
+            vhdheader.PLAT_CODE_W2RU: './' + name})
+
+    def test_not_vhd(self):
+        self.pwrite('\0' * 8, 0)
+        self.assertEqual(self.read(), None)
+
+    def test_set_parent(self):
+        vg_name, parent_lv_name, parent_uuid = self.resign()
+
+        vhd = self.read()
+        new_parent = os.path.join(self.dir,
+                                  mapper_name(vg_name, parent_lv_name))
+        self.assertEqual(vhd.uuid, self.uuid)
+        self.assertEqual(vhd.parent_uuid, parent_uuid)
+        self.assertEqual(vhd.parent_name, new_parent)
+        self.assertEqual(vhd.getParentLvName(), parent_lv_name)
+
+        name = os.path.basename(new_parent)
+        self.assertEqual(self.locatorPaths(vhd), {
+            vhdheader.PLAT_CODE_MACX: 'file://./' + name,
+            vhdheader.PLAT_CODE_W2KU: new_parent,
+            vhdheader.PLAT_CODE_W2RU: './' + name})
+
+        # readHeader checks it, the header holds the sum of its bytes
+        header = self.pread(vhdheader.HEADER_SIZE, vhd.header_offset)
+        self.assertEqual(struct.unpack('>I', header[HEADER_CHECKSUM:
+                                                    HEADER_CHECKSUM + 4])[0],
+                         vhdheader._checksum(header, HEADER_CHECKSUM))
+
+    def test_set_parent_io(self):
+        # the locators are read, then written with the header
+        data_len = sum([loc.data_len for loc in self.read().locators])
+        self.assertEqual(self.setParent([], self.parent_lv_name,
+                                        self.parent_uuid),
+                         (data_len, data_len + vhdheader.HEADER_SIZE))
+
+    def test_set_parent_length(self):
+        # the parent moves to a shorter directory: the locator lengths
+        # change, and no byte of the longer paths is left
+        name = os.path.basename(self.parent)
+        new_parent = '/dev/mapper/' + name
+        self.setParent([(self.parent, new_parent), (self.dir, '/dev/mapper')],
+                       self.parent_lv_name, self.parent_uuid)
+
+        vhd = self.read()
+        self.assertEqual(vhd.parent_name, new_parent)
+        paths = self.locatorPaths(vhd)
+        self.assertEqual(paths[vhdheader.PLAT_CODE_W2KU], new_parent)
+        self.assertEqual(paths[vhdheader.PLAT_CODE_W2RU], './' + name)
+        for loc in vhd.locators:
+            tail = self.pread(vhdheader.SECTOR_SIZE - loc.data_len,
+                              loc.data_offset + loc.data_len)
+            self.assertEqual(tail, '\0' * len(tail))
+
+    def test_unexpected_locator(self):
+        # a locator which does not name the old parent is not rewritten, the
+        # caller falls back to vhd-util
+        vhd = self.read()
+        loc = [loc for loc in vhd.locators
+               if loc.code == vhdheader.PLAT_CODE_W2RU][0]
+        other = './' + mapper_name(self.vg_name, 'VHD-' + str(uuidlib.uuid4()))
+        self.pwrite(other.decode('utf-8').encode('utf-16-le'), loc.data_offset)
+
+        before = self.pread(os.path.getsize(self.path), 0)
+        self.assertRaises(vhdheader.VhdFormatError, self.resign)
+        self.assertEqual(self.pread(os.path.getsize(self.path), 0), before)
+
+    def test_unexpected_parent_name(self):
+        self.assertRaises(vhdheader.VhdFormatError, self.setParent,
+                          [], 'VHD-' + str(uuidlib.uuid4()), self.parent_uuid)
+
+    def test_not_differencing(self):
+        vhd = self.read(self.parent)
+        fd = os.open(self.parent, os.O_RDWR)
+        try:
+            self.assertRaises(vhdheader.VhdFormatError, vhdheader.setParent,
+                              fd, vhd, self.uuid, [], self.parent_lv_name)
+        finally:
+            os.close(fd)
+
+    def test_bad_footer_checksum(self):
+        offset = FOOTER_CHECKSUM - 1
+        self.pwrite(chr(ord(self.pread(1, offset)) ^ 0xff), offset)
+        self.assertRaises(vhdheader.VhdFormatError, self.read)
+
+    def test_bad_header_cookie(self):
+        self.pwrite('\0' * 8, vhdheader.FOOTER_SIZE)
+        self.assertRaises(vhdheader.VhdFormatError, self.read)
+
+    def test_bad_header_checksum(self):
+        offset = vhdheader.FOOTER_SIZE + 64
+        self.pwrite(chr(ord(self.pread(1, offset)) ^ 0xff), offset)
+        self.assertRaises(vhdheader.VhdFormatError, self.read)
+
+
+if __name__ == '__main__':
+    unittest.main()